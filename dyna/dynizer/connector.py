@@ -3,7 +3,10 @@ from ..common.errors import *
 from .types import *
 from .filters import *
 import http.client
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, IntEnum
+import queue
+import threading
 import urllib
 import re
 
@@ -20,6 +23,8 @@ class DynizerConnection:
         self.https = https
         self.key_file = key_file
         self.cert_file = cert_file
+        self.username = username
+        self.password = password
         self._headers = {
             'cache-control': 'no-cache',
             'content-type': 'application/json'
@@ -49,6 +54,17 @@ class DynizerConnection:
             self.connection.close()
             self.connection = None
 
+    def clone(self):
+        # http.client connections can not be shared between threads, so
+        # concurrent operations each work on their own (unconnected) copy
+        return self.__class__(self.dynizer_address, self.dynizer_port,
+                              endpoint_prefix=self.endpoint_prefix,
+                              https=self.https,
+                              key_file=self.key_file,
+                              cert_file=self.cert_file,
+                              username=self.username,
+                              password=self.password)
+
 
 
     # Functions that operate on partially of fully populated objects
@@ -56,9 +72,14 @@ class DynizerConnection:
         f = self.__get_function_handle_for_obj('create', obj)
         return f(obj)
 
-    def batch_create(self, obj_arr):
+    def batch_create(self, obj_arr, payload=None):
+        # payload optionally holds obj_arr already serialized by serialize_batch
         f = self.__get_function_handle_for_obj('batch_create', obj_arr[0])
-        return f(obj_arr)
+        return f(obj_arr, payload)
+
+    @staticmethod
+    def serialize_batch(obj_arr):
+        return '['+','.join(map(lambda x: x.to_json(), obj_arr))+']'
 
     def read(self, obj):
         f = self.__get_function_handle_for_obj('read', obj)
@@ -85,6 +106,157 @@ class DynizerConnection:
         f = self.__get_function_handle_for_class('list', type)
         return f(field_filters, pagination_filter)
 
+    def iterate(self, type, field_filters=None, pagination_filter=None):
+        """
+        Iterate over all objects of the given type page by page.
+
+        Pages are fetched with keyset pagination on id unless an explicit
+        PaginationFilter (offset based) or KeysetPaginationFilter is provided.
+        """
+        page_filter = KeysetPaginationFilter(100) if pagination_filter is None else pagination_filter
+        while True:
+            page = self.list(type, field_filters, page_filter)
+            if page is None or len(page) == 0:
+                return
+            yield from page
+            if len(page) < page_filter.limit:
+                return
+            page_filter = page_filter.next_page(page)
+
+    def parallel_scan(self, type, field_filters=None, partitions=4, key='id',
+                      bounds=None, page_size=100):
+        """
+        Scan all objects of the given type using several connections at once.
+
+        The key space (id by default, or e.g. action_id / topology_id) is split
+        in `partitions` disjoint ranges (low, high], every range is paged with
+        keyset pagination on its own worker connection and the pages are merged
+        into one stream as they arrive. The order of the stream is therefore not
+        defined. For keys other than id the (low, high) bounds must be given;
+        for id they are probed on the server when omitted.
+        """
+        field_filters = [] if field_filters is None else list(field_filters)
+        if bounds is None:
+            if key != 'id':
+                raise FilterError(type, key, 'Partition bounds required for')
+            self.connect()
+            bounds = self.__probe_id_bounds(type, field_filters or None)
+            if bounds is None:
+                return
+        low, high = bounds
+
+        # Partition i covers (edges[i], edges[i+1]], the last one is left open
+        # ended so objects created during the scan are not missed
+        partitions = max(1, min(partitions, high - low + 1))
+        edges = [low - 1 + ((high - low + 1) * i) // partitions for i in range(partitions)]
+        ranges = [(edges[i], edges[i + 1] if i + 1 < partitions else None) for i in range(partitions)]
+
+        pages = queue.Queue(maxsize=2 * partitions)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker(lower, upper):
+            conn = self.clone()
+            try:
+                conn.connect()
+                filters = list(field_filters)
+                if key == 'id':
+                    page_filter = KeysetPaginationFilter(page_size, lower)
+                else:
+                    page_filter = KeysetPaginationFilter(page_size)
+                    filters.append(FieldFilter(key, FilterOperator.GT, lower))
+                if upper is not None:
+                    filters.append(FieldFilter(key, FilterOperator.LTEQ, upper))
+
+                while not stop.is_set():
+                    page = conn.list(type, filters or None, page_filter)
+                    if page is None or len(page) == 0:
+                        break
+                    if not put(page) or len(page) < page_size:
+                        break
+                    page_filter = page_filter.next_page(page)
+                put(done)
+            except Exception as e:
+                put(e)
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target=worker, args=r, daemon=True) for r in ranges]
+        for t in threads:
+            t.start()
+        try:
+            remaining = len(threads)
+            while remaining > 0:
+                item = pages.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield from item
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+
+    def read_many(self, type, ids, max_url_length=2048, workers=4):
+        """
+        Fetch the objects of the given type for a list of ids.
+
+        The ids are packed into as few multi-value id filters as the url length
+        allows, the resulting list() calls run concurrently on worker connections.
+        The result is in the order of ids, with None for ids that were not found.
+        """
+        ids = list(ids)
+        chunks = DynizerConnection.__pack_ids(ids, max_url_length - len(self.endpoint_prefix))
+        if len(chunks) == 0:
+            return []
+
+        def fetch(conn, chunk):
+            return conn.list(type,
+                             [FieldFilter('id', FilterOperator.IN, chunk)],
+                             PaginationFilter(0, len(chunk)))
+
+        results = []
+        if workers <= 1 or len(chunks) == 1:
+            self.connect()
+            for chunk in chunks:
+                results.append(fetch(self, chunk))
+        else:
+            local = threading.local()
+            clones = []
+            clones_lock = threading.Lock()
+
+            def worker(chunk):
+                if not hasattr(local, 'conn'):
+                    local.conn = self.clone()
+                    local.conn.connect()
+                    with clones_lock:
+                        clones.append(local.conn)
+                return fetch(local.conn, chunk)
+
+            try:
+                with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+                    results = list(executor.map(worker, chunks))
+            finally:
+                for conn in clones:
+                    conn.close()
+
+        by_id = {}
+        for result in results:
+            for obj in result if result is not None else []:
+                by_id[str(obj.id)] = obj
+        return [by_id.get(str(id)) for id in ids]
+
     # Query functions
     def query(self, query, pagination_filter=None):
         f = self.__get_function_handle_for_obj('query', query)
@@ -112,6 +284,56 @@ class DynizerConnection:
         return func
 
 
+    def __probe_id_bounds(self, type, field_filters):
+        # Lowest id: the first keyset page of a single object
+        first = self.list(type, field_filters, KeysetPaginationFilter(1))
+        if first is None or len(first) == 0:
+            return None
+        low = int(first[0].id)
+
+        def exists_after(id):
+            page = self.list(type, field_filters, KeysetPaginationFilter(1, id))
+            return int(page[0].id) if page is not None and len(page) > 0 else None
+
+        # Gallop upwards until nothing lies beyond the probe, then bisect
+        # the last step to find the highest id
+        high = low
+        step = 1
+        while True:
+            nxt = exists_after(high + step)
+            if nxt is None:
+                break
+            high = nxt
+            step *= 2
+        upper = high + step
+        while high < upper:
+            middle = (high + upper) // 2
+            nxt = exists_after(middle)
+            if nxt is None:
+                upper = middle
+            else:
+                high = nxt
+        return (low, high)
+
+    @staticmethod
+    def __pack_ids(ids, max_url_length):
+        # Reserve room for the endpoint path, the filter name and the pagination
+        budget = max(max_url_length - 96, 1)
+        chunks = []
+        chunk = []
+        length = 0
+        for id in ids:
+            id_length = len(FieldFilter.quote_value(id)) + 1
+            if len(chunk) > 0 and length + id_length > budget:
+                chunks.append(chunk)
+                chunk = []
+                length = 0
+            chunk.append(id)
+            length += id_length
+        if len(chunk) > 0:
+            chunks.append(chunk)
+        return chunks
+
     @staticmethod
     def __build_url_with_arguments(cls, url, field_filters=None, pagination_filter=None):
         filters = ''
@@ -197,9 +419,8 @@ class DynizerConnection:
         url = '/data/v1_1/instances'
         return self.__POST('/data/v1_1/instances', obj.to_json(), Instance)
 
-    def __batch_create_Instance(self, obj_arr):
-        json_arr = list(map(lambda x: x.to_json(), obj_arr))
-        data = '['+','.join(json_arr)+']'
+    def __batch_create_Instance(self, obj_arr, payload=None):
+        data = DynizerConnection.serialize_batch(obj_arr) if payload is None else payload
         url = '/data/v1_1/instances'
         return self.__POST(url, data, Instance)
 
@@ -3,3 +3,4 @@ from .filter_operator import FilterOperator
 
 from .field_filter import FieldFilter
 from .pagination_filter import PaginationFilter
+from .keyset_pagination_filter import KeysetPaginationFilter
@@ -1,7 +1,8 @@
 from ..types import *
 from ...common.errors import *
 from .filter import Filter
-import urllib
+from .filter_operator import FilterOperator
+import urllib.parse
 
 class FieldFilter(Filter):
     def __init__(self, field, op, value):
@@ -14,12 +15,18 @@ class FieldFilter(Filter):
         # Exception for components filter on Topology class
         if cls.__name__ == Topology.__name__ and self.field == 'components':
             return "{0}={1}'{2}'".format(self.field, self.op.to_url_operator(), self.value)
+        elif self.op == FilterOperator.IN:
+            # Multi-value filter: field=[v1,v2,...]
+            return '{0}=[{1}]'.format(self.field, ','.join(map(FieldFilter.quote_value, self.value)))
         else:
-            return '{0}={1}{2}'.format(self.field, self.op.to_url_operator(), urllib.parse.quote(self.value))
+            return '{0}={1}{2}'.format(self.field, self.op.to_url_operator(), FieldFilter.quote_value(self.value))
+
+    @staticmethod
+    def quote_value(value):
+        return urllib.parse.quote(str(value))
 
     @staticmethod
     def __validate_field(cls, field):
         if not cls._can_filter_on(field):
             raise FilterError(cls, field)
 
-
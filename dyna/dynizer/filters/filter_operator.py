@@ -10,6 +10,7 @@ class FilterOperator(Enum):
     GTEQ = 5
     NEQ = 6
     TSRCH = 7
+    IN = 8
 
     @staticmethod
     @static_func_vars(trmap={
@@ -19,7 +20,8 @@ class FilterOperator(Enum):
         4: '>',
         5: '>=',
         6: '!=',
-        7: '~='
+        7: '~=',
+        8: '[]'
     })
     def __to_str(v):
         return FilterOperator.__to_str.trmap[int(v)]
@@ -28,7 +30,8 @@ class FilterOperator(Enum):
         return FilterOperator.__to_str(self.value)
 
     def to_url_operator(self):
-        if self.value == FilterOperator.EQ.value:
+        # Multi-value filters carry their operator around the value list
+        if self.value == FilterOperator.EQ.value or self.value == FilterOperator.IN.value:
             return ''
         else:
             return FilterOperator.__to_str(self.value)
@@ -41,7 +44,8 @@ class FilterOperator(Enum):
         '>': 'GT',
         '>=': 'GTEQ',
         '!=': 'NEQ',
-        '~=': 'TSRCH'
+        '~=': 'TSRCH',
+        '[]': 'IN'
     })
     def from_string(cls, string):
         op_name = FilterOperators.from_string.trmap[string]
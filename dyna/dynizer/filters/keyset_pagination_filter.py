@@ -0,0 +1,27 @@
+from .filter import Filter
+from .filter_operator import FilterOperator
+from .field_filter import FieldFilter
+
+class KeysetPaginationFilter(Filter):
+    """
+    Keyset (cursor) pagination
+
+    Instead of skipping `offset` rows, every page asks for the `limit` objects
+    whose `key` is greater than the last key seen on the previous page. This
+    requires the server to return results in ascending key order, but keeps
+    the cost of a page independent of how deep into the result set it is.
+    """
+    def __init__(self, limit, last_key=None, key='id'):
+        self.limit = limit
+        self.last_key = last_key
+        self.key = key
+
+    def compose_filter(self, cls):
+        if self.last_key is None:
+            return 'limit={0}'.format(self.limit)
+        key_filter = FieldFilter(self.key, FilterOperator.GT, self.last_key)
+        return '{0}&limit={1}'.format(key_filter.compose_filter(cls), self.limit)
+
+    def next_page(self, page):
+        return KeysetPaginationFilter(self.limit, getattr(page[-1], self.key), self.key)
+
@@ -8,3 +8,6 @@ class PaginationFilter(Filter):
     def compose_filter(self, cls):
         return 'offset={0}&limit={1}'.format(self.offset, self.limit)
 
+    def next_page(self, page):
+        return PaginationFilter(self.offset + len(page), self.limit)
+
@@ -4,3 +4,17 @@ from .xml_loader import XMLLoopVariable, XMLMapping, XMLLoader
 from .csv_loader import CSVAbstractElement, CSVFixedElement, CSVRowElement, CSVStringCombinationElement
 from .csv_loader import CSVMapping, CSVLoader
 
+from .json_loader import JSONAbstractElement, JSONFixedElement, JSONVariableElement, JSONExtractionElement, JSONStringCombinationElement
+from .json_loader import JSONLoopVariable, JSONMapping, JSONLoader
+
+from .sql_loader import SQLLoader
+
+from .engine import LoaderEngine, Sink, ConnectorSink, SpoolSink, DryRunSink
+from .registry import TopologyRegistry
+from .metrics import ProgressReporter, ConsoleReporter, LoaderMetrics
+from .rejects import RejectFile
+from .dedup import Deduplicator, FingerprintSet, BloomFilter
+from .delta import DeltaState, DeltaRun
+from .follow import FollowState
+
+from .directory_loader import DirectoryLoader, FileStatus
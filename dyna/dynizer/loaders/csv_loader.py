@@ -1,8 +1,27 @@
-from ..types import Action, ComponentType, DataElement, DataType, Instance, InstanceElement, Topology
+from ..types import Action, ComponentType, DataType, InstanceElement
 from ..connector import DynizerConnection
 from ...common.errors import LoaderError
+from .metrics import LoaderMetrics
+from .pipeline import chunked, ordered_map, threaded_iter
+from .delta import DeltaRun, DeltaState, row_hash
+from .engine import LoaderEngine, Sink, default_sink
+from .follow import FollowState, _FollowedFile
+from .rejects import describe_error
+from concurrent.futures import ProcessPoolExecutor
 from typing import Sequence
+import bz2
+import contextlib
 import csv
+import gzip
+import io
+import itertools
+import locale
+import lzma
+import mmap
+import multiprocessing
+import os
+import sys
+import time
 
 class CSVAbstractElement:
     def __init__(self, value,
@@ -20,6 +39,20 @@ class CSVAbstractElement:
         labels.append(self.label)
         return True
 
+    def _row_producer(self):
+        # The fast path of a compiled mapping: a function that builds the
+        # InstanceElement for a row, or returns None to defer to fetch_from_row.
+        # Constant values are converted once and shared between instances.
+        element = InstanceElement(value=self.value, datatype=self.data_type)
+        return lambda row: element
+
+    def _max_index(self):
+        return -1
+
+    def _columns(self):
+        # The row indices the element reads, used to decode only those columns
+        return ()
+
 
 
 class CSVFixedElement(CSVAbstractElement):
@@ -55,7 +88,7 @@ class CSVRowElement(CSVAbstractElement):
                 return self._add_na_value(components, data, labels)
         else:
             value = row[self.index]
-            if value in self.na_list:
+            if value is None or value in self.na_list:
                 if self.required:
                     return self._add_na_value(components, data, labels)
             else:
@@ -67,9 +100,31 @@ class CSVRowElement(CSVAbstractElement):
                 labels.append(self.label)
                 return True
 
+    def _row_producer(self):
+        index = self.index
+        na_set = frozenset(self.na_list)
+        transform_funcs = tuple(self.transform_funcs)
+        data_type = self.data_type
+
+        def produce(row):
+            value = row[index]
+            # Typed database values may be unhashable, only text can be a na value
+            if value is None or (isinstance(value, str) and value in na_set):
+                return None
+            for tf in transform_funcs:
+                value = tf(value)
+            return InstanceElement(value=value, datatype=data_type)
+        return produce
+
+    def _max_index(self):
+        return self.index
+
+    def _columns(self):
+        return (self.index,)
+
     def _add_na_value(self, components, data, labels):
         if self.default is not None:
-            data.append(InstanceElement(value=value, datatype=self.data_type))
+            data.append(InstanceElement(value=self.default, datatype=self.data_type))
         elif self.allow_void:
             data.append(InstanceElement())
         else:
@@ -95,10 +150,10 @@ class CSVStringCombinationElement(CSVAbstractElement):
     def fetch_from_row(self, row, components, data, labels):
         tmp_data = []
         for index in self.indices:
-            data = ''
+            value = ''
             if len(row) > index:
-                data = row[index]
-            tmp_data.append(data)
+                value = _text(row[index])
+            tmp_data.append(value)
 
         value = self.combinator_func(tmp_data) if self.combinator_func is not None else self._default_combinator(tmp_data)
         if len(value) == 0:
@@ -109,18 +164,29 @@ class CSVStringCombinationElement(CSVAbstractElement):
         else:
             data.append(InstanceElement(value=value, datatype=DataType.STRING))
 
-        component.append(self.component)
+        components.append(self.component)
         labels.append(self.label)
+        return True
+
+    def _row_producer(self):
+        indices = tuple(self.indices)
+        combinator = self.combinator_func if self.combinator_func is not None else self._default_combinator
+
+        def produce(row):
+            value = combinator([_text(row[index]) for index in indices])
+            if len(value) == 0:
+                return None
+            return InstanceElement(value=value, datatype=DataType.STRING)
+        return produce
+
+    def _max_index(self):
+        return max(self.indices) if len(self.indices) > 0 else -1
+
+    def _columns(self):
+        return tuple(self.indices)
 
     def _default_combinator(self, tmp_data):
-        result = '';
-        for elem in tmp_data:
-            if len(elem) > 0:
-                if len(result) == 0:
-                    result = '{0}'.format(result, elem)
-                else:
-                    result = '{0} {1}'.format(result, elem)
-        return result
+        return ' '.join(elem for elem in tmp_data if len(elem) > 0)
 
 
 
@@ -134,10 +200,108 @@ class CSVMapping:
         self.fallback = list(fallback)
         self.batch_size = batch_size
 
+    def map_row(self, row):
+        """
+        Map a single csv row onto instance data
+
+        Returns a (components, data, labels, topology key) tuple, or None when
+        neither the elements nor the fallback elements could be fetched from
+        the row.
+        """
+        result = CSVMapping.__fetch_row(row, self.elements)
+        if result is None:
+            result = CSVMapping.__fetch_row(row, self.fallback)
+        return result
+
+    def compile(self):
+        """
+        Compile the mapping into a specialized row mapper
+
+        The returned callable behaves like map_row, but the components, labels
+        and topology key for rows where every element has a value are computed
+        once up front. Rows with missing or n/a values, and mappings with
+        custom element classes, take the generic map_row path. The components
+        and labels lists of the result are shared between rows and must not be
+        modified.
+        """
+        primary = CSVMapping.__compile_elements(self.elements)
+        fallback = CSVMapping.__compile_elements(self.fallback)
+
+        def mapper(row):
+            result = primary(row)
+            if result is None:
+                result = fallback(row)
+            return result
+        return mapper
+
+    @staticmethod
+    def __compile_elements(elements):
+        elements = list(elements)
+        if len(elements) == 0:
+            return lambda row: None
+
+        def generic(row):
+            return CSVMapping.__fetch_row(row, elements)
+
+        # Instances need two components, which the generic path checks per row
+        if len(elements) < 2:
+            return generic
+        for element in elements:
+            if type(element).fetch_from_row not in _COMPILABLE_FETCHES:
+                return generic
+
+        components = [element.component for element in elements]
+        labels = [element.label for element in elements]
+        top_map_key = ','.join(map(str, components))
+        producers = [element._row_producer() for element in elements]
+        min_length = max(element._max_index() for element in elements) + 1
+
+        def mapper(row):
+            if len(row) < min_length:
+                return generic(row)
+            data = []
+            for produce in producers:
+                element = produce(row)
+                if element is None:
+                    return generic(row)
+                data.append(element)
+            return (components, data, labels, top_map_key)
+        return mapper
+
+    @staticmethod
+    def __fetch_row(row, elements):
+        if len(elements) == 0:
+            return None
+
+        components = []
+        data = []
+        labels = []
+        for element in elements:
+            if element.fetch_from_row(row, components, data, labels) == False:
+                return None
+
+        if len(components) < 2:
+            return None
+        return (components, data, labels, ','.join(map(str, components)))
+
 
 
 class CSVLoader:
-    def __init__(self, csv_path: str,
+    """
+    CSV loader
+
+    The csv_path can be a path to a plain or compressed (.gz, .bz2, .xz) file,
+    '-' for stdin, a text or binary stream, or any iterable of lines. Paths are
+    decompressed based on their extension, binary streams based on their
+    leading magic bytes, and all input is streamed rather than read up front.
+
+    With backend 'mmap' an uncompressed file is memory mapped and records are
+    split on the raw bytes, decoding only the columns the mappings reference.
+    The other fields of the rows handed to custom code (such as rejects) are
+    None. It needs an ascii compatible encoding and no escapechar; otherwise
+    the regular 'csv' backend is used.
+    """
+    def __init__(self, csv_path,
                        mappings: Sequence[CSVMapping] = [],
                        header_count=0,
                        delimiter=',',
@@ -147,7 +311,9 @@ class CSVLoader:
                        quotechar='"',
                        quoting=csv.QUOTE_MINIMAL,
                        skipinitialspace=False,
-                       strict=False):
+                       strict=False,
+                       encoding=None,
+                       backend='csv'):
         print("INIT !!!")
         print(mappings)
         self.csv_path = csv_path
@@ -161,130 +327,751 @@ class CSVLoader:
         self.quoting = quoting
         self.skipinitialspace = skipinitialspace
         self.strict = strict
+        self.encoding = encoding
+        if backend not in ('csv', 'mmap'):
+            raise LoaderError(CSVLoader, "Unknown csv backend: '{0}'".format(backend))
+        self.backend = backend
         print(self.mappings)
 
     def add_mapping(self, mapping: CSVMapping):
         self.mappings.append(mapping)
 
-    def run(self, connection: DynizerConnection, debug=False):
+    def run(self, connection: DynizerConnection, debug=False,
+                  processes=1, chunk_size=64*1024*1024,
+                  pipeline=False, upload_workers=2, queue_size=8,
+                  registry=None, prescan=False, prescan_workers=4,
+                  progress=None, rejects=None, dedup=None, delta=None,
+                  sink: Sink = None):
+        """
+        Load the csv file into the Dynizer
+
+        When processes is larger than 1 the file is split in byte ranges of
+        about chunk_size bytes, aligned on record boundaries, which are parsed
+        and mapped in a process pool. Topology creation and batch uploads stay
+        in the calling process. Worker processes are forked, so on platforms
+        without fork the mappings (including transform functions) must be
+        picklable.
+
+        With pipeline enabled reading, mapping and uploading run as concurrent
+        stages connected by queues of at most queue_size items: a reader
+        thread, the mapping stage in the calling thread and upload_workers
+        upload threads, each with their own connection.
+
+        Actions and topologies are resolved through registry, a
+        TopologyRegistry that can be shared between loaders and persisted
+        between runs. Without one a fresh in memory registry is used.
+
+        With prescan enabled the file is scanned once up front to collect the
+        distinct topologies of every mapping, which are then resolved with
+        prescan_workers concurrent requests before any instance is loaded. A
+        number instead of True only samples that many rows; topologies missed
+        by the sample are resolved when they are met. Prescanning needs a
+        source that can be opened twice, so it is skipped for streams.
+
+        progress takes a ProgressReporter (such as ConsoleReporter), a function
+        or a list of them, which receive periodic snapshots with throughput,
+        batch counts, the time spent per stage (parse, fetch, topology,
+        serialize, http) and an ETA based on the file offset. In parallel mode
+        the parse time also covers the mapping done by the worker processes.
+        The final snapshot is returned.
+
+        rejects takes a path or a RejectFile. When given, rows whose mapping
+        raises an error and instances the server rejects are written to it
+        with their source row and the error, and loading continues. Rejected
+        batches are bisected to single out the offending instances. Rows that
+        lack a required value are skipped as before and not quarantined.
+
+        dedup drops instances identical to one loaded before in this run (same
+        action, topology and data values): True for an in memory
+        FingerprintSet, a number to bound its size, or a Deduplicator such as
+        a spilling FingerprintSet or a BloomFilter. The number of dropped
+        duplicates is reported in the snapshot.
+
+        delta takes a path or a DeltaState and enables incremental loading of
+        a csv file: an unchanged file is skipped, when rows were appended only
+        those are read, and otherwise only rows that were not in the file at
+        the previous successful run are loaded. Rows are compared by content,
+        so the state should be reset when the mappings change.
+
+        sink replaces the Dynizer as the destination of the instances, e.g. a
+        SpoolSink that writes them to a file for a later replay. Without a
+        connection the instances are mapped and counted by a DryRunSink. The
+        delta state is only committed once the sink is closed.
+        """
+        delta_state = None
+        delta_run = None
         try:
-            if connection is not None:
-                connection.connect()
-            for mapping in self.mappings:
-                self.__run_mapping(connection, mapping, debug)
-            if connection is not None:
-                connection.close()
+            if delta is not None:
+                if not isinstance(self.csv_path, (str, os.PathLike)) or self.csv_path == '-':
+                    raise LoaderError(CSVLoader, "Delta loading requires a csv file")
+                delta_state = delta if isinstance(delta, DeltaState) else DeltaState(delta)
+                delta_run = delta_state.begin(self.csv_path, appendable=self.__is_plain_file())
+                print('Delta load of {0}: {1}'.format(self.csv_path, delta_run.mode))
+                if delta_run.mode == DeltaRun.UNCHANGED:
+                    return LoaderMetrics(progress).finish()
+                if delta_run.mode == DeltaRun.CHANGED:
+                    with self.__rows() as csv_rdr:
+                        delta_run.collect(itertools.islice(csv_rdr, self.header_count, None))
+                    if processes is not None and processes > 1:
+                        print('Delta loading of a changed file runs in a single process')
+                        processes = 1
+
+            sink = default_sink(connection, sink, registry, upload_workers if pipeline else 0, queue_size)
+            engine = LoaderEngine(CSVLoader, sink, progress=progress, rejects=rejects, dedup=dedup, debug=debug)
+            snapshot = engine.run(lambda engine: self.__load(engine, delta_run, processes, chunk_size,
+                                                             pipeline, queue_size, prescan, prescan_workers))
+            if delta_run is not None:
+                delta_run.commit()
+            return snapshot
         except Exception as e:
-            if connection is not None:
-                connection.close()
+            if delta_run is not None:
+                delta_run.rollback()
             raise e
+        finally:
+            if delta_state is not None and delta_state is not delta:
+                delta_state.close()
 
-    def __run_mapping(self, connection: DynizerConnection,
-                            mapping: CSVMapping,
-                            debug):
-        print('Creating instances for: {0}'.format(mapping.action.name))
-        action_obj = None
-        if connection is not None:
-            try:
-                action_obj = connection.create(mapping.action)
-            except Exception as e:
-                raise LoaderError(CSVLoader, "Failed to create required action: '{0}'".format(mapping.action.name))
-
-        topology_map = {}
-        loadlist = []
-
-        self.__run_simple_mapping(connection, mapping, action_obj, topology_map, loadlist, debug)
-
-        if len(loadlist) > 0:
-            self.__push_batch(connection, loadlist)
-
-    def __run_simple_mapping(self, connection: DynizerConnection,
-                                   mapping: CSVMapping,
-                                   action_obj, topology_map, loadlist,
-                                   debug):
-        with open(self.csv_path, newline='') as csvfile:
-            row_cnt=0
-            csv_rdr = csv.reader(csvfile,
-                                 delimiter=self.delimiter,
-                                 doublequote=self.doublequote,
-                                 escapechar=self.escapechar,
-                                 lineterminator=self.lineterminator,
-                                 quotechar=self.quotechar,
-                                 quoting=self.quoting,
-                                 skipinitialspace=self.skipinitialspace,
-                                 strict=self.strict)
-            for row in csv_rdr:
-                row_cnt = row_cnt+1
-                if row_cnt <= self.header_count:
-                    continue
+    def follow(self, connection: DynizerConnection, debug=False,
+                     offsets=None, max_latency=5.0, poll_interval=1.0,
+                     idle_timeout=None, stop=None, read_size=1024*1024,
+                     registry=None, progress=None, rejects=None, dedup=None,
+                     sink: Sink = None):
+        """
+        Follow a growing csv file and load its rows as they are appended
 
-                status = self.__run_mapping_on_row(row, topology_map, loadlist, action_obj, connection, mapping, debug=debug)
-                if not status:
-                    self.__run_mapping_on_row(row, topology_map, loadlist, action_obj, connection, mapping, fallback=True, debug=debug)
+        Like tail -f, the file is read up to its last complete record and
+        polled every poll_interval seconds for new data. Rows are loaded in
+        micro-batches: the instances of a mapping are written once its
+        batch_size is reached, and everything that was read is flushed at the
+        latest max_latency seconds after the first unflushed row.
 
-            if len(loadlist) >= mapping.batch_size:
-                self.__push_batch(connection, loadlist)
+        offsets takes a path or a FollowState that persists the offset of the
+        loaded rows, which is stored after every flush. A restarted follower
+        resumes at that offset, so rows are loaded at least once: rows read
+        after the last flush are loaded again. When the file is rotated (the
+        path refers to a new file) the old file is read to its end and the new
+        file is followed from its start, header rows included; a truncated
+        file is read again from the start.
 
-    def __run_mapping_on_row(self, row, topology_map, loadlist,
-                                   action_obj: Action,
-                                   connection: DynizerConnection,
-                                   mapping: CSVMapping,
-                                   fallback = False,
-                                   debug = False):
-        components = []
-        data = []
-        labels = []
-        elements = mapping.fallback if fallback else mapping.elements
-        if len(elements) == 0:
-            return False
+        Following stops when stop, a threading.Event, is set, after
+        idle_timeout seconds without new rows, or on a keyboard interrupt.
+        The rows read so far are then flushed and the final snapshot is
+        returned. registry, progress, rejects, dedup and sink work as in run;
+        batches are uploaded inline so a stored offset is never ahead of the
+        instances in the Dynizer.
 
-        for element in elements:
-            if element.fetch_from_row(row, components, data, labels) == False:
-                return False
+        Following requires an uncompressed csv file in an ascii compatible
+        encoding without escapechar.
+        """
+        if not self.__is_plain_file():
+            raise LoaderError(CSVLoader, "Following requires an uncompressed csv file")
+        if self.escapechar is not None or not _is_ascii_compatible(self.__encoding(), self.delimiter, self.quotechar):
+            raise LoaderError(CSVLoader, "Following requires an ascii compatible encoding and no escapechar")
 
-        if len(components) < 2:
-            return False
+        state = offsets if offsets is None or isinstance(offsets, FollowState) else FollowState(offsets)
+        try:
+            sink = default_sink(connection, sink, registry)
+            engine = LoaderEngine(CSVLoader, sink, progress=progress, rejects=rejects, dedup=dedup, debug=debug)
+            return engine.run(lambda engine: self.__follow(engine, state, max_latency, poll_interval,
+                                                           idle_timeout, stop, read_size))
+        finally:
+            if state is not None and state is not offsets:
+                state.close()
 
-        if debug:
-            inst = Instance(action_id=0, topology_id=0, data=data)
-            print(inst.to_json())
+    def __follow(self, engine: LoaderEngine, state: FollowState, max_latency, poll_interval,
+                       idle_timeout, stop, read_size):
+        metrics = engine.metrics
+        states = [engine.bind(mapping, mapping.compile()) for mapping in self.mappings]
+        batch_rows = max([mapping.batch_size for mapping in self.mappings], default=1)
+        quote = None if self.quoting == csv.QUOTE_NONE else self.quotechar.encode('ascii')
+        followed = _FollowedFile(self.csv_path, quote, read_size)
+        if followed.open(state) and followed.position > 0:
+            print('Resuming {0} at offset {1}'.format(self.csv_path, followed.position))
+        metrics.position = lambda: followed.position
 
-        if connection is None:
-            return True
+        unflushed = 0
+        oldest = None
+        last_data = time.monotonic()
+        skip = 0
+        try:
+            while stop is None or not stop.is_set():
+                records, at_start = followed.read()
+                if at_start:
+                    skip = self.header_count
+                if len(records) > 0:
+                    last_data = time.monotonic()
+                    csv_rdr = self.__reader(io.StringIO(records.decode(self.__encoding()), newline=''))
+                    for row in metrics.timed_iter(csv_rdr, 'parse'):
+                        if skip > 0:
+                            skip -= 1
+                            continue
+                        metrics.row()
+                        unflushed += 1
+                        for mapping_state in states:
+                            engine.map(mapping_state, row, row)
+                    if oldest is None and unflushed > 0:
+                        oldest = last_data
 
-        top_map_key = ','.join(map(str, components))
-        topology_obj = None
-        if top_map_key in topology_map:
-            topology_obj = topology_map[top_map_key]
+                now = time.monotonic()
+                if unflushed > 0 and (unflushed >= batch_rows or now - oldest >= max_latency):
+                    self.__flush_followed(engine, state, followed)
+                    unflushed = 0
+                    oldest = None
+                    metrics.report()
+                if len(records) > 0:
+                    continue
+                if idle_timeout is not None and now - last_data >= idle_timeout:
+                    break
+                wait = poll_interval if oldest is None else min(poll_interval, max(0, oldest + max_latency - now))
+                if stop is not None:
+                    stop.wait(wait)
+                else:
+                    time.sleep(wait)
+        except KeyboardInterrupt:
+            print('Stopped following {0}'.format(self.csv_path))
+        try:
+            self.__flush_followed(engine, state, followed)
+        finally:
+            followed.close()
+
+    def __flush_followed(self, engine: LoaderEngine, state: FollowState, followed):
+        # The offset is only stored once the rows before it are written
+        engine.flush()
+        if state is not None and followed.file is not None:
+            state.save(self.csv_path, followed.file, followed.position)
+
+    def __load(self, engine: LoaderEngine, delta_run: DeltaRun, processes, chunk_size,
+                     pipeline, queue_size, prescan, prescan_workers):
+        states = [engine.bind(mapping, mapping.compile()) for mapping in self.mappings]
+        if prescan and engine.sink.resolves_topologies:
+            self.__prescan(engine, states, prescan, prescan_workers)
+        if processes is not None and processes > 1:
+            reason = self._split_requirement()
+            if reason is not None:
+                print('Parallel loading requires {0}, loading in a single process'.format(reason))
+                processes = 1
+        if processes is not None and processes > 1:
+            self.__run_parallel(engine, states, delta_run, processes, chunk_size, pipeline, queue_size)
         else:
-            if topology_obj is None:
+            self.__run_simple(engine, states, delta_run, pipeline, queue_size)
+
+    def __prescan(self, engine: LoaderEngine, states, prescan, workers):
+        if not isinstance(self.csv_path, (str, os.PathLike)) or self.csv_path == '-':
+            print('Prescan requires a csv file that can be read twice, skipping prescan')
+            return
+
+        with self.__rows() as csv_rdr:
+            csv_rdr = itertools.islice(csv_rdr, self.header_count, None)
+            if prescan is not True:
+                csv_rdr = itertools.islice(csv_rdr, prescan)
+            engine.prescan(((state, (row,)) for row in csv_rdr for state in states), workers)
+
+    def __run_simple(self, engine: LoaderEngine, states, delta_run: DeltaRun, pipeline, queue_size, start = None):
+        # A single scan over the file evaluates every mapping on each row,
+        # from byte offset start when given
+        metrics = engine.metrics
+        if start is None:
+            start = delta_run.start if delta_run is not None else 0
+        with self.__rows(metrics, start) as csv_rdr:
+            csv_rdr = metrics.timed_iter(csv_rdr, 'parse')
+            if start == 0:
+                csv_rdr = itertools.islice(csv_rdr, self.header_count, None)
+            if delta_run is not None:
+                csv_rdr = delta_run.filter(csv_rdr)
+            if pipeline:
+                chunks = threaded_iter(chunked(csv_rdr, _PIPELINE_CHUNK_ROWS), queue_size)
+            else:
+                chunks = [csv_rdr]
+
+            try:
+                for rows in chunks:
+                    for row in rows:
+                        metrics.row()
+                        for state in states:
+                            engine.map(state, row, row)
+            finally:
+                if pipeline:
+                    chunks.close()
+
+    def __run_parallel(self, engine: LoaderEngine, states, delta_run: DeltaRun,
+                             processes, chunk_size, pipeline, queue_size):
+        metrics = engine.metrics
+        start = delta_run.start if delta_run is not None else 0
+        ranges = self._record_ranges(chunk_size, start)
+
+        # Ranges are consumed in file order, so the end of the last one is the offset
+        offset = [ranges[0][0] if len(ranges) > 0 else 0]
+        metrics.position = lambda: offset[0]
+        metrics.total_bytes = os.path.getsize(self.csv_path)
+
+        quarantine = any(state.rejects is not None for state in states)
+        chunks = self.__map_ranges(ranges, processes, quarantine, delta_run is not None)
+        if pipeline:
+            chunks = threaded_iter(chunks, queue_size)
+        try:
+            with contextlib.closing(chunks):
+                for (start, end), (row_count, mapped_rows, hashes) in zip(ranges, metrics.timed_iter(chunks, 'parse')):
+                    if hashes is not None:
+                        delta_run.record_hashes(hashes)
+                    for mapping_index, mapped, source, error in mapped_rows:
+                        if error is None:
+                            engine.load(states[mapping_index], mapped, source=source)
+                        else:
+                            engine.reject(states[mapping_index], source, error)
+                    offset[0] = end
+                    metrics.row(row_count)
+                    metrics.report()
+        except _RangeBoundaryError as e:
+            # All ranges before the failing one were verified, so it starts on
+            # a record boundary and the rest of the file can be read in order
+            print('{0}, loading the rest of the file in a single process'.format(e))
+            self.__run_simple(engine, states, delta_run, pipeline, queue_size, start=offset[0])
+
+    def __map_ranges(self, ranges, processes, quarantine, hash_rows):
+        # Keep a bounded number of ranges in flight so mapped rows do not pile
+        # up in memory when uploading is slower than mapping
+        with ProcessPoolExecutor(max_workers=processes,
+                                 mp_context=_worker_context(),
+                                 initializer=_init_csv_worker,
+                                 initargs=(self,)) as executor:
+            yield from ordered_map(executor, _map_csv_range,
+                                   ((start, end, quarantine, hash_rows) for start, end in ranges), 2 * processes)
+
+    def _map_range(self, start, end, quarantine = False, hash_rows = False):
+        # Runs inside a worker process, returns the row count, (mapping index, mapped row,
+        # source row, error) tuples in file order and, with hash_rows, the row hashes.
+        # The source row and mapping errors are only kept when quarantining. Raises a
+        # _RangeBoundaryError when the range does not end on a record boundary.
+        with contextlib.ExitStack() as stack:
+            csvfile = stack.enter_context(open(self.csv_path, 'rb'))
+            if self.__uses_mmap(report=False):
+                buf = stack.enter_context(mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ))
+                lines = csv_rdr = self.__mapped_reader(buf, start, end)
+            else:
+                csvfile.seek(start)
+                lines = _RangeLines(csvfile, end, self.__encoding())
+                csv_rdr = self.__reader(lines)
+            return self.__map_rows(_checked_records(csv_rdr, lines, start, end), quarantine, hash_rows)
+
+    def _split_requirement(self):
+        """Return what splitting the file in byte ranges lacks, or None when it can be split"""
+        if not self.__is_plain_file():
+            return 'an uncompressed csv file'
+        if self.escapechar is not None:
+            return 'no escapechar'
+        if not _is_ascii_compatible(self.__encoding(), self.delimiter, self.quotechar):
+            return 'an ascii compatible encoding'
+        return None
+
+    def _record_ranges(self, chunk_size, start = 0):
+        """Split the file in byte ranges from offset start, leaving out the headers at offset 0"""
+        quotechar = None if self.quoting == csv.QUOTE_NONE else self.quotechar
+        return _csv_record_ranges(self.csv_path, chunk_size, quotechar,
+                                  self.header_count if start == 0 else 0, start,
+                                  self.__encoding(), self.__reader)
+
+    def _map_chunks(self, quarantine = False, start = 0):
+        # Like _map_range for the source from byte offset start, which may be
+        # compressed when start is 0, yielding the results of chunks of rows
+        # so the mapped rows stay bounded in memory
+        mappers = [mapping.compile() for mapping in self.mappings]
+        with self.__rows(None, start) as csv_rdr:
+            if start == 0:
+                csv_rdr = itertools.islice(csv_rdr, self.header_count, None)
+            for rows in chunked(csv_rdr, _PIPELINE_CHUNK_ROWS):
+                yield self.__map_rows(rows, quarantine, False, mappers)
+
+    def __map_rows(self, csv_rdr, quarantine, hash_rows, mappers = None):
+        if mappers is None:
+            mappers = [mapping.compile() for mapping in self.mappings]
+        result = []
+        hashes = [] if hash_rows else None
+        row_count = 0
+        for row in csv_rdr:
+            row_count += 1
+            if hash_rows:
+                hashes.append(row_hash(row))
+            for mapping_index, mapper in enumerate(mappers):
+                if not quarantine:
+                    mapped = mapper(row)
+                    if mapped is not None:
+                        result.append((mapping_index, mapped, None, None))
+                    continue
                 try:
-                    topology = Topology(components=components, labels=labels)
-                    topology_obj = connection.create(topology)
-                    topology_obj.labels = labels
+                    mapped = mapper(row)
                 except Exception as e:
-                    raise LoaderError(CSVLoader, "Failed to create topology: '{0}'".format(top_map_key))
+                    result.append((mapping_index, None, row, describe_error(e)))
+                    continue
+                if mapped is not None:
+                    result.append((mapping_index, mapped, row, None))
+        return (row_count, result, hashes)
 
-            try:
-                connection.link_actiontopology(action_obj, topology_obj)
-            except Exception as e:
-                print("Failed to link action and topology.")
+    @contextlib.contextmanager
+    def __rows(self, metrics: LoaderMetrics = None, start = 0):
+        # Yields an iterator over the records of the source from byte offset
+        # start, which includes the headers when start is 0
+        if not self.__uses_mmap():
+            with _open_source(self.csv_path, self.encoding, metrics, start, newline='') as csvfile:
+                yield self.__reader(csvfile)
+            return
 
-            topology_map[top_map_key] = topology_obj
+        with open(self.csv_path, 'rb') as csvfile:
+            size = os.fstat(csvfile.fileno()).st_size
+            if metrics is not None:
+                metrics.total_bytes = size
+            if size == 0:
+                yield iter(())
+                return
+            with mmap.mmap(csvfile.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                csv_rdr = self.__mapped_reader(buf, start, size)
+                if metrics is not None:
+                    metrics.position = csv_rdr.tell
+                yield csv_rdr
 
-        inst = Instance(action_id=action_obj.id, topology_id=topology_obj.id, data=data)
-        loadlist.append(inst)
-        return True
+    def __mapped_reader(self, buf, start, end):
+        quotechar = None if self.quoting == csv.QUOTE_NONE else self.quotechar
+        return _MappedCSVReader(buf, start, end, _referenced_columns(self.mappings),
+                                self.__encoding(), self.delimiter, quotechar,
+                                self.skipinitialspace, self.__reader)
+
+    def __uses_mmap(self, report = True):
+        if self.backend != 'mmap':
+            return False
+        reason = None
+        if not self.__is_plain_file():
+            reason = 'an uncompressed csv file'
+        elif self.escapechar is not None or self.quoting == csv.QUOTE_NONNUMERIC:
+            reason = 'no escapechar and no QUOTE_NONNUMERIC quoting'
+        elif not _is_ascii_compatible(self.__encoding(), self.delimiter, self.quotechar):
+            reason = 'an ascii compatible encoding'
+        if reason is not None and report:
+            print('The mmap backend requires {0}, using the csv backend'.format(reason))
+        return reason is None
+
+    def __encoding(self):
+        return self.encoding if self.encoding is not None else locale.getpreferredencoding(False)
+
+    def __is_plain_file(self):
+        return (isinstance(self.csv_path, (str, os.PathLike)) and self.csv_path != '-'
+                and _compression_from_path(self.csv_path) is None)
+
+    def __reader(self, csvfile):
+        return csv.reader(csvfile,
+                          delimiter=self.delimiter,
+                          doublequote=self.doublequote,
+                          escapechar=self.escapechar,
+                          lineterminator=self.lineterminator,
+                          quotechar=self.quotechar,
+                          quoting=self.quoting,
+                          skipinitialspace=self.skipinitialspace,
+                          strict=self.strict)
+
+
+
+def _text(value):
+    # Row values are strings for csv files, typed values from a database
+    if value.__class__ is str:
+        return value
+    return '' if value is None else str(value)
+
+_COMPILABLE_FETCHES = (
+    CSVAbstractElement.fetch_from_row,
+    CSVRowElement.fetch_from_row,
+    CSVStringCombinationElement.fetch_from_row
+)
 
+def _referenced_columns(mappings):
+    # The sorted columns any of the mappings reads, or None when a custom
+    # element class may read any column
+    columns = set()
+    for mapping in mappings:
+        for element in itertools.chain(mapping.elements, mapping.fallback):
+            if type(element).fetch_from_row not in _COMPILABLE_FETCHES:
+                return None
+            columns.update(element._columns())
+    return tuple(sorted(columns))
 
+def _is_ascii_compatible(encoding, *chars):
+    # Whether records and fields can be split on the raw bytes
+    try:
+        return all(c is None or c.encode(encoding) == c.encode('ascii') for c in chars + ('\n', '\r'))
+    except (UnicodeError, LookupError):
+        return False
 
-    def __push_batch(self, connection: DynizerConnection,
-                           batch: Sequence[Instance]):
-        if connection is not None:
-            print("Writing batch ...")
+
+
+class _MappedCSVReader:
+    # Reads the csv records between start and end of a byte buffer such as an
+    # mmap. Records are split on the raw bytes and only the referenced columns
+    # are decoded; the other fields of a row are None. Records containing the
+    # quote character are handed to the regular csv reader, which pulls lines
+    # from the buffer until it ends the record, so a quote that does not
+    # start a field is read literally as with the csv backend.
+    def __init__(self, buf, start, end, columns, encoding, delimiter, quotechar,
+                       skipinitialspace, reader):
+        self.buf = buf
+        self.pos = start
+        self.end = end
+        self.columns = columns
+        self.column_set = frozenset(columns) if columns is not None else None
+        self.encoding = encoding
+        self.delimiter = delimiter.encode(encoding)
+        self.quote = quotechar.encode(encoding) if quotechar is not None else None
+        self.skipinitialspace = skipinitialspace
+        self.quoted_reader = reader(iter(self.__next_line, None))
+        # Set once the csv reader asked for a line past end
+        self.exhausted = False
+
+    def tell(self):
+        return self.pos
+
+    def __iter__(self):
+        buf = self.buf
+        end = self.end
+        find = buf.find
+        quote = self.quote
+        delimiter = self.delimiter
+        decode = self.__decode
+        pos = self.pos
+        while pos < end:
+            line_end = find(b'\n', pos, end)
+            line_end = end if line_end < 0 else line_end + 1
+            record = buf[pos:line_end]
+            if quote is not None and quote in record:
+                self.pos = pos
+                row = next(self.quoted_reader, [])
+                pos = self.pos
+                if self.column_set is not None:
+                    row = [value if index in self.column_set else None for index, value in enumerate(row)]
+                yield row
+                continue
+
+            pos = self.pos = line_end
+            record = record.rstrip(b'\r\n')
+            if len(record) == 0:
+                yield []
+            else:
+                yield decode(record.split(delimiter))
+
+    def __decode(self, fields):
+        encoding = self.encoding
+        if self.columns is None:
+            if self.skipinitialspace:
+                return [field.lstrip(b' ').decode(encoding) for field in fields]
+            return [field.decode(encoding) for field in fields]
+        row = [None] * len(fields)
+        for index in self.columns:
+            if index >= len(fields):
+                break
+            field = fields[index]
+            if self.skipinitialspace:
+                field = field.lstrip(b' ')
+            row[index] = field.decode(encoding)
+        return row
+
+    def __next_line(self):
+        # Line source of the csv reader for quoted records, None at the end
+        if self.pos >= self.end:
+            self.exhausted = True
+            return None
+        line_end = self.buf.find(b'\n', self.pos, self.end)
+        line_end = self.end if line_end < 0 else line_end + 1
+        line = self.buf[self.pos:line_end]
+        self.pos = line_end
+        return line.decode(self.encoding)
+
+_OPENERS = {
+    'gzip': gzip.open,
+    'bz2': bz2.open,
+    'xz': lzma.open
+}
+
+def _compression_from_path(path):
+    path = os.fspath(path).lower()
+    if path.endswith('.gz') or path.endswith('.gzip'):
+        return 'gzip'
+    if path.endswith('.bz2'):
+        return 'bz2'
+    if path.endswith('.xz') or path.endswith('.lzma'):
+        return 'xz'
+    return None
+
+def _compression_from_magic(header):
+    if header.startswith(b'\x1f\x8b'):
+        return 'gzip'
+    if header.startswith(b'BZh'):
+        return 'bz2'
+    if header.startswith(b'\xfd7zXZ\x00'):
+        return 'xz'
+    return None
+
+@contextlib.contextmanager
+def _open_source(source, encoding, metrics: LoaderMetrics = None, start = 0, newline = None):
+    # Yields an iterable of text for any supported kind of source: a path
+    # (compressed by its extension, a plain file can be read from byte offset
+    # start), '-' for stdin, a text or binary stream (compression sniffed from
+    # its first bytes) or an iterable of lines
+    if isinstance(source, (str, os.PathLike)) and source != '-':
+        with open(source, 'rb') as raw:
+            raw.seek(start)
+            if metrics is not None:
+                # Progress follows the (compressed) bytes read from disk
+                metrics.position = raw.tell
+                metrics.total_bytes = os.path.getsize(source)
+            compression = _compression_from_path(source)
+            if compression is not None:
+                textfile = _OPENERS[compression](raw, 'rt', newline=newline, encoding=encoding)
+            else:
+                textfile = io.TextIOWrapper(raw, encoding=encoding, newline=newline)
+            with textfile:
+                try:
+                    yield textfile
+                finally:
+                    if metrics is not None:
+                        offset = raw.tell()
+                        metrics.position = lambda: offset
+    elif source == '-' or hasattr(source, 'read'):
+        stream = sys.stdin.buffer if source == '-' else source
+        if isinstance(stream, io.TextIOBase):
+            yield stream
+            return
+        # Binary stream: sniff compression and decode, but leave the
+        # underlying stream open for its owner
+        compression = None
+        if hasattr(stream, 'peek'):
+            compression = _compression_from_magic(stream.peek(8))
+        if compression is not None:
+            with _OPENERS[compression](stream, 'rt', newline=newline, encoding=encoding) as textfile:
+                yield textfile
+        else:
+            textfile = io.TextIOWrapper(stream, encoding=encoding, newline=newline)
             try:
-                connection.batch_create(batch)
-                batch.clear()
-            except Exception as e:
-                raise LoaderError(CSVLoader, "Failed to push batch of instances")
+                yield textfile
+            finally:
+                textfile.detach()
+    else:
+        yield iter(source)
+
+
+
+_BLOCK_SIZE = 1024 * 1024
+_PIPELINE_CHUNK_ROWS = 1000
+
+def _csv_record_ranges(path, chunk_size, quotechar='"', skip_records=0, start=0,
+                       encoding='ascii', reader=csv.reader):
+    """
+    Split a csv file in (start, end) byte ranges of about chunk_size bytes
+
+    Every range is meant to end on a record boundary: a line break that is not
+    inside a quoted field. Rather than reading the whole file to follow the
+    quote state, the splitter seeks to every chunk_size offset and takes the
+    first line break after it outside the quoted fields that open from there
+    on. That is wrong when the offset itself lies inside a quoted field that
+    spans lines, or for an escapechar or a quote inside an unquoted field, so
+    the workers verify the boundaries with _checked_records and the ranges
+    from the first bad one on are loaded in order. The encoding must be ascii
+    compatible. The ranges begin at the record boundary start; the first
+    skip_records records from there (headers) are read with reader, a csv
+    reader factory, and left out.
+    """
+    size = os.path.getsize(path)
+    quote = quotechar.encode(encoding) if quotechar else None
+    ranges = []
+    with open(path, 'rb') as csvfile:
+        if skip_records > 0:
+            csvfile.seek(start)
+            lines = _RangeLines(csvfile, size, encoding)
+            headers = reader(lines)
+            for i in range(skip_records):
+                next(headers, None)
+            start = lines.pos
+
+        while start < size:
+            target = start + chunk_size
+            if target >= size:
+                ranges.append((start, size))
+                break
+            end = _next_record_end(csvfile, target, quote, size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+class _RangeBoundaryError(Exception):
+    # A byte range that does not end on a record boundary
+    def __init__(self, start, end):
+        super().__init__('The csv range {0}-{1} does not end on a record boundary'.format(start, end))
+        self.start = start
+        self.end = end
+
+    def __reduce__(self):
+        return (_RangeBoundaryError, (self.start, self.end))
+
+class _RangeLines:
+    # The text lines of a binary file from its position up to byte offset
+    # end, as the input of a csv reader. pos is the offset of the next line,
+    # exhausted is set once the reader asked for a line past end.
+    def __init__(self, csvfile, end, encoding):
+        self.csvfile = csvfile
+        self.pos = csvfile.tell()
+        self.end = end
+        self.encoding = encoding
+        self.exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.csvfile.readline(self.end - self.pos) if self.pos < self.end else b''
+        if len(line) == 0:
+            self.exhausted = True
+            raise StopIteration
+        self.pos += len(line)
+        return line.decode(self.encoding)
+
+def _checked_records(csv_rdr, lines, start, end):
+    # A record that is returned after its lines ran out was cut off by the
+    # end of the range in a quoted field
+    for row in csv_rdr:
+        if lines.exhausted:
+            raise _RangeBoundaryError(start, end)
+        yield row
+
+def _next_record_end(csvfile, pos, quote, size):
+    # Offset just past the first line break at or after pos outside the quoted
+    # fields that open after pos
+    in_quotes = False
+    csvfile.seek(pos)
+    while True:
+        block = csvfile.read(_BLOCK_SIZE)
+        if not block:
+            return size
+        i = 0
+        while True:
+            nl = block.find(b'\n', i)
+            if nl == -1:
+                if quote is not None and block.count(quote, i) % 2 == 1:
+                    in_quotes = not in_quotes
+                pos += len(block)
+                break
+            if quote is not None and block.count(quote, i, nl) % 2 == 1:
+                in_quotes = not in_quotes
+            i = nl + 1
+            if not in_quotes:
+                return pos + i
+
+def _worker_context():
+    # Forked workers inherit the mappings, so transform functions such as
+    # lambdas do not need to be picklable
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+_worker_loader = None
+
+def _init_csv_worker(loader):
+    global _worker_loader
+    _worker_loader = loader
+
+def _map_csv_range(start, end, quarantine, hash_rows):
+    return _worker_loader._map_range(start, end, quarantine, hash_rows)
 
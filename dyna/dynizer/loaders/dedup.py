@@ -0,0 +1,132 @@
+import hashlib
+import math
+import os
+import sqlite3
+import tempfile
+
+class Deduplicator:
+    """
+    Base class of the instance deduplicators
+
+    A loader run with a deduplicator drops every instance whose fingerprint
+    (action, topology and data values) was seen before in the same run.
+
+    Member Functions
+    ----------------
+    seen
+        Return whether a fingerprint was seen before and remember it
+
+    close
+        Release the resources of the deduplicator
+    """
+    def seen(self, fingerprint: bytes):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+
+class FingerprintSet(Deduplicator):
+    """
+    Exact deduplication with a bounded in memory set
+
+    At most max_entries fingerprints are kept in memory. When the set is full
+    and spill is enabled, its fingerprints are moved to a temporary sqlite
+    file in spill_dir, so duplicates are still found exactly at the cost of a
+    disk lookup for every new instance. Without spill, the full set replaces
+    the previous one, so only duplicates among the last max_entries to
+    2 * max_entries distinct instances are dropped.
+    """
+    def __init__(self, max_entries = 1000000, spill = False, spill_dir = None):
+        self.max_entries = max_entries
+        self.spill = spill
+        self.spill_dir = spill_dir
+        self.current = set()
+        self.previous = set()
+        self.db = None
+        self.db_path = None
+
+    def seen(self, fingerprint: bytes):
+        if fingerprint in self.current or fingerprint in self.previous:
+            return True
+        if self.db is not None and self.db.execute('SELECT 1 FROM fingerprints WHERE fp = ?',
+                                                   (fingerprint,)).fetchone() is not None:
+            return True
+        self.current.add(fingerprint)
+        if len(self.current) >= self.max_entries:
+            self.__rotate()
+        return False
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            os.remove(self.db_path)
+            self.db = None
+
+    def __rotate(self):
+        if not self.spill:
+            self.previous = self.current
+            self.current = set()
+            return
+        if self.db is None:
+            fd, self.db_path = tempfile.mkstemp(suffix='.sqlite', dir=self.spill_dir)
+            os.close(fd)
+            self.db = sqlite3.connect(self.db_path)
+            self.db.execute('CREATE TABLE fingerprints (fp BLOB PRIMARY KEY) WITHOUT ROWID')
+        self.db.executemany('INSERT OR IGNORE INTO fingerprints VALUES (?)',
+                            ((fp,) for fp in self.current))
+        self.db.commit()
+        self.current = set()
+
+
+
+class BloomFilter(Deduplicator):
+    """
+    Approximate deduplication in constant memory
+
+    Sized for capacity distinct instances with a false positive rate of
+    error_rate, e.g. about 1.8 bytes per instance for a rate of 0.001. A false
+    positive drops a unique instance, so only use it where losing that
+    fraction is acceptable.
+    """
+    def __init__(self, capacity = 10000000, error_rate = 0.001):
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def seen(self, fingerprint: bytes):
+        # Double hashing on the two halves of the fingerprint
+        h1 = int.from_bytes(fingerprint[:8], 'little')
+        h2 = int.from_bytes(fingerprint[8:16], 'little') | 1
+        bits = self.bits
+        found = True
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % self.size
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                found = False
+                bits[position >> 3] |= mask
+        return found
+
+
+
+def instance_fingerprint(action, key, data):
+    """Return a 16 byte fingerprint of an instance of action with topology key and data"""
+    values = tuple((e.dataelement.value, e.dataelement.datatype) for e in data)
+    text = repr((action.name, action.actiontype, key, values))
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+def make_deduplicator(dedup):
+    """
+    Return the Deduplicator for the dedup argument of a loader: True for a
+    default FingerprintSet, a number for a FingerprintSet of that size or a
+    Deduplicator. None and False disable deduplication.
+    """
+    if dedup is None or dedup is False:
+        return None
+    if dedup is True:
+        return FingerprintSet()
+    if isinstance(dedup, Deduplicator):
+        return dedup
+    return FingerprintSet(max_entries=int(dedup))
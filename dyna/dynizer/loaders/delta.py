@@ -0,0 +1,182 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+_HASH_BLOCK_SIZE = 1 << 20
+_INSERT_BATCH = 10000
+
+class DeltaState:
+    """
+    Persistent state for incremental (delta) loading of csv files
+
+    For every source file the state keeps a fingerprint of its contents (size
+    and a hash) and the content hashes of its rows, stored in a sqlite database
+    at path. A loader run with a DeltaState only loads what changed since the
+    last successful run on the same file:
+
+    - an unchanged file is skipped
+    - when the previous contents are a prefix of the file, reading starts at
+      the old end of the file, so only the appended rows are parsed
+    - otherwise the rows are hashed in a first pass and only the rows whose
+      hash is not known yet are loaded
+
+    Rows that disappeared from the file are not removed from the Dynizer. The
+    state is only updated when the load succeeds. Source files must not be
+    written to while they are loaded.
+
+    Member Functions
+    ----------------
+    begin
+        Compare a file with the previous run and return its DeltaRun
+
+    close
+        Close the underlying database
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files '
+                        '(source TEXT PRIMARY KEY, size INTEGER, hash BLOB)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS rows '
+                        '(source TEXT, hash BLOB, PRIMARY KEY (source, hash)) WITHOUT ROWID')
+        self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def begin(self, path, appendable = True):
+        """
+        Return the DeltaRun of a load of the file at path. Appended rows are
+        only detected by offset when appendable is set, which requires an
+        uncompressed file.
+        """
+        source = os.path.abspath(path)
+        previous = self.db.execute('SELECT size, hash FROM files WHERE source = ?', (source,)).fetchone()
+        size = os.path.getsize(path)
+
+        # One pass over the bytes yields both the hash of the previous extent
+        # and the hash of the current contents
+        digest = hashlib.blake2b(digest_size=16)
+        prefix_hash = None
+        with open(path, 'rb') as f:
+            pos = 0
+            while pos < size:
+                limit = size - pos
+                if previous is not None and pos < previous[0]:
+                    limit = min(limit, previous[0] - pos)
+                block = f.read(min(_HASH_BLOCK_SIZE, limit))
+                if len(block) == 0:
+                    break
+                digest.update(block)
+                pos += len(block)
+                if previous is not None and pos == previous[0]:
+                    prefix_hash = digest.copy().digest()
+        file_hash = digest.digest()
+
+        if previous is None:
+            mode, start = DeltaRun.FULL, 0
+        elif previous[0] == size and previous[1] == file_hash:
+            mode, start = DeltaRun.UNCHANGED, size
+        elif appendable and previous[0] < size and previous[1] == prefix_hash:
+            mode, start = DeltaRun.APPEND, previous[0]
+        else:
+            mode, start = DeltaRun.CHANGED, 0
+        return DeltaRun(self, source, mode, start, size, file_hash)
+
+
+
+class DeltaRun:
+    """
+    The delta of one load of a file
+
+    mode is one of FULL (first load), UNCHANGED, APPEND or CHANGED. Rows are
+    read from byte offset start; when start is not 0 the header rows have
+    already been passed. In CHANGED mode collect() must see every data row of
+    the file before filter() is used.
+    """
+    FULL = 'full'
+    UNCHANGED = 'unchanged'
+    APPEND = 'append'
+    CHANGED = 'changed'
+
+    def __init__(self, state: DeltaState, source, mode, start, size, file_hash):
+        self.state = state
+        self.source = source
+        self.mode = mode
+        self.start = start
+        self.size = size
+        self.file_hash = file_hash
+        self.new_rows = None
+        self.pending = []
+        self.db = state.db
+        self.db.execute('CREATE TEMP TABLE IF NOT EXISTS pending (hash BLOB PRIMARY KEY) WITHOUT ROWID')
+        self.db.execute('DELETE FROM pending')
+
+    def collect(self, rows):
+        """Hash all data rows of a changed file and keep the hashes of the new ones"""
+        for row in rows:
+            self.__record(row_hash(row))
+        self.__flush()
+        self.new_rows = set(h for (h,) in self.db.execute(
+                'SELECT hash FROM pending WHERE hash NOT IN (SELECT hash FROM rows WHERE source = ?)',
+                (self.source,)))
+
+    def filter(self, rows):
+        """Yield the rows that have to be loaded"""
+        if self.mode == DeltaRun.UNCHANGED:
+            return
+        if self.new_rows is not None:
+            new_rows = self.new_rows
+            for row in rows:
+                if row_hash(row) in new_rows:
+                    yield row
+            return
+        for row in rows:
+            self.__record(row_hash(row))
+            yield row
+
+    def record_hashes(self, hashes):
+        """Remember the hashes of rows that were loaded outside of filter()"""
+        for h in hashes:
+            self.__record(h)
+
+    def commit(self):
+        """Store the file fingerprint and row hashes after a successful load"""
+        self.__flush()
+        with self.state.lock:
+            if self.mode == DeltaRun.CHANGED:
+                self.db.execute('DELETE FROM rows WHERE source = ?', (self.source,))
+            if self.mode != DeltaRun.UNCHANGED:
+                self.db.execute('INSERT OR IGNORE INTO rows SELECT ?, hash FROM pending', (self.source,))
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)',
+                            (self.source, self.size, self.file_hash))
+            self.db.execute('DELETE FROM pending')
+            self.db.commit()
+
+    def rollback(self):
+        self.pending = []
+        with self.state.lock:
+            self.db.rollback()
+            self.db.execute('DELETE FROM pending')
+            self.db.commit()
+
+    def __record(self, h):
+        self.pending.append((h,))
+        if len(self.pending) >= _INSERT_BATCH:
+            self.__flush()
+
+    def __flush(self):
+        if len(self.pending) > 0:
+            with self.state.lock:
+                self.db.executemany('INSERT OR IGNORE INTO pending VALUES (?)', self.pending)
+            self.pending = []
+
+
+
+def row_hash(row):
+    """Return the 16 byte content hash of a parsed csv row"""
+    return hashlib.blake2b(repr(row).encode('utf-8'), digest_size=16).digest()
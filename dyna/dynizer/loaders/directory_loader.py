@@ -0,0 +1,385 @@
+from ..connector import DynizerConnection
+from .engine import LoaderEngine, Sink, default_sink
+from .rejects import describe_error
+from .csv_loader import CSVMapping, CSVLoader, _RangeBoundaryError, _worker_context
+from .xml_loader import XMLMapping, XMLLoader
+from concurrent.futures import ProcessPoolExecutor
+from typing import Sequence
+import glob
+import itertools
+import os
+import queue
+
+class FileStatus:
+    """
+    Load status of a single file of a DirectoryLoader run
+
+    status is one of PENDING, LOADED, FAILED or SKIPPED (no mapping applies
+    to the file). rows counts the csv rows or xml entities that were mapped,
+    instances the instances that were loaded. error holds the description of
+    the error a failed file ran into.
+    """
+    PENDING = 'pending'
+    LOADED = 'loaded'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, path, kind, size):
+        self.path = path
+        self.kind = kind
+        self.size = size
+        self.status = FileStatus.PENDING
+        self.rows = 0
+        self.instances = 0
+        self.rejected = 0
+        self.error = None
+
+    def __repr__(self):
+        return 'FileStatus({0!r}, {1}, rows={2}, instances={3}, rejected={4}, error={5!r})'.format(
+                self.path, self.status, self.rows, self.instances, self.rejected, self.error)
+
+
+
+class DirectoryLoader:
+    """
+    Directory loader
+
+    Loads every file that matches one of the glob patterns ('**' matches
+    nested directories). Files ending in .xml are loaded with the XMLMappings
+    of mappings, all other files (plain or compressed) with the CSVMappings,
+    using csv_options as the keyword arguments of CSVLoader and namespaces
+    for the xml files.
+
+    Files are parsed and mapped in a process pool. The largest files are
+    handed out first and uncompressed csv files larger than chunk_size are
+    split in ranges, and an idle worker always takes the next pending file or
+    range, so a few large files do not keep the other workers waiting. Other
+    files larger than chunk_size (compressed csv files and xml documents) are
+    streamed by a worker, which sends their rows or entities back in chunks as
+    they are mapped, so they are never held in memory as a whole. Actions
+    and topologies are resolved through a single registry and the instances of
+    all files are uploaded through a single upload stage in the calling
+    process.
+
+    A file that fails does not stop the run: its error is recorded in its
+    FileStatus (see status after run) and the other files are still loaded.
+    Instances of the failed file that were mapped before the error may have
+    been loaded.
+    """
+    def __init__(self, patterns,
+                       mappings: Sequence = [],
+                       csv_options = None,
+                       namespaces = {}):
+        self.patterns = [patterns] if isinstance(patterns, (str, os.PathLike)) else list(patterns)
+        self.mappings = list(mappings)
+        self.csv_options = dict(csv_options) if csv_options is not None else {}
+        self.ns = namespaces
+        self.status = []
+
+    def add_mapping(self, mapping):
+        self.mappings.append(mapping)
+
+    def files(self):
+        """Return the sorted paths of the files matching the patterns"""
+        found = set()
+        for pattern in self.patterns:
+            for path in glob.glob(os.fspath(pattern), recursive=True):
+                if os.path.isfile(path):
+                    found.add(os.path.abspath(path))
+        return sorted(found)
+
+    def run(self, connection: DynizerConnection, debug=False,
+                  processes=None, chunk_size=64*1024*1024,
+                  pipeline=False, upload_workers=2, queue_size=8,
+                  registry=None, progress=None, rejects=None, dedup=None,
+                  sink: Sink = None):
+        """
+        Load all matching files into the Dynizer
+
+        processes is the size of the process pool, by default the number of
+        cpus; with 1 the files are mapped in the calling process. Worker
+        processes are forked, so on platforms without fork the mappings
+        (including transform functions) must be picklable.
+
+        pipeline, upload_workers, queue_size, registry, progress, rejects,
+        dedup and sink work as in CSVLoader.run and apply to the run as a
+        whole: the files share the sink, reject file and deduplicator. The
+        final snapshot is returned and the FileStatus of every file is kept in
+        status. With debug, the files are also reported as they are loaded or
+        fail.
+        """
+        if processes is None:
+            processes = os.cpu_count() or 1
+        mappings = {
+            'csv': [mapping for mapping in self.mappings if isinstance(mapping, CSVMapping)],
+            'xml': [mapping for mapping in self.mappings if isinstance(mapping, XMLMapping)]
+        }
+        self.status = [FileStatus(path, DirectoryLoader.__kind(path), os.path.getsize(path))
+                       for path in self.files()]
+        if debug:
+            print('Loading {0} files'.format(len(self.status)))
+
+        sink = default_sink(connection, sink, registry, upload_workers if pipeline else 0, queue_size)
+        engine = LoaderEngine(DirectoryLoader, sink, progress=progress, rejects=rejects, dedup=dedup, debug=debug)
+        return engine.run(lambda engine: self.__load(engine, mappings, processes, chunk_size))
+
+    def __load(self, engine: LoaderEngine, mappings, processes, chunk_size):
+        metrics = engine.metrics
+        states = {}
+        for kind in mappings:
+            states[kind] = [engine.bind(mapping) for mapping in mappings[kind]]
+
+        loaders, tasks = self.__plan(mappings, chunk_size)
+        done = [0]
+        metrics.position = lambda: done[0]
+        metrics.total_bytes = sum(status.size for status in self.status)
+
+        remaining = {}
+        for file_index, start, end in tasks:
+            remaining[file_index] = remaining.get(file_index, 0) + 1
+        # The ranges of a split file are applied in file order: next_start is
+        # the start of the next range to apply, held keeps the ranges that
+        # were mapped ahead of it
+        next_start = {}
+        for file_index, start, end in reversed(tasks):
+            if start is not None:
+                next_start[file_index] = start
+        held = {}
+        quarantine = engine.rejects is not None
+        for task, result, error, last in metrics.timed_iter(
+                self.__map_tasks(loaders, tasks, processes, quarantine), 'parse'):
+            file_index, start, end = task
+            status = self.status[file_index]
+            if last:
+                done[0] += (end - start) if start is not None else status.size
+                remaining[file_index] -= 1
+            if start is None:
+                self.__apply(engine, states, status, result, error)
+            else:
+                held[(file_index, start)] = (end, result, error)
+                while file_index in next_start and (file_index, next_start[file_index]) in held:
+                    start = next_start[file_index]
+                    end, result, error = held.pop((file_index, start))
+                    next_start[file_index] = end
+                    if isinstance(error, _RangeBoundaryError):
+                        # The ranges before it were verified, so the range starts
+                        # on a record boundary; the rest of the file is streamed
+                        if engine.debug:
+                            print('{0}, loading the rest of {1} in order'.format(error, status.path))
+                        del next_start[file_index]
+                        for key in [key for key in held if key[0] == file_index]:
+                            del held[key]
+                        self.__stream(engine, states, status, loaders[file_index]._map_chunks(quarantine, start))
+                    else:
+                        self.__apply(engine, states, status, result, error)
+            metrics.report()
+            if remaining[file_index] == 0:
+                self.__loaded(engine, status)
+
+    def __stream(self, engine: LoaderEngine, states, status: FileStatus, chunks):
+        # Loads the chunk results of a file as they are mapped
+        try:
+            for chunk in chunks:
+                self.__apply(engine, states, status, [chunk], None)
+                engine.metrics.report()
+        except Exception as e:
+            self.__apply(engine, states, status, None, e)
+
+    def __loaded(self, engine: LoaderEngine, status: FileStatus):
+        if status.status == FileStatus.PENDING:
+            status.status = FileStatus.LOADED
+            if engine.debug:
+                print('Loaded {0}: {1} rows, {2} instances'.format(status.path, status.rows, status.instances))
+
+    def __apply(self, engine: LoaderEngine, states, status: FileStatus, chunks, error):
+        # Loads the mapped rows of the chunks of a task of the file, or records its error
+        if status.status == FileStatus.FAILED:
+            return
+        if error is not None:
+            status.status = FileStatus.FAILED
+            status.error = describe_error(error)
+            if engine.debug:
+                print('Failed to load {0}: {1}'.format(status.path, status.error))
+            return
+        for chunk in chunks:
+            self.__apply_chunk(engine, states, status, chunk)
+
+    def __apply_chunk(self, engine: LoaderEngine, states, status: FileStatus, chunk):
+        row_count, mapped_rows, hashes = chunk
+        status.rows += row_count
+        engine.metrics.row(row_count)
+        for mapping_index, mapped, source, mapping_error in mapped_rows:
+            state = states[status.kind][mapping_index]
+            if mapping_error is None:
+                if engine.load(state, mapped, source=source):
+                    status.instances += 1
+            else:
+                engine.reject(state, source, mapping_error)
+                status.rejected += 1
+
+    def __plan(self, mappings, chunk_size):
+        # Returns the loader of every file and the (file index, start, end)
+        # tasks, largest files first. start is None for a task that covers a
+        # whole file, end is then None or _STREAMED for a file that is streamed
+        # in chunks.
+        loaders = []
+        tasks = []
+        for file_index, status in enumerate(self.status):
+            kind_mappings = mappings[status.kind]
+            if len(kind_mappings) == 0:
+                status.status = FileStatus.SKIPPED
+                loaders.append(None)
+                continue
+            if status.kind == 'xml':
+                loaders.append(XMLLoader.stream(status.path, kind_mappings, self.ns))
+            else:
+                loaders.append(CSVLoader(status.path, kind_mappings, **self.csv_options))
+
+        order = sorted((i for i, loader in enumerate(loaders) if loader is not None),
+                       key=lambda i: -self.status[i].size)
+        for file_index in order:
+            loader = loaders[file_index]
+            status = self.status[file_index]
+            if status.size > chunk_size and isinstance(loader, CSVLoader) and loader._split_requirement() is None:
+                ranges = loader._record_ranges(chunk_size)
+                tasks.extend((file_index, start, end) for start, end in ranges)
+                if len(ranges) == 0:
+                    tasks.append((file_index, 0, 0))
+            elif status.size > chunk_size:
+                tasks.append((file_index, None, _STREAMED))
+            else:
+                tasks.append((file_index, None, None))
+        return loaders, tasks
+
+    def __map_tasks(self, loaders, tasks, processes, quarantine):
+        # Yields (task, chunks, error, last) in completion order: the chunk
+        # results of a task or its error, and whether the task is complete.
+        # Streamed files yield their chunks as the worker sends them. Tasks
+        # are handed to the pool one at a time as workers finish, with at most
+        # 2 * processes in flight and 2 * processes streamed chunks waiting,
+        # so workers pick up pending work as soon as they are idle and mapped
+        # results do not pile up in memory.
+        if processes <= 1:
+            _init_directory_worker(loaders)
+            for task in tasks:
+                if task[2] == _STREAMED:
+                    yield from self.__stream_file(loaders, task, quarantine)
+                    continue
+                try:
+                    yield task, _map_directory_task(task[0], task[1], task[2], quarantine), None, True
+                except Exception as e:
+                    yield task, None, e, True
+            return
+
+        pending = {}
+        streams = set()
+        tasks = iter(tasks)
+        context = _worker_context()
+        chunks = context.Queue(2 * processes)
+        stop = context.Event()
+        with ProcessPoolExecutor(max_workers=processes,
+                                 mp_context=context,
+                                 initializer=_init_directory_worker,
+                                 initargs=(loaders, chunks, stop)) as executor:
+            def submit(task):
+                pending[executor.submit(_map_directory_task, task[0], task[1], task[2], quarantine)] = task
+                if task[2] == _STREAMED:
+                    streams.add(task[0])
+
+            try:
+                for task in itertools.islice(tasks, 2 * processes):
+                    submit(task)
+                while len(pending) > 0 or len(streams) > 0:
+                    try:
+                        file_index, chunk, error = chunks.get(timeout=0.05)
+                    except queue.Empty:
+                        pass
+                    else:
+                        task = (file_index, None, _STREAMED)
+                        if chunk is not None:
+                            yield task, [chunk], None, False
+                        else:
+                            # The end of the file, or the error it ran into
+                            streams.discard(file_index)
+                            yield task, [], error, True
+
+                    for future in [future for future in pending if future.done()]:
+                        task = pending.pop(future)
+                        for next_task in itertools.islice(tasks, 1):
+                            submit(next_task)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            if task[2] != _STREAMED or task[0] in streams:
+                                streams.discard(task[0])
+                                yield task, None, e, True
+                            continue
+                        if task[2] != _STREAMED:
+                            yield task, result, None, True
+            finally:
+                stop.set()
+                for future in pending:
+                    future.cancel()
+
+    def __stream_file(self, loaders, task, quarantine):
+        # Streams a file in the calling process, in the shape of __map_tasks
+        try:
+            for chunk in loaders[task[0]]._map_chunks(quarantine):
+                yield task, [chunk], None, False
+        except Exception as e:
+            yield task, None, e, True
+            return
+        yield task, [], None, True
+
+    @staticmethod
+    def __kind(path):
+        return 'xml' if path.lower().endswith('.xml') else 'csv'
+
+
+
+_STREAMED = 'streamed'
+
+_worker_loaders = None
+_worker_chunks = None
+_worker_stop = None
+
+def _init_directory_worker(loaders, chunks = None, stop = None):
+    global _worker_loaders, _worker_chunks, _worker_stop
+    _worker_loaders = loaders
+    _worker_chunks = chunks
+    _worker_stop = stop
+    if chunks is not None:
+        # Chunks left in the queue of an aborted run must not keep the worker from exiting
+        chunks.cancel_join_thread()
+
+def _map_directory_task(file_index, start, end, quarantine):
+    # Returns the chunk results of the task. Whole file tasks only cover files
+    # up to chunk_size, larger ones are streamed through the chunk queue.
+    loader = _worker_loaders[file_index]
+    if end == _STREAMED:
+        return _stream_directory_file(loader, file_index, quarantine)
+    if start is None:
+        return list(loader._map_chunks(quarantine))
+    return [loader._map_range(start, end, quarantine)]
+
+def _stream_directory_file(loader, file_index, quarantine):
+    # Sends the chunk results of the file as they are mapped, followed by a
+    # (file index, None, error) entry that ends the file
+    error = None
+    try:
+        for chunk in loader._map_chunks(quarantine):
+            if not _put_chunk((file_index, chunk, None)):
+                return
+    except Exception as e:
+        error = describe_error(e)
+    _put_chunk((file_index, None, error))
+
+def _put_chunk(item):
+    # Blocking put that gives up once the run is stopped
+    while not _worker_stop.is_set():
+        try:
+            _worker_chunks.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
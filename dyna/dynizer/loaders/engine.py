@@ -0,0 +1,453 @@
+from ..types import Action, ComponentType, Instance, InstanceElement
+from ..connector import DynizerConnection
+from ...common.errors import LoaderError
+from .pipeline import BatchUploader
+from .metrics import LoaderMetrics
+from .dedup import instance_fingerprint, make_deduplicator
+from .registry import TopologyRegistry
+from .rejects import RejectFile
+import json
+import threading
+
+class Sink:
+    """
+    Destination of the instances of a loader run
+
+    The engine opens the sink when the run starts, binds every mapping to it
+    before the mapping is used and writes each mapped instance, a
+    (components, data, labels, topology key) tuple, with the handle its
+    mapping was bound to. close() is called after the last write of a
+    successful run, abort() when the run fails.
+
+    Member Functions
+    ----------------
+    open
+        Prepare the sink for a run of loader
+
+    bind
+        Return the handle instances of a mapping are written with
+
+    write
+        Take a mapped instance
+
+    prefetch
+        Resolve the topologies of mapped instances up front, when the sink
+        resolves topologies
+
+    flush
+        Write out the instances taken so far, keeping the sink open
+
+    close
+        Flush all instances and release the sink
+
+    abort
+        Release the sink without flushing
+
+    A sink that resolves topologies itself sets resolves_topologies, which
+    makes the loaders run their prescan for it.
+    """
+    resolves_topologies = False
+
+    def open(self, loader, metrics: LoaderMetrics, rejects: RejectFile = None):
+        pass
+
+    def bind(self, mapping):
+        return mapping
+
+    def write(self, handle, mapped, source = None):
+        raise NotImplementedError()
+
+    def prefetch(self, requests, workers = 4):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+
+class ConnectorSink(Sink):
+    """
+    Loads the instances into the Dynizer
+
+    Actions and topologies are resolved through registry, a TopologyRegistry
+    that can be shared between runs, or a fresh in memory one. Instances are
+    collected in batches of the batch_size of their mapping, which are
+    uploaded inline or, with workers, by that many upload threads on their
+    own connections. At most queue_size batches wait for upload.
+    """
+    resolves_topologies = True
+
+    def __init__(self, connection: DynizerConnection,
+                       registry: TopologyRegistry = None,
+                       workers = 0,
+                       queue_size = 8):
+        self.connection = connection
+        self.registry = registry
+        self.workers = workers
+        self.queue_size = queue_size
+        self.uploader = None
+        self.targets = []
+
+    def open(self, loader, metrics: LoaderMetrics, rejects: RejectFile = None):
+        self.loader = loader
+        self.metrics = metrics
+        self.rejects = rejects
+        self.targets = []
+        if self.registry is None:
+            self.registry = TopologyRegistry()
+        self.connection.connect()
+        self.uploader = BatchUploader(self.connection, loader,
+                                      workers=self.workers,
+                                      queue_size=self.queue_size,
+                                      metrics=metrics,
+                                      rejects=rejects)
+
+    def bind(self, mapping):
+        try:
+            action_obj = self.registry.resolve_action(self.connection, mapping.action)
+        except Exception as e:
+            raise LoaderError(self.loader, "Failed to create required action: '{0}'".format(mapping.action.name))
+        target = _ConnectorTarget(mapping, action_obj,
+                                  self.registry.for_action(self.connection, action_obj, self.metrics),
+                                  self.rejects is not None)
+        self.targets.append(target)
+        return target
+
+    def write(self, target, mapped, source = None):
+        components, data, labels, top_map_key = mapped
+        try:
+            # Creates the topology and links it to the action on first sight
+            topology_obj = target.topology_map.resolve(top_map_key, components, labels)
+        except Exception as e:
+            raise LoaderError(self.loader, "Failed to create topology: '{0}'".format(top_map_key))
+
+        target.loadlist.append(Instance(action_id=target.action_obj.id, topology_id=topology_obj.id, data=data))
+        if target.sources is not None:
+            target.sources.append(source)
+        if len(target.loadlist) >= target.mapping.batch_size:
+            self.__push_batch(target)
+
+    def prefetch(self, requests, workers = 4):
+        # requests holds (target, topology key, components, labels) tuples
+        self.registry.prefetch(self.connection, [(target.topology_map, key, components, labels)
+                                                 for target, key, components, labels in requests], workers)
+
+    def flush(self):
+        for target in self.targets:
+            if len(target.loadlist) > 0:
+                self.__push_batch(target)
+        self.uploader.drain()
+
+    def close(self):
+        for target in self.targets:
+            if len(target.loadlist) > 0:
+                self.__push_batch(target)
+        self.uploader.close()
+        self.connection.close()
+
+    def abort(self):
+        if self.uploader is not None:
+            self.uploader.abort()
+        self.connection.close()
+
+    def __push_batch(self, target):
+        self.uploader.submit(target.loadlist, target.sources)
+        target.loadlist = []
+        if target.sources is not None:
+            target.sources = []
+
+
+
+class SpoolSink(Sink):
+    """
+    Writes the instances to a spool file instead of the Dynizer
+
+    Every instance becomes a line of json with its action, topology key,
+    components, labels and data. The target is a path, opened for appending and closed at
+    the end of the run, or an open text stream. replay() loads a spool file
+    into another sink later on, e.g. a ConnectorSink when the Dynizer is
+    reachable again.
+    """
+    def __init__(self, target):
+        self.target = target
+        self.stream = None
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def open(self, loader, metrics: LoaderMetrics, rejects: RejectFile = None):
+        self.stream = open(self.target, 'a', encoding='utf-8') if isinstance(self.target, str) else self.target
+
+    def bind(self, mapping):
+        return json.dumps(mapping.action.to_dict())
+
+    def write(self, action_json, mapped, source = None):
+        components, data, labels, top_map_key = mapped
+        line = '{{"action": {0}, "key": {1}, "components": {2}, "labels": {3}, "data": {4}}}\n'.format(
+                action_json, json.dumps(top_map_key), json.dumps([component.name for component in components]),
+                json.dumps(list(labels)), json.dumps([element.to_dict() for element in data]))
+        with self.lock:
+            self.stream.write(line)
+            self.count += 1
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    def close(self):
+        if self.stream is not self.target:
+            self.stream.close()
+        else:
+            self.stream.flush()
+
+    def abort(self):
+        self.close()
+
+    @staticmethod
+    def replay(path: str, sink: Sink, batch_size = 100, progress = None, rejects = None):
+        """
+        Write the instances of the spool file at path to sink in batches of
+        batch_size instances per action. Returns the final snapshot.
+        """
+        engine = LoaderEngine(SpoolSink, sink, progress=progress, rejects=rejects)
+        bound = {}
+
+        def load(engine):
+            with open(path, encoding='utf-8') as spool:
+                for line in engine.metrics.timed_iter(spool, 'parse'):
+                    record = json.loads(line)
+                    engine.metrics.row()
+                    key = json.dumps(record['action'], sort_keys=True)
+                    mapping = bound.get(key)
+                    if mapping is None:
+                        mapping = bound[key] = engine.bind(_SpooledMapping(Action.from_dict(record['action']), batch_size))
+                    components = [ComponentType[name] for name in record['components']]
+                    data = [InstanceElement.from_dict(element) for element in record['data']]
+                    engine.load(mapping, (components, data, record['labels'], record['key']),
+                                source=line.rstrip('\n'))
+        return engine.run(load)
+
+
+
+class DryRunSink(Sink):
+    """
+    Discards the instances, counting them per action name in counts
+
+    A run into a dry-run sink maps the whole source, which checks the
+    mappings and measures the mapping throughput without a Dynizer.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def bind(self, mapping):
+        return mapping.action.name
+
+    def write(self, name, mapped, source = None):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+
+
+class LoaderEngine:
+    """
+    Shared mapping and sink stage of the loaders
+
+    A loader adapts its source to the engine: it binds its mappings and hands
+    its rows or entities to map(), or maps them itself and hands the results
+    to load(), or to reject() when a mapping raised an error. The engine
+    drops duplicates, prints debug output,
+    keeps the metrics and passes the instances to the sink. progress, rejects
+    and dedup are the arguments of the same name of the loader runs; reject
+    files and deduplicators created from a path or number are released when
+    the run ends.
+
+    Member Functions
+    ----------------
+    run
+        Run a loader body with the engine and return the final snapshot
+
+    bind
+        Bind a mapping (and its compiled mapper) to the sink
+
+    map
+        Map a row or entity with a bound mapper and write the instance
+
+    load
+        Write a mapped instance
+
+    reject
+        Quarantine a source whose mapping failed
+
+    flush
+        Write out the instances loaded so far
+
+    prescan
+        Resolve the topologies of a sample of rows or entities up front
+    """
+    def __init__(self, loader, sink: Sink,
+                       progress = None,
+                       rejects = None,
+                       dedup = None,
+                       debug = False):
+        self.loader = loader
+        self.sink = sink
+        self.debug = debug
+        self.metrics = LoaderMetrics(progress)
+        self.owned = []
+        self.rejects = rejects
+        if rejects is not None and not isinstance(rejects, RejectFile):
+            self.rejects = RejectFile(rejects)
+            self.owned.append(self.rejects)
+        self.dedup = make_deduplicator(dedup)
+        if self.dedup is not None and self.dedup is not dedup:
+            self.owned.append(self.dedup)
+
+    def run(self, body):
+        """
+        Open the sink, call body with the engine and close the sink. The
+        sink is aborted when body raises an error.
+        """
+        opened = False
+        try:
+            self.sink.open(self.loader, self.metrics, self.rejects)
+            opened = True
+            body(self)
+            self.sink.close()
+            return self.metrics.finish()
+        except Exception as e:
+            if opened:
+                self.sink.abort()
+            raise e
+        finally:
+            for resource in self.owned:
+                resource.close()
+
+    def bind(self, mapping, mapper = None):
+        """
+        Return the per run state of mapping, with its mapper timed as the
+        fetch stage. Bindings are printed as the loaders always did.
+        """
+        print('Creating instances for: {0}'.format(mapping.action.name))
+        return _BoundMapping(mapping, self.metrics.timed(mapper, 'fetch') if mapper is not None else None,
+                             self.sink.bind(mapping), self.rejects, self.dedup, self.metrics)
+
+    def map(self, state, source, *args):
+        """
+        Map args with the mapper of state and write the result. Without a
+        reject file mapping errors are raised; with one the source is
+        quarantined and loading continues. source may be a function that
+        returns it, which is only called with a reject file. Returns whether
+        an instance was written.
+        """
+        if self.rejects is None:
+            return self.load(state, state.mapper(*args))
+        if callable(source):
+            source = source()
+        try:
+            mapped = state.mapper(*args)
+        except Exception as e:
+            self.reject(state, source, e)
+            return False
+        return self.load(state, mapped, source=source)
+
+    def load(self, state, mapped, source = None):
+        """Write mapped, which may be None, and return whether an instance was written"""
+        if mapped is None:
+            return False
+        components, data, labels, top_map_key = mapped
+        if self.dedup is not None and self.dedup.seen(instance_fingerprint(state.mapping.action, top_map_key, data)):
+            self.metrics.duplicate()
+            return False
+
+        if self.debug:
+            inst = Instance(action_id=0, topology_id=0, data=data)
+            print(inst.to_json())
+
+        self.sink.write(state.handle, mapped, source)
+        self.metrics.instance()
+        return True
+
+    def flush(self):
+        """Write out the instances loaded so far, e.g. before recording a source offset"""
+        self.sink.flush()
+
+    def reject(self, state, source, error):
+        self.rejects.reject(self.loader, 'mapping', source, None, error)
+        self.metrics.rejected()
+
+    def prescan(self, samples, workers = 4):
+        """
+        Map samples, (state, args) pairs, with the mappers of their states
+        and resolve the distinct topologies of every state up front. Mapping
+        errors are left to the load with a reject file.
+        """
+        found = {}
+        for state, args in samples:
+            try:
+                mapped = state.mapper(*args)
+            except Exception as e:
+                # Quarantined by the load itself
+                if self.rejects is None:
+                    raise
+                continue
+            if mapped is not None and (state, mapped[3]) not in found:
+                found[(state, mapped[3])] = mapped
+        self.prefetch([(state, mapped) for (state, key), mapped in found.items()], workers)
+
+    def prefetch(self, signatures, workers = 4):
+        """
+        Resolve topologies up front. signatures holds (state, mapped) pairs
+        with one mapped instance per distinct topology.
+        """
+        requests = [(state.handle, mapped[3], mapped[0], mapped[2]) for state, mapped in signatures]
+        print('Resolving {0} topologies'.format(len(requests)))
+        try:
+            self.sink.prefetch(requests, workers)
+        except Exception as e:
+            raise LoaderError(self.loader, "Failed to create topologies during prescan")
+
+
+
+def default_sink(connection: DynizerConnection, sink = None, registry = None, workers = 0, queue_size = 8):
+    """
+    Return the sink of a loader run: sink when given, a ConnectorSink on
+    connection or a DryRunSink when connection is None
+    """
+    if sink is not None:
+        return sink
+    if connection is None:
+        return DryRunSink()
+    return ConnectorSink(connection, registry, workers, queue_size)
+
+
+
+class _BoundMapping:
+    # Per mapping state of a run
+    def __init__(self, mapping, mapper, handle, rejects, dedup, metrics):
+        self.mapping = mapping
+        self.mapper = mapper
+        self.handle = handle
+        self.rejects = rejects
+        self.dedup = dedup
+        self.metrics = metrics
+
+class _ConnectorTarget:
+    # Resolved action and pending batch of a mapping
+    def __init__(self, mapping, action_obj: Action, topology_map, quarantine):
+        self.mapping = mapping
+        self.action_obj = action_obj
+        self.topology_map = topology_map
+        # Source rows or entities of the loadlist, only kept to quarantine rejected instances
+        self.sources = [] if quarantine else None
+        self.loadlist = []
+
+class _SpooledMapping:
+    def __init__(self, action: Action, batch_size):
+        self.action = action
+        self.batch_size = batch_size
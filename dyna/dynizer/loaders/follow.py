@@ -0,0 +1,172 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+_HEAD_SIZE = 4096
+
+class FollowState:
+    """
+    Persistent read offsets of followed csv files
+
+    For every followed file the state keeps the byte offset up to which its
+    rows were loaded, together with a hash of the first bytes of the file,
+    stored in a sqlite database at path. A follower that restarts resumes at
+    the stored offset when the file still starts with the same bytes and is
+    at least that long, and reads the file from the start otherwise (it was
+    rotated or truncated while the follower was down).
+
+    Member Functions
+    ----------------
+    resume
+        Return the offset to resume an open file at
+
+    save
+        Store the offset of an open file
+
+    close
+        Close the underlying database
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS offsets '
+                        '(source TEXT PRIMARY KEY, offset INTEGER, head_size INTEGER, head BLOB)')
+        self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def resume(self, source, f):
+        """Return the stored offset of source when f, its open binary file, still matches it, else 0"""
+        with self.lock:
+            previous = self.db.execute('SELECT offset, head_size, head FROM offsets WHERE source = ?',
+                                       (os.path.abspath(source),)).fetchone()
+        if previous is None:
+            return 0
+        offset, head_size, head = previous
+        if os.fstat(f.fileno()).st_size < offset or _head_hash(f, head_size) != head:
+            return 0
+        return offset
+
+    def save(self, source, f, offset):
+        """Store offset as the end of the loaded rows of source, read from f"""
+        head_size = min(offset, _HEAD_SIZE)
+        head = _head_hash(f, head_size)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO offsets VALUES (?, ?, ?, ?)',
+                            (os.path.abspath(source), offset, head_size, head))
+            self.db.commit()
+
+
+
+class _FollowedFile:
+    # A csv file that is read up to its last complete record as it grows.
+    # When the file at path is replaced (rotated) the old file is drained and
+    # the new one is read from the start; a truncated file is read again from
+    # the start.
+    def __init__(self, path, quote, read_size):
+        self.path = path
+        self.quote = quote
+        self.read_size = read_size
+        self.file = None
+        self.identity = None
+        self.__reset(0)
+
+    def open(self, state: FollowState = None):
+        # Returns whether the file exists, resuming at the offset in state
+        try:
+            self.file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        stat = os.fstat(self.file.fileno())
+        self.identity = (stat.st_dev, stat.st_ino)
+        start = state.resume(self.path, self.file) if state is not None else 0
+        self.file.seek(start)
+        self.__reset(start)
+        return True
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def read(self):
+        # Returns the complete records that were appended since the last call
+        # and whether they start at the beginning of a file, headers included
+        if self.file is None and not self.open():
+            return b'', False
+        data = self.file.read(self.read_size)
+        if len(data) > 0:
+            self.buffer += data
+            return self.__records(self.__split())
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # Rotation in progress, the new file is picked up once it exists
+            return b'', False
+        if (stat.st_dev, stat.st_ino) != self.identity:
+            print('{0} was rotated, following the new file'.format(self.path))
+            # The old file is fully read, a final record without line end is complete as well
+            tail = self.buffer + b'\n' if len(self.buffer.strip()) > 0 else b''
+            result = self.__records(tail)
+            self.close()
+            self.open()
+            return result
+        if stat.st_size < self.file.tell():
+            print('{0} was truncated, reading it from the start'.format(self.path))
+            self.file.seek(0)
+            self.__reset(0)
+        return b'', False
+
+    def __records(self, records):
+        at_start = self.at_start and len(records) > 0
+        if len(records) > 0:
+            self.at_start = False
+        return records, at_start
+
+    def __reset(self, position):
+        # position is the offset of the end of the last complete record
+        self.position = position
+        self.at_start = position == 0
+        self.buffer = b''
+        self.scanned = 0
+        self.in_quotes = False
+
+    def __split(self):
+        buf = self.buffer
+        pos = self.scanned
+        in_quotes = self.in_quotes
+        end = 0
+        if self.quote is None:
+            end = pos = buf.rfind(b'\n') + 1
+        else:
+            # A line end only ends a record outside of a quoted field
+            while True:
+                nl = buf.find(b'\n', pos)
+                if nl < 0:
+                    break
+                if buf.count(self.quote, pos, nl) % 2 == 1:
+                    in_quotes = not in_quotes
+                pos = nl + 1
+                if not in_quotes:
+                    end = pos
+        self.buffer = buf[end:]
+        self.scanned = pos - end
+        self.in_quotes = in_quotes
+        self.position += end
+        return buf[:end]
+
+
+
+def _head_hash(f, size):
+    offset = f.tell()
+    try:
+        f.seek(0)
+        return hashlib.blake2b(f.read(size), digest_size=16).digest()
+    finally:
+        f.seek(offset)
@@ -0,0 +1,521 @@
+from ..types import Action, ComponentType, DataType, InstanceElement
+from ..connector import DynizerConnection
+from ...common.errors import LoaderError
+from .engine import LoaderEngine, Sink, default_sink
+from .csv_loader import _open_source
+from typing import Sequence
+import itertools
+import json
+import os
+import re
+
+class JSONAbstractElement:
+    """
+    Abstract JSON element
+
+    This class represents an abstract JSON element, that can be use to build up
+    Dynizer instance data.
+
+    Member Variables
+    ----------------
+    value : any
+        The actual value of the json element
+
+    data_type : DataType
+        The Dynizer data type of the json element
+
+    component : ComponentType
+        The Dynizer component type of the json element
+
+    label : str
+        The label for the json element
+
+    Member Functions
+    ----------------
+    fetch_from_entity
+        Should be overwritten in concrete elements that fetch the value from the
+        parsed json entity
+    """
+    def __init__(self, value,
+                       data_type: DataType,
+                       component: ComponentType,
+                       label = ''):
+        self.value = value
+        self.data_type = data_type
+        self.component = component
+        self.label = label
+
+    def fetch_from_entity(self, entity, components, data, labels, variables = None):
+        components.append(self.component)
+        data.append(InstanceElement(value=self.value, datatype=self.data_type))
+        labels.append(self.label)
+        return True
+
+
+
+class JSONFixedElement(JSONAbstractElement):
+    """
+    Fixed element
+
+    This class represents a Fixed element, that can be use to build up
+    Dynizer instance data. The value of the element is fixed.
+    """
+    def __init__(self, value,
+                       data_type: DataType,
+                       component: ComponentType,
+                       label = ''):
+        super().__init__(value, data_type, component, label)
+
+
+
+class JSONVariableElement(JSONAbstractElement):
+    """
+    Variable element
+
+    Variable elements take their value from the loop variables of the mapping.
+    The combination of loop variable values an entity was found with is
+    passed to fetch_from_entity. The loop_index selects the loop variable, the
+    variable_index the value within it, in the order of its variable paths.
+
+    See the JSONLoopVariable class for more information
+    """
+    def __init__(self, loop_index: int,
+                       variable_index: int,
+                       data_type: DataType,
+                       component: ComponentType,
+                       label = '',
+                       transform_funcs = []):
+        super().__init__(None, data_type, component, label)
+        self.loop_index = loop_index
+        self.variable_index = variable_index
+        self.transform_funcs = list(transform_funcs)
+
+    def fetch_from_entity(self, entity, components, data, labels, variables = None):
+        value = self.value if variables is None else self.variable_value(variables)
+        components.append(self.component)
+        data.append(InstanceElement(value=value, datatype=self.data_type))
+        labels.append(self.label)
+        return True
+
+    def variable_value(self, combination):
+        value = combination[self.loop_index][self.variable_index]
+        for tf in self.transform_funcs:
+            value = tf(value)
+        return value
+
+
+
+class JSONExtractionElement(JSONAbstractElement):
+    """
+    Extraction element
+
+    Adds the values found at path in the entity, one instance element per
+    value. null values count as missing; objects and arrays are added as their
+    json text. See JSONMapping for the path syntax.
+    """
+    def __init__(self, path: str,
+                       data_type: DataType,
+                       component: ComponentType,
+                       label = '',
+                       required = True,
+                       default = None,
+                       allow_void = True,
+                       transform_funcs = []):
+        super().__init__(None, data_type, component, label)
+        self.path = path
+        self.required = required
+        self.default = default
+        self.allow_void = allow_void
+        self.transform_funcs = list(transform_funcs)
+
+    def fetch_from_entity(self, entity, components, data, labels, variables = None):
+        values = [value for value in _json_path(self.path)(entity) if value is not None]
+        if len(values) == 0:
+            if self.required:
+                if self.default is not None:
+                    components.append(self.component)
+                    data.append(InstanceElement(value=self.default, datatype=self.data_type))
+                    labels.append(self.label)
+                elif self.allow_void:
+                    components.append(self.component)
+                    data.append(InstanceElement())
+                    labels.append(self.label)
+                else:
+                    return False
+            return True
+
+        for value in values:
+            value = _scalar(value)
+            for tf in self.transform_funcs:
+                value = tf(value)
+
+            components.append(self.component)
+            data.append(InstanceElement(value=value, datatype=self.data_type))
+            labels.append(self.label)
+        return True
+
+
+
+class JSONStringCombinationElement(JSONAbstractElement):
+    """
+    String combination element
+
+    Combines the values found at each of the paths into a single string. The
+    values of a path that selects several values are joined with
+    sequence_join_char, the paths are combined with combinator_func or joined
+    with spaces.
+    """
+    def __init__(self, paths: Sequence[str],
+                 component: ComponentType,
+                 label = '',
+                 combinator_func = None,
+                 required = True,
+                 sequence_join_char = ','):
+        super().__init__(None, DataType.STRING, component, label)
+        self.paths = paths
+        self.combinator_func = combinator_func
+        self.required = required
+        self.sequence_join_char = sequence_join_char
+
+    def fetch_from_entity(self, entity, components, data, labels, variables = None):
+        tmp_data = []
+        for path in self.paths:
+            values = [str(_scalar(value)) for value in _json_path(path)(entity) if value is not None]
+            tmp_data.append(self.sequence_join_char.join(values))
+
+        value = self.combinator_func(tmp_data) if self.combinator_func is not None else self._default_combinator(tmp_data)
+        if len(value) == 0:
+            if self.required:
+                data.append(InstanceElement())
+            else:
+                return False
+        else:
+            data.append(InstanceElement(value=value, datatype=DataType.STRING))
+
+        components.append(self.component)
+        labels.append(self.label)
+        return True
+
+    def _default_combinator(self, tmp_data):
+        return ' '.join(elem for elem in tmp_data if len(elem) > 0)
+
+
+
+class JSONLoopVariable:
+    """
+    Loop variable over a nested array
+
+    path selects the nodes to loop over, relative to the node of the previous
+    loop variable of the mapping or to the document for the first one, e.g.
+    'countries[*]' followed by 'cities[*]'. For every node, the values at the
+    variable paths (relative to the node) form the value tuple the variable
+    elements read.
+    """
+    def __init__(self, path: str, variable_path: Sequence[str]):
+        self.path = path
+        self.variable_path = variable_path
+
+
+
+class JSONMapping:
+    """
+    Mapping of json entities onto instances of an action
+
+    Entities are the values found at root_path in every document: a line of
+    an NDJSON file, an element of a top level json array or otherwise the
+    whole json document. With loop variables, root_path is relative to the
+    node of the last loop variable and the entities are mapped once for every
+    combination of loop variable values, so nested arrays can be flattened
+    while the values of the enclosing levels stay available to the variable
+    elements.
+
+    Paths are dotted keys with array steps: 'name', 'address.city',
+    'tags[*]' (every element of an array), 'tags[0]', 'items[-1]' and
+    '["key.with.dots"]'. A '*' step selects all values of an object. An empty
+    path or '$' selects the node itself.
+    """
+    def __init__(self, action: Action,
+                       root_path: str = '',
+                       variables: Sequence[JSONLoopVariable] = [],
+                       elements: Sequence[JSONAbstractElement] = [],
+                       fallback: Sequence[JSONAbstractElement] = [],
+                       batch_size = 100):
+        self.action = action
+        self.root_path = root_path
+        self.variables = list(variables)
+        self.elements = list(elements)
+        self.fallback = list(fallback)
+        self.batch_size = batch_size
+
+    def entities(self, document):
+        """Yield the (entity, combination) pairs of a document"""
+        if len(self.variables) == 0:
+            for entity in _json_path(self.root_path)(document):
+                yield entity, None
+            return
+        find_root = _json_path(self.root_path)
+        for combination, node in self.__expand(document, 0, [None] * len(self.variables)):
+            for entity in find_root(node):
+                yield entity, combination
+
+    def map_entity(self, entity, variables = None):
+        """
+        Map a single entity onto instance data
+
+        Returns a (components, data, labels, topology key) tuple, or None when
+        neither the elements nor the fallback elements could be fetched from
+        the entity.
+        """
+        result = JSONMapping.__fetch_entity(entity, self.elements, variables)
+        if result is None:
+            result = JSONMapping.__fetch_entity(entity, self.fallback, variables)
+        return result
+
+    def __expand(self, node, level, combination):
+        if level == len(self.variables):
+            yield tuple(combination), node
+            return
+        variable = self.variables[level]
+        for child in _json_path(variable.path)(node):
+            values = [[_scalar(value) for value in _json_path(v_path)(child)] for v_path in variable.variable_path]
+            for value in itertools.product(*values):
+                combination[level] = value
+                yield from self.__expand(child, level + 1, combination)
+
+    @staticmethod
+    def __fetch_entity(entity, elements, variables):
+        if len(elements) == 0:
+            return None
+
+        components = []
+        data = []
+        labels = []
+        for element in elements:
+            if element.fetch_from_entity(entity, components, data, labels, variables) == False:
+                return None
+
+        if len(components) < 2:
+            return None
+        return (components, data, labels, ','.join(map(str, components)))
+
+
+
+class JSONLoader:
+    """
+    JSON loader
+
+    The source can be a path to a plain or compressed (.gz, .bz2, .xz) file,
+    '-' for stdin, a text or binary stream, or for NDJSON any iterable of
+    lines. The source is parsed incrementally: NDJSON line by line and a json
+    document whose top level is an array element by element, so memory use is
+    bounded by the size of a document rather than the source. Other json
+    documents are parsed as a whole.
+
+    ndjson selects NDJSON (one json document per line). By default it is used
+    for paths ending in .ndjson, .jsonl or .ldjson, before a compression
+    extension.
+    """
+    def __init__(self, source,
+                       mappings: Sequence[JSONMapping] = [],
+                       ndjson = None,
+                       encoding = 'utf-8'):
+        self.source = source
+        self.mappings = list(mappings)
+        if ndjson is None:
+            ndjson = isinstance(source, (str, os.PathLike)) and _NDJSON_PATH.search(os.fspath(source).lower()) is not None
+        self.ndjson = ndjson
+        self.encoding = encoding
+
+    def add_mapping(self, mapping: JSONMapping):
+        self.mappings.append(mapping)
+
+    def run(self, connection: DynizerConnection, debug=False,
+                  pipeline=False, upload_workers=2, queue_size=8,
+                  registry=None, progress=None, rejects=None, dedup=None,
+                  sink: Sink = None):
+        """
+        Load the json source into the Dynizer
+
+        A single pass over the source serves all mappings. pipeline,
+        upload_workers, queue_size, registry, progress, rejects, dedup and
+        sink work as in XMLLoader.run; the source of a rejected entity is its
+        json text.
+        """
+        sink = default_sink(connection, sink, registry, upload_workers if pipeline else 0, queue_size)
+        engine = LoaderEngine(JSONLoader, sink, progress=progress, rejects=rejects, dedup=dedup, debug=debug)
+        return engine.run(self.__load)
+
+    def __load(self, engine: LoaderEngine):
+        states = [engine.bind(mapping, mapping.map_entity) for mapping in self.mappings]
+        if not (self.ndjson or isinstance(self.source, (str, os.PathLike)) or hasattr(self.source, 'read')):
+            raise LoaderError(JSONLoader, "Only NDJSON can be read from an iterable of lines")
+        with _open_source(self.source, self.encoding, engine.metrics) as jsonfile:
+            for document in engine.metrics.timed_iter(self.__documents(jsonfile), 'parse'):
+                for state in states:
+                    for entity, combination in state.mapping.entities(document):
+                        engine.metrics.row()
+                        engine.map(state, lambda: json.dumps(entity), entity, combination)
+
+    def __documents(self, jsonfile):
+        if self.ndjson:
+            for number, line in enumerate(jsonfile, 1):
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    raise LoaderError(JSONLoader, "Invalid json on line {0}: {1}".format(number, e))
+            return
+        try:
+            yield from _iter_json_documents(jsonfile)
+        except ValueError as e:
+            raise LoaderError(JSONLoader, "Invalid json: {0}".format(e))
+
+
+
+_NDJSON_PATH = re.compile(r'\.(ndjson|jsonl|ldjson)(\.(gz|gzip|bz2|xz|lzma))?$')
+_PATH_TOKEN = re.compile(r'\.?([^.\[\]]+)|\[\s*(\*|-?\d+|"(?:[^"\\]|\\.)*"|\'[^\']*\')\s*\]')
+_READ_SIZE = 64 * 1024
+_WHITESPACE = ' \t\n\r'
+_CUT_OFF_CHARS = 16
+
+def _scalar(value):
+    # Objects and arrays become their json text
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+_PATHS = {}
+
+def _json_path(path: str):
+    # Returns a function that selects the values at path from a node, see
+    # JSONMapping for the syntax. Compiled paths are cached.
+    find = _PATHS.get(path)
+    if find is not None:
+        return find
+
+    text = path.strip()
+    if text.startswith('$'):
+        text = text[1:]
+    steps = []
+    pos = 0
+    while pos < len(text):
+        match = _PATH_TOKEN.match(text, pos)
+        if match is None or match.end() == pos:
+            raise LoaderError(JSONLoader, "Invalid json path: '{0}'".format(path))
+        key, index = match.groups()
+        if key is not None:
+            steps.append(('all', None) if key == '*' else ('key', key))
+        elif index == '*':
+            steps.append(('all', None))
+        elif index[0] in '"\'':
+            steps.append(('key', json.loads(index) if index[0] == '"' else index[1:-1]))
+        else:
+            steps.append(('index', int(index)))
+        pos = match.end()
+
+    if all(kind == 'key' for kind, arg in steps):
+        # Plain object keys select at most one value
+        keys = tuple(arg for kind, arg in steps)
+
+        def find(node):
+            for key in keys:
+                if not isinstance(node, dict) or key not in node:
+                    return []
+                node = node[key]
+            return [node]
+        _PATHS[path] = find
+        return find
+
+    def find(node):
+        nodes = [node]
+        for kind, arg in steps:
+            found = []
+            for node in nodes:
+                if kind == 'key':
+                    if isinstance(node, dict) and arg in node:
+                        found.append(node[arg])
+                elif kind == 'index':
+                    if isinstance(node, list) and -len(node) <= arg < len(node):
+                        found.append(node[arg])
+                elif isinstance(node, list):
+                    found.extend(node)
+                elif isinstance(node, dict):
+                    found.extend(node.values())
+            nodes = found
+        return nodes
+
+    _PATHS[path] = find
+    return find
+
+def _maybe_cut_off(error, buf):
+    # Whether a decoding error may be due to the element continuing in the
+    # next read: an unterminated string, or an error close enough to the end
+    # of the buffer to be a cut off literal, number or escape. Any other error
+    # is raised at once instead of reading the rest of the file into the buffer.
+    return error.msg.startswith('Unterminated string') or error.pos >= len(buf) - _CUT_OFF_CHARS
+
+def _iter_json_documents(jsonfile):
+    # Yields the elements of a top level json array one at a time, or the
+    # whole document when it is not an array. Raises ValueError on invalid json.
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill(buf, pos):
+        # Drops the consumed part of the buffer and reads at least as much
+        # as it holds, so a large element is not decoded over and over
+        chunk = jsonfile.read(max(_READ_SIZE, len(buf) - pos))
+        return buf[pos:] + chunk, 0, len(chunk) == 0
+
+    def skip(buf, pos, eof):
+        while True:
+            while pos < len(buf) and buf[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf, pos, eof
+            buf, pos, eof = fill(buf, pos)
+
+    buf, pos, eof = skip(buf, pos, eof)
+    if pos == len(buf):
+        return
+    if buf[pos] != '[':
+        while not eof:
+            buf, pos, eof = fill(buf, pos)
+        document, end = decoder.raw_decode(buf, pos)
+        buf, pos, eof = skip(buf, end, eof)
+        if pos < len(buf):
+            raise ValueError('Extra data after the json document')
+        yield document
+        return
+
+    buf, pos, eof = skip(buf, pos + 1, eof)
+    if pos < len(buf) and buf[pos] == ']':
+        return
+    while True:
+        try:
+            element, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            if eof or not _maybe_cut_off(e, buf):
+                raise
+            buf, pos, eof = fill(buf, pos)
+            continue
+        number = isinstance(element, (int, float)) and not isinstance(element, bool)
+        if number and not eof and end >= len(buf) - _CUT_OFF_CHARS:
+            # A number near the end of the buffer may continue in the next
+            # read, like 1.5 of 1.5e+10
+            buf, pos, eof = fill(buf, pos)
+            continue
+        yield element
+        buf, pos, eof = skip(buf, end, eof)
+        if pos == len(buf):
+            raise ValueError('Unterminated array')
+        if buf[pos] == ']':
+            return
+        if buf[pos] != ',':
+            raise ValueError("Expecting ',' delimiter between array elements")
+        buf, pos, eof = skip(buf, pos + 1, eof)
+        if pos > _READ_SIZE:
+            buf, pos = buf[pos:], 0
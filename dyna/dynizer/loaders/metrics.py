@@ -0,0 +1,214 @@
+import threading
+import time
+
+class ProgressReporter:
+    """
+    Progress callback of a loader
+
+    Loaders call on_progress at most every interval seconds while they run and
+    on_finish once when they are done, both with a snapshot dictionary (see
+    LoaderMetrics.snapshot). Subclass it to feed loader metrics into another
+    system, or pass a plain function which is then called as on_progress.
+    """
+    def __init__(self, interval = 5.0):
+        self.interval = interval
+
+    def on_progress(self, snapshot):
+        pass
+
+    def on_finish(self, snapshot):
+        pass
+
+
+
+class ConsoleReporter(ProgressReporter):
+    """Periodically prints the throughput and stage timings to stdout"""
+    def on_progress(self, snapshot):
+        print(ConsoleReporter.format(snapshot))
+
+    def on_finish(self, snapshot):
+        print('Finished: {0}'.format(ConsoleReporter.format(snapshot)))
+
+    @staticmethod
+    def format(snapshot):
+        line = '{0} rows ({1:.0f}/s), {2} instances ({3:.0f}/s), {4} batches ({5:.1f} instances/batch, {6} in flight)'.format(
+                snapshot['rows'], snapshot['rows_per_second'],
+                snapshot['instances'], snapshot['instances_per_second'],
+                snapshot['batches'], snapshot['instances_per_batch'],
+                snapshot['batches_in_flight'])
+        if snapshot['duplicates'] > 0:
+            line = '{0}, {1} duplicates dropped'.format(line, snapshot['duplicates'])
+        if snapshot['rejected'] > 0:
+            line = '{0}, {1} rejected'.format(line, snapshot['rejected'])
+        if snapshot['progress'] is not None:
+            line = '{0}, {1:.1f}%'.format(line, 100.0 * snapshot['progress'])
+        if snapshot['eta'] is not None:
+            line = '{0}, ETA {1:.0f}s'.format(line, snapshot['eta'])
+        stages = ', '.join('{0} {1:.1f}s'.format(stage, seconds)
+                           for stage, seconds in snapshot['stage_times'].items() if seconds > 0)
+        if len(stages) > 0:
+            line = '{0} [{1}]'.format(line, stages)
+        return line
+
+
+
+class _FunctionReporter(ProgressReporter):
+    def __init__(self, func):
+        super().__init__()
+        self.func = func
+
+    def on_progress(self, snapshot):
+        self.func(snapshot)
+
+
+
+class LoaderMetrics:
+    """
+    Counters and stage timings of a loader run
+
+    Rows (or entities), instances, batches, dropped duplicates and rejected
+    records are always counted. Stage timing is only done when reporters are attached, since it
+    costs a clock read per row and stage. The stages are parse, fetch,
+    topology, serialize and http.
+
+    The position callable, when set, returns the number of source bytes consumed
+    so far; together with total_bytes it drives the progress and ETA.
+    """
+    STAGES = ('parse', 'fetch', 'topology', 'serialize', 'http')
+
+    def __init__(self, reporters = None):
+        if reporters is None:
+            reporters = []
+        elif isinstance(reporters, ProgressReporter) or callable(reporters):
+            reporters = [reporters]
+        self.reporters = [r if isinstance(r, ProgressReporter) else _FunctionReporter(r) for r in reporters]
+        self.timing = len(self.reporters) > 0
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.last_report = [self.start_time] * len(self.reporters)
+        self.rows = 0
+        self.instances = 0
+        self.batches = 0
+        self.batched_instances = 0
+        self.batches_in_flight = 0
+        self.rejects = 0
+        self.duplicates = 0
+        self.stage_times = dict((stage, 0.0) for stage in LoaderMetrics.STAGES)
+        self.position = None
+        self.total_bytes = None
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.stage_times[stage] += seconds
+
+    def timed(self, func, stage):
+        """Wrap func so its run time is added to stage, when timing is enabled"""
+        if not self.timing:
+            return func
+        stage_times = self.stage_times
+        clock = time.perf_counter
+
+        def timed_func(*args):
+            start = clock()
+            try:
+                return func(*args)
+            finally:
+                stage_times[stage] += clock() - start
+        return timed_func
+
+    def timed_iter(self, iterable, stage):
+        """Iterate over iterable, adding the time to fetch each item to stage"""
+        if not self.timing:
+            return iterable
+        return self.__timed_iter(iterable, stage)
+
+    def __timed_iter(self, iterable, stage):
+        stage_times = self.stage_times
+        clock = time.perf_counter
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                stage_times[stage] += clock() - start
+                return
+            stage_times[stage] += clock() - start
+            yield item
+
+    def row(self, count = 1):
+        self.rows += count
+        if self.timing and self.rows & 0x3ff == 0:
+            self.report()
+
+    def instance(self):
+        self.instances += 1
+
+    def duplicate(self):
+        self.duplicates += 1
+
+    def rejected(self, count = 1):
+        with self.lock:
+            self.rejects += count
+
+    def batch_submitted(self, size):
+        with self.lock:
+            self.batches_in_flight += 1
+
+    def batch_done(self, size):
+        with self.lock:
+            self.batches_in_flight -= 1
+            self.batches += 1
+            self.batched_instances += size
+
+    def report(self, force = False):
+        now = time.perf_counter()
+        snapshot = None
+        for i, reporter in enumerate(self.reporters):
+            if force or now - self.last_report[i] >= reporter.interval:
+                self.last_report[i] = now
+                if snapshot is None:
+                    snapshot = self.snapshot()
+                reporter.on_progress(snapshot)
+
+    def finish(self):
+        snapshot = self.snapshot()
+        for reporter in self.reporters:
+            reporter.on_finish(snapshot)
+        return snapshot
+
+    def snapshot(self):
+        elapsed = max(time.perf_counter() - self.start_time, 1e-9)
+        with self.lock:
+            batches = self.batches
+            batched_instances = self.batched_instances
+            in_flight = self.batches_in_flight
+            rejects = self.rejects
+            stage_times = dict(self.stage_times)
+
+        bytes_read = self.position() if self.position is not None else None
+        progress = None
+        eta = None
+        if bytes_read is not None and self.total_bytes:
+            progress = min(1.0, bytes_read / self.total_bytes)
+            if progress > 0:
+                eta = elapsed * (1.0 - progress) / progress
+
+        return {
+            'elapsed': elapsed,
+            'rows': self.rows,
+            'rows_per_second': self.rows / elapsed,
+            'instances': self.instances,
+            'instances_per_second': self.instances / elapsed,
+            'batches': batches,
+            'instances_per_batch': batched_instances / batches if batches > 0 else 0.0,
+            'batches_in_flight': in_flight,
+            'rejected': rejects,
+            'duplicates': self.duplicates,
+            'stage_times': stage_times,
+            'bytes_read': bytes_read,
+            'total_bytes': self.total_bytes,
+            'progress': progress,
+            'eta': eta
+        }
+
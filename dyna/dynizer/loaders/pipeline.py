@@ -0,0 +1,248 @@
+from ..connector import DynizerConnection
+from ...common.errors import LoaderError
+from .metrics import LoaderMetrics
+from .rejects import RejectFile, is_rejection
+import collections
+import itertools
+import queue
+import threading
+import time
+
+_DONE = object()
+
+class _StageError:
+    def __init__(self, error):
+        self.error = error
+
+
+
+class BatchUploader:
+    """
+    Upload stage of a loader
+
+    Batches handed to submit() are written with batch_create. Without workers
+    this happens inline on the given connection. With workers every worker
+    thread uploads on its own clone of the connection and submit() blocks while
+    queue_size batches are waiting, which keeps the mapping stage from running
+    ahead of the uploads. The first upload error is raised from the next
+    submit() or from close().
+
+    With a RejectFile, a batch the server rejects is bisected until the
+    offending instances are found. Those are written to the reject file
+    together with their source, the rest of the batch is loaded.
+
+    Member Functions
+    ----------------
+    submit
+        Hand a batch of instances to the upload stage
+
+    drain
+        Wait for the submitted batches to be written, leaving the workers
+        running
+
+    close
+        Wait for all submitted batches to be written
+
+    abort
+        Stop the workers without writing the remaining batches
+    """
+    def __init__(self, connection: DynizerConnection,
+                       loader,
+                       workers = 0,
+                       queue_size = 8,
+                       metrics: LoaderMetrics = None,
+                       rejects: RejectFile = None):
+        self.connection = connection
+        self.loader = loader
+        self.metrics = metrics if metrics is not None else LoaderMetrics()
+        self.rejects = rejects
+        self.workers = workers if connection is not None else 0
+        self.error = None
+        self.queue = None
+        self.threads = []
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        if self.workers > 0:
+            self.queue = queue.Queue(maxsize=queue_size)
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.__work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, batch, sources = None):
+        # sources optionally holds the source row or entity of every instance
+        if self.connection is None:
+            return
+        self.__raise_error()
+        self.metrics.batch_submitted(len(batch))
+        if self.queue is None:
+            self.__upload(self.connection, batch, sources)
+        elif not _put(self.queue, (batch, sources), self.stop):
+            self.__raise_error()
+
+    def drain(self):
+        if self.queue is not None:
+            with self.queue.all_tasks_done:
+                while self.queue.unfinished_tasks > 0 and not self.stop.is_set():
+                    self.queue.all_tasks_done.wait(0.1)
+        self.__raise_error()
+
+    def close(self):
+        for thread in self.threads:
+            _put(self.queue, _DONE, self.stop)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.__raise_error()
+
+    def abort(self):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def __work(self):
+        connection = self.connection.clone()
+        try:
+            connection.connect()
+            while not self.stop.is_set():
+                try:
+                    item = self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    self.queue.task_done()
+                    break
+                try:
+                    self.__upload(connection, *item)
+                finally:
+                    self.queue.task_done()
+        except Exception as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+            self.stop.set()
+        finally:
+            connection.close()
+
+    def __upload(self, connection: DynizerConnection, batch, sources = None):
+        print("Writing batch ...")
+        try:
+            self.__write(connection, batch)
+        except Exception as e:
+            if self.rejects is None or not is_rejection(e):
+                raise LoaderError(self.loader, "Failed to push batch of instances") from e
+            if sources is None:
+                sources = [None] * len(batch)
+            self.__bisect(connection, batch, sources, e)
+        self.metrics.batch_done(len(batch))
+
+    def __write(self, connection: DynizerConnection, batch):
+        start = time.perf_counter()
+        payload = connection.serialize_batch(batch)
+        serialized = time.perf_counter()
+        connection.batch_create(batch, payload)
+        self.metrics.add_time('serialize', serialized - start)
+        self.metrics.add_time('http', time.perf_counter() - serialized)
+
+    def __bisect(self, connection: DynizerConnection, batch, sources, error):
+        # The batch was rejected: split it until the rejected instances are isolated
+        if len(batch) == 1:
+            self.rejects.reject(self.loader, 'upload', sources[0], batch[0], error)
+            self.metrics.rejected()
+            return
+        middle = len(batch) // 2
+        for part, part_sources in ((batch[:middle], sources[:middle]), (batch[middle:], sources[middle:])):
+            try:
+                self.__write(connection, part)
+            except Exception as e:
+                if not is_rejection(e):
+                    raise LoaderError(self.loader, "Failed to push batch of instances") from e
+                self.__bisect(connection, part, part_sources, e)
+
+    def __raise_error(self):
+        with self.lock:
+            error = self.error
+        if error is not None:
+            raise error
+
+
+
+def threaded_iter(iterable, queue_size = 8):
+    """
+    Reader stage of a loader
+
+    Iterates over iterable in a separate thread, handing the items over through
+    a bounded queue. Errors raised while iterating are re-raised in the
+    consuming thread.
+    """
+    items = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def read():
+        try:
+            for item in iterable:
+                if not _put(items, item, stop):
+                    return
+            _put(items, _DONE, stop)
+        except Exception as e:
+            _put(items, _StageError(e), stop)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _StageError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def chunked(iterable, size):
+    """Group the items of iterable in lists of at most size items"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def ordered_map(executor, func, arguments, window):
+    """
+    Mapping stage of a loader
+
+    Submits func(*args) to executor for every tuple of arguments and yields
+    the results in submission order. At most window calls are in flight
+    ahead of the results that were consumed, so results do not pile up in
+    memory when the consumer is slower than the workers. Calls that did not
+    start yet are cancelled when the iteration stops early.
+    """
+    pending = collections.deque()
+    try:
+        for args in arguments:
+            pending.append(executor.submit(func, *args))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while len(pending) > 0:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def _put(q, item, stop):
+    # Blocking put that gives up once the pipeline is stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
@@ -0,0 +1,260 @@
+from ..types import Action, ComponentType, Topology
+from ..connector import DynizerConnection
+from concurrent.futures import ThreadPoolExecutor
+import json
+import sqlite3
+import threading
+import time
+
+class TopologyRegistry:
+    """
+    Action and topology registry
+
+    Resolves actions and topologies to their Dynizer objects and remembers the
+    result, so every action and component combination is created and linked only
+    once. A registry can be shared by several loaders and loader runs.
+
+    When a path is given the registry is persisted in a sqlite database and warmed
+    from it on creation. Entries are stored per Dynizer server. Entries that come
+    from the database are validated against the server the first time they are
+    used, unless validate is False; entries that no longer match are resolved
+    again.
+
+    Member Functions
+    ----------------
+    resolve_action
+        Return the Dynizer action for an Action, creating it when needed
+
+    resolve_topology
+        Return the Dynizer topology for a list of components, creating it and
+        linking it to the action when needed
+
+    for_action
+        Return a per action view with a lock free cache for the row path
+
+    prefetch
+        Resolve many topologies up front with concurrent requests
+
+    close
+        Close the underlying database
+    """
+    def __init__(self, path: str = None, validate = True):
+        self.path = path
+        self.validate = validate
+        self.lock = threading.RLock()
+        self.actions = {}
+        self.topologies = {}
+        self.links = {}
+        self.validated = set()
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.__create_tables()
+            self.__warm()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def for_action(self, connection: DynizerConnection, action_obj: Action, metrics = None):
+        return ActionTopologies(self, connection, action_obj, metrics)
+
+    def prefetch(self, connection: DynizerConnection, requests, workers=4):
+        """
+        Resolve topologies concurrently
+
+        requests is a sequence of (ActionTopologies, key, components, labels)
+        tuples. Every worker resolves on its own clone of the connection and the
+        results are stored in the given views.
+        """
+        if len(requests) == 0:
+            return
+        local = threading.local()
+        clones = []
+
+        def resolve(request):
+            view, key, components, labels = request
+            if key in view:
+                return
+            if not hasattr(local, 'connection'):
+                local.connection = connection.clone()
+                local.connection.connect()
+                with self.lock:
+                    clones.append(local.connection)
+            view.topologies[key] = self.resolve_topology(local.connection, view.action_obj,
+                                                         components, labels, key)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                for result in executor.map(resolve, requests):
+                    pass
+        finally:
+            for clone in clones:
+                clone.close()
+
+    def resolve_action(self, connection: DynizerConnection, action: Action):
+        server = TopologyRegistry.__server(connection)
+        key = (server, action.name, action.actiontype)
+        with self.lock:
+            action_obj = self.actions.get(key)
+        if action_obj is not None and not self.__is_valid(connection, ('action',) + key, action_obj):
+            self.__forget_action(key)
+            action_obj = None
+
+        if action_obj is None:
+            action_obj = connection.create(action)
+            with self.lock:
+                self.actions[key] = action_obj
+                self.validated.add(('action',) + key)
+                self.__store('INSERT OR REPLACE INTO actions VALUES (?, ?, ?, ?)',
+                             (server, action.name, action.actiontype, action_obj.id))
+        return action_obj
+
+    def resolve_topology(self, connection: DynizerConnection,
+                               action_obj: Action,
+                               components,
+                               labels,
+                               key = None):
+        server = TopologyRegistry.__server(connection)
+        if key is None:
+            key = ','.join(map(str, components))
+        topology_key = (server, key)
+        with self.lock:
+            topology_obj = self.topologies.get(topology_key)
+        if topology_obj is not None and not self.__is_valid(connection, ('topology',) + topology_key, topology_obj):
+            self.__forget_topology(topology_key)
+            topology_obj = None
+
+        if topology_obj is None:
+            topology_obj = connection.create(Topology(components=components, labels=labels))
+            with self.lock:
+                self.topologies[topology_key] = topology_obj
+                self.validated.add(('topology',) + topology_key)
+                self.__store('INSERT OR REPLACE INTO topologies VALUES (?, ?, ?)',
+                             (server, key, topology_obj.id))
+
+        # The labels belong to the link with this action, so every caller gets
+        # its own copy of the shared topology
+        topology_obj = Topology(topology_obj.id, topology_obj.components, labels,
+                                topology_obj.constraining_actions, topology_obj.applying_actions)
+
+        link_key = (server, action_obj.id, topology_obj.id)
+        with self.lock:
+            linked = link_key in self.links
+        if not linked:
+            try:
+                connection.link_actiontopology(action_obj, topology_obj)
+                with self.lock:
+                    self.__store('INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?)',
+                                 (server, action_obj.id, topology_obj.id, json.dumps(labels)))
+            except Exception as e:
+                print("Failed to link action and topology.")
+            with self.lock:
+                self.links[link_key] = labels
+        return topology_obj
+
+    def __is_valid(self, connection, validation_key, obj):
+        # Only entries that were warmed from the database need validation
+        if not self.validate or connection is None:
+            return True
+        with self.lock:
+            if validation_key in self.validated:
+                return True
+        try:
+            if validation_key[0] == 'action':
+                server_obj = connection.read(Action(id=obj.id))
+                valid = server_obj is not None and server_obj.name == obj.name
+            else:
+                server_obj = connection.read(Topology(id=obj.id))
+                valid = (server_obj is not None and
+                         ','.join(map(str, server_obj.components)) == validation_key[2])
+        except Exception as e:
+            valid = False
+        if valid:
+            with self.lock:
+                self.validated.add(validation_key)
+        return valid
+
+    def __forget_action(self, key):
+        with self.lock:
+            action_obj = self.actions.pop(key, None)
+            self.__store('DELETE FROM actions WHERE server = ? AND name = ? AND actiontype = ?', key)
+            if action_obj is not None:
+                for link_key in [k for k in self.links if k[0] == key[0] and k[1] == action_obj.id]:
+                    del self.links[link_key]
+                self.__store('DELETE FROM links WHERE server = ? AND action_id = ?', (key[0], action_obj.id))
+
+    def __forget_topology(self, key):
+        with self.lock:
+            topology_obj = self.topologies.pop(key, None)
+            self.__store('DELETE FROM topologies WHERE server = ? AND key = ?', key)
+            if topology_obj is not None:
+                for link_key in [k for k in self.links if k[0] == key[0] and k[2] == topology_obj.id]:
+                    del self.links[link_key]
+                self.__store('DELETE FROM links WHERE server = ? AND topology_id = ?', (key[0], topology_obj.id))
+
+    def __create_tables(self):
+        self.db.execute('CREATE TABLE IF NOT EXISTS actions '
+                        '(server TEXT, name TEXT, actiontype TEXT, id, PRIMARY KEY (server, name, actiontype))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS topologies '
+                        '(server TEXT, key TEXT, id, PRIMARY KEY (server, key))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS links '
+                        '(server TEXT, action_id, topology_id, labels TEXT, PRIMARY KEY (server, action_id, topology_id))')
+        self.db.commit()
+
+    def __warm(self):
+        for server, name, actiontype, id in self.db.execute('SELECT * FROM actions'):
+            self.actions[(server, name, actiontype)] = Action(id, name, actiontype)
+        for server, key, id in self.db.execute('SELECT * FROM topologies'):
+            self.topologies[(server, key)] = Topology(id=id, components=list(map(ComponentType.from_string, key.split(','))))
+        for server, action_id, topology_id, labels in self.db.execute('SELECT * FROM links'):
+            self.links[(server, action_id, topology_id)] = json.loads(labels)
+
+    def __store(self, statement, args):
+        if self.db is not None:
+            self.db.execute(statement, args)
+            self.db.commit()
+
+    @staticmethod
+    def __server(connection):
+        if connection is None:
+            return ''
+        return '{0}:{1}{2}'.format(connection.dynizer_address, connection.dynizer_port,
+                                   connection.endpoint_prefix)
+
+
+
+class ActionTopologies:
+    """
+    The topologies of one action
+
+    A thin per action view on a TopologyRegistry, used by a loader while it
+    runs. Topologies that were resolved before are served from a plain dict;
+    others are resolved through the registry.
+    """
+    def __init__(self, registry: TopologyRegistry,
+                       connection: DynizerConnection,
+                       action_obj: Action,
+                       metrics = None):
+        self.registry = registry
+        self.connection = connection
+        self.action_obj = action_obj
+        self.metrics = metrics
+        self.topologies = {}
+
+    def __contains__(self, key):
+        return key in self.topologies
+
+    def resolve(self, key, components, labels):
+        topology_obj = self.topologies.get(key)
+        if topology_obj is None:
+            start = time.perf_counter()
+            topology_obj = self.registry.resolve_topology(self.connection, self.action_obj,
+                                                          components, labels, key)
+            self.topologies[key] = topology_obj
+            if self.metrics is not None:
+                self.metrics.add_time('topology', time.perf_counter() - start)
+        return topology_obj
+
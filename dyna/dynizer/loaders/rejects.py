@@ -0,0 +1,73 @@
+from ...common.errors import RequestError, SerializationError
+import json
+import threading
+
+class RejectFile:
+    """
+    Quarantine for rows and instances that could not be loaded
+
+    Every rejected record is appended to the file as a line of json holding
+    the loader, the stage that failed ('mapping' or 'upload'), the source row
+    or entity, the instance when there was one and the error. The target is
+    either a path or an open text stream; a path is opened on creation and
+    closed by close().
+    """
+    def __init__(self, target):
+        self.count = 0
+        self.lock = threading.Lock()
+        if isinstance(target, str):
+            self.stream = open(target, 'a', encoding='utf-8')
+            self.owned = True
+        else:
+            self.stream = target
+            self.owned = False
+
+    def reject(self, loader, stage, source, instance, error):
+        record = {
+            'loader': loader.__name__,
+            'stage': stage,
+            'source': source,
+            'instance': RejectFile.__instance_json(instance),
+            'error': describe_error(error)
+        }
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.owned and not self.stream.closed:
+                self.stream.close()
+
+    @staticmethod
+    def __instance_json(instance):
+        if instance is None:
+            return None
+        try:
+            return json.loads(instance.to_json())
+        except Exception as e:
+            return repr(instance)
+
+
+
+def describe_error(error):
+    """Return a one line description of an exception"""
+    if isinstance(error, str):
+        return error
+    message = getattr(error, 'message', None)
+    if message is None:
+        message = str(error)
+    return '{0}: {1}'.format(type(error).__name__, message)
+
+def is_rejection(error):
+    """
+    Return whether error rejects the instances that were sent, rather than
+    pointing at a problem with the server or the connection
+    """
+    if isinstance(error, SerializationError):
+        return True
+    if isinstance(error, RequestError):
+        return 400 <= error.http_status < 500 and error.http_status not in (401, 403, 404, 408, 429)
+    return False
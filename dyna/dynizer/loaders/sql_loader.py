@@ -0,0 +1,85 @@
+from ..connector import DynizerConnection
+from ...common.errors import LoaderError
+from .engine import LoaderEngine, Sink, default_sink
+from .csv_loader import CSVMapping
+from typing import Sequence
+
+class SQLLoader:
+    """
+    SQL loader
+
+    Runs query with the optional parameters on db_connection, a DB-API 2.0
+    connection such as one from sqlite3, and maps the result rows with
+    CSVMappings: index i of a CSVRowElement reads column i of the result.
+    Rows are fetched with fetchmany in chunks of fetch_size rows, so the
+    result set is never held in memory as a whole.
+
+    Values keep the python type the database driver returns. Where that type
+    already matches the data type of the element (int for INTEGER, str for
+    STRING, datetime for TIMESTAMP and so on) the value is used as is; other
+    values are converted as for csv files. NULL counts as a missing value.
+    The db_connection is not closed by the loader.
+    """
+    def __init__(self, db_connection,
+                       query: str,
+                       mappings: Sequence[CSVMapping] = [],
+                       parameters = None,
+                       fetch_size = 1000):
+        self.db_connection = db_connection
+        self.query = query
+        self.mappings = list(mappings)
+        self.parameters = parameters
+        self.fetch_size = fetch_size
+
+    def add_mapping(self, mapping: CSVMapping):
+        self.mappings.append(mapping)
+
+    def run(self, connection: DynizerConnection, debug=False,
+                  pipeline=False, upload_workers=2, queue_size=8,
+                  registry=None, progress=None, rejects=None, dedup=None,
+                  sink: Sink = None):
+        """
+        Load the result of the query into the Dynizer
+
+        Rows are fetched and mapped in the calling thread, as DB-API
+        connections are not generally safe to share between threads. pipeline,
+        upload_workers, queue_size, registry, progress, rejects, dedup and sink
+        work as in CSVLoader.run; the source of a rejected row is its list of
+        values.
+        """
+        sink = default_sink(connection, sink, registry, upload_workers if pipeline else 0, queue_size)
+        engine = LoaderEngine(SQLLoader, sink, progress=progress, rejects=rejects, dedup=dedup, debug=debug)
+        return engine.run(self.__load)
+
+    def __load(self, engine: LoaderEngine):
+        states = [engine.bind(mapping, mapping.compile()) for mapping in self.mappings]
+        cursor = self.__execute()
+        try:
+            for rows in engine.metrics.timed_iter(self.__chunks(cursor), 'parse'):
+                for row in rows:
+                    engine.metrics.row()
+                    for state in states:
+                        engine.map(state, lambda: list(row), row)
+                engine.metrics.report()
+        finally:
+            cursor.close()
+
+    def __execute(self):
+        cursor = self.db_connection.cursor()
+        try:
+            cursor.arraysize = self.fetch_size
+            if self.parameters is None:
+                cursor.execute(self.query)
+            else:
+                cursor.execute(self.query, self.parameters)
+        except Exception as e:
+            cursor.close()
+            raise LoaderError(SQLLoader, "Failed to execute query: {0}".format(e))
+        return cursor
+
+    def __chunks(self, cursor):
+        while True:
+            rows = cursor.fetchmany(self.fetch_size)
+            if len(rows) == 0:
+                return
+            yield rows
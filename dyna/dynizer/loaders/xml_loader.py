@@ -1,9 +1,24 @@
-from ..types import Action, ComponentType, DataElement, DataType, Instance, InstanceElement, Topology
+from ..types import Action, ComponentType, DataType, InstanceElement
 from ..connector import DynizerConnection
 from ...common.errors import LoaderError
+from .pipeline import chunked, ordered_map, threaded_iter
+from .csv_loader import _worker_context
+from .metrics import LoaderMetrics
+from .engine import LoaderEngine, Sink, default_sink
+from .rejects import describe_error
+from concurrent.futures import ProcessPoolExecutor
 from typing import Sequence
 import xml.etree.ElementTree as ET
+import contextlib
+import copy
 import itertools
+import os
+import re
+
+try:
+    from lxml import etree as _lxml_etree
+except ImportError:
+    _lxml_etree = None
 
 class XMLAbstractElement:
     """
@@ -55,6 +70,10 @@ class XMLAbstractElement:
     def apply_variables(self, combinations):
         pass
 
+    def _paths(self):
+        # The entity relative paths the element reads, see XMLMapping.compile
+        return []
+
 
 
 class XMLFixedElement(XMLAbstractElement):
@@ -87,6 +106,11 @@ class XMLVariableElement(XMLAbstractElement):
     Since each loop variable can have multiple subvariable references, the variable_index
     refers to the sub-index within the loopvariable.
 
+    The combination is passed to fetch_from_entity as the variables argument,
+    so the element itself holds no per combination state and a mapping can be
+    used for several combinations at the same time. apply_variables is kept
+    for callers that bind a combination on the element instead.
+
     See the XmlLoopVariable class for more information
     """
     def __init__(self, loop_index: int,
@@ -101,10 +125,22 @@ class XMLVariableElement(XMLAbstractElement):
         self.transform_funcs = list(transform_funcs)
 
 
-    def apply_variables(self, combination):
-        self.value = combination[self.loop_index][self.variable_index]
+    def fetch_from_entity(self, entity, components, data, labels, ns, variables = None):
+        value = self.value if variables is None else self.variable_value(variables)
+        components.append(self.component)
+        data.append(InstanceElement(value=value, datatype=self.data_type))
+        labels.append(self.label)
+        return True
+
+    def variable_value(self, combination):
+        # The transform functions are applied once, to the raw loop variable
+        value = combination[self.loop_index][self.variable_index]
         for tf in self.transform_funcs:
-            self.value = tf(self.value)
+            value = tf(value)
+        return value
+
+    def apply_variables(self, combination):
+        self.value = self.variable_value(combination)
 
 
 
@@ -125,12 +161,18 @@ class XMLExtractionElement(XMLAbstractElement):
         self.transform_funcs = list(transform_funcs)
 
     def fetch_from_entity(self, entity, components, data, labels, ns):
-        node = entity.findall(self.path, ns)
+        return self._fetch_nodes(entity.findall(self.path, ns), components, data, labels)
+
+    def _paths(self):
+        return [self.path]
+
+    def _fetch_nodes(self, node, components, data, labels):
+        # Adds the values of the nodes found at path
         if len(node) == 0:
             if self.required:
                 if self.default is not None:
                     components.append(self.component)
-                    data.append(InstanceElement(value=value, datatype=self.data_type))
+                    data.append(InstanceElement(value=self.default, datatype=self.data_type))
                     labels.append(self.label)
                 elif self.allow_void:
                     components.append(self.component)
@@ -169,11 +211,19 @@ class XMLStringCombinationElement(XMLAbstractElement):
         self.paths = paths
         self.combinator_func = combinator_func
         self.required = required
+        self.sequence_join_char = sequence_join_char
 
     def fetch_from_entity(self, entity, components, data, labels, ns):
+        return self._fetch_nodes([entity.findall(path, ns) for path in self.paths], components, data, labels)
+
+    def _paths(self):
+        return list(self.paths)
+
+    def _fetch_nodes(self, nodes, components, data, labels):
+        # Combines the values of the nodes found at each of the paths
+        sequence_join_char = self.sequence_join_char
         tmp_data=[]
-        for path in self.paths:
-            node = entity.findall(path, ns)
+        for node in nodes:
             val = ''
             if len(node) == 1:
                 val = node[0].text
@@ -214,14 +264,7 @@ class XMLStringCombinationElement(XMLAbstractElement):
 
 
     def _default_combinator(self, tmp_data):
-        result = '';
-        for elem in tmp_data:
-            if len(elem) > 0:
-                if len(result) == 0:
-                    result = '{0}'.format(result, elem)
-                else:
-                    result = '{0} {1}'.format(result, elem)
-        return result
+        return ' '.join(elem for elem in tmp_data if elem is not None and len(elem) > 0)
 
 
 
@@ -246,187 +289,1003 @@ class XMLMapping:
         self.expanded_variables = []
         self.batch_size = batch_size
 
+    def map_entity(self, entity, ns={}, variables=None):
+        """
+        Map a single entity onto instance data
+
+        variables is the combination of loop variable values the entity was
+        found with, or None for a mapping without loop variables. Returns a
+        (components, data, labels, topology key) tuple, or None when neither
+        the elements nor the fallback elements could be fetched from the
+        entity.
+        """
+        result = XMLMapping.__fetch_entity(entity, self.elements, ns, variables)
+        if result is None:
+            result = XMLMapping.__fetch_entity(entity, self.fallback, ns, variables)
+        return result
+
+    def compile(self, ns={}, backend=None):
+        """
+        Compile the mapping into a specialized entity mapper
+
+        The returned callable takes an entity and optionally the combination of
+        loop variables and behaves like map_entity. It keeps no state between
+        calls, so it can be used from several threads at once. The
+        paths of all extraction and string combination elements are merged
+        into one plan, so the nodes they select are collected in a single walk
+        over the entity instead of a findall per path and element. Paths the
+        plan cannot express (predicates, '..', '//', attributes) and custom
+        element classes keep using findall.
+
+        With backend 'lxml' the paths outside the plan are compiled to XPath,
+        and the mapper only accepts lxml elements. By default findall is used,
+        which works on both ElementTree and lxml elements.
+        """
+        backend = _ElementTreeBackend() if backend is None else _xml_backend(backend)
+        elements = list(self.elements) + list(self.fallback)
+        plan = _EntityPlan([path for element in elements if type(element).fetch_from_entity in _PLANNED_FETCHES
+                                 for path in element._paths()], ns, backend)
+        primary = XMLMapping.__compile_elements(self.elements, plan, ns)
+        fallback = XMLMapping.__compile_elements(self.fallback, plan, ns)
+
+        def mapper(entity, variables=None):
+            nodes = plan.collect(entity)
+            result = primary(entity, nodes, variables)
+            if result is None:
+                result = fallback(entity, nodes, variables)
+            return result
+        return mapper
+
+    @staticmethod
+    def __compile_elements(elements, plan, ns):
+        elements = list(elements)
+        if len(elements) == 0:
+            return lambda entity, nodes, variables: None
+
+        fetches = []
+        for element in elements:
+            fetch = type(element).fetch_from_entity
+            if _binds_variables(element):
+                fetches.append(XMLMapping.__bound_fetch(element, ns))
+            elif fetch is XMLExtractionElement.fetch_from_entity:
+                fetches.append(XMLMapping.__planned_fetch(element, plan.index(element.path)))
+            elif fetch is XMLStringCombinationElement.fetch_from_entity:
+                fetches.append(XMLMapping.__planned_fetch(element, [plan.index(path) for path in element.paths]))
+            elif fetch is XMLVariableElement.fetch_from_entity:
+                fetches.append(XMLMapping.__variable_fetch(element))
+            else:
+                fetches.append(XMLMapping.__entity_fetch(element, ns))
+
+        def mapper(entity, nodes, variables):
+            components = []
+            data = []
+            labels = []
+            for fetch in fetches:
+                if fetch(entity, nodes, variables, components, data, labels) == False:
+                    return None
+            if len(components) < 2:
+                return None
+            return (components, data, labels, ','.join(map(str, components)))
+        return mapper
+
+    @staticmethod
+    def __planned_fetch(element, slots):
+        fetch_nodes = element._fetch_nodes
+        if isinstance(slots, list):
+            return lambda entity, nodes, variables, components, data, labels: fetch_nodes(
+                    [nodes[slot] for slot in slots], components, data, labels)
+        return lambda entity, nodes, variables, components, data, labels: fetch_nodes(
+                nodes[slots], components, data, labels)
+
+    @staticmethod
+    def __variable_fetch(element):
+        # All entities of a combination share the value, so the transformed
+        # value of the last combination is kept. The pair is replaced as a
+        # whole, which keeps it consistent between threads.
+        cache = [(None, None)]
+
+        def fetch(entity, nodes, variables, components, data, labels):
+            if variables is None:
+                value = element.value
+            else:
+                cached = cache[0]
+                if cached[0] is variables:
+                    value = cached[1]
+                else:
+                    value = element.variable_value(variables)
+                    cache[0] = (variables, value)
+            components.append(element.component)
+            data.append(InstanceElement(value=value, datatype=element.data_type))
+            labels.append(element.label)
+            return True
+        return fetch
+
+    @staticmethod
+    def __bound_fetch(element, ns):
+        # Custom elements that take the combination through apply_variables
+        # are bound on a copy per combination, the copy of the last
+        # combination is kept
+        unbound = XMLMapping.__entity_fetch(element, ns)
+        cache = [(None, None)]
+
+        def fetch(entity, nodes, variables, components, data, labels):
+            bound = unbound
+            if variables is not None:
+                cached = cache[0]
+                if cached[0] is variables:
+                    bound = cached[1]
+                else:
+                    bound = XMLMapping.__entity_fetch(_bind_variables(element, variables), ns)
+                    cache[0] = (variables, bound)
+            return bound(entity, nodes, variables, components, data, labels)
+        return fetch
+
+    @staticmethod
+    def __entity_fetch(element, ns):
+        fetch = element.fetch_from_entity
+        if isinstance(element, XMLVariableElement):
+            return lambda entity, nodes, variables, components, data, labels: fetch(
+                    entity, components, data, labels, ns, variables)
+        return lambda entity, nodes, variables, components, data, labels: fetch(entity, components, data, labels, ns)
+
+    @staticmethod
+    def __fetch_entity(entity, elements, ns, variables=None):
+        if len(elements) == 0:
+            return None
+
+        components = []
+        data = []
+        labels = []
+        # Loop over all elements and fetch them from the entity
+        for element in elements:
+            if variables is not None and _binds_variables(element):
+                element = _bind_variables(element, variables)
+            if isinstance(element, XMLVariableElement):
+                fetched = element.fetch_from_entity(entity, components, data, labels, ns, variables)
+            else:
+                fetched = element.fetch_from_entity(entity, components, data, labels, ns)
+            if fetched == False:
+                return None
+
+        if len(components) < 2:
+            return None
+        return (components, data, labels, ','.join(map(str, components)))
+
 
 class XMLLoader:
+    """
+    XML loader
+
+    A loader created with parse or fromstring holds the whole document tree.
+    A loader created with stream reads the document incrementally while it
+    runs: every element that matches the root_path of a mapping is mapped as
+    soon as it is complete and then removed from the tree, so memory use is
+    bounded by the size of an entity rather than the document. Streaming
+    supports root paths made of tags, '*' and '//' steps, without predicates
+    or loop variables.
+
+    The backend selects the xml library: 'etree' for xml.etree.ElementTree or
+    'lxml'. With lxml, documents are parsed by libxml2 and the root paths,
+    loop variable paths and the element paths that are not collected in a
+    single walk are compiled once to XPath expressions; paths that have no
+    XPath equivalent use lxml's findall. By default lxml is used when it is
+    installed, or for a root_node that is an lxml element. Comments and
+    processing instructions are left out of parsed documents with either
+    backend.
+
+    lxml keeps libxml2's limits on the nesting depth and the size of text
+    nodes, which protect against malicious documents. huge_tree lifts them
+    for trusted documents that exceed them.
+    """
     def __init__(self, root_node: ET.Element,
                        mappings: Sequence[XMLMapping] = [],
-                       namespaces={}):
+                       namespaces={},
+                       backend=None,
+                       huge_tree=False):
         self.root_node = root_node
         self.mappings = list(mappings)
         self.ns = namespaces
+        self.source = None
+        if backend is None and root_node is not None:
+            backend = 'lxml' if _lxml_etree is not None and isinstance(root_node, _lxml_etree._Element) else 'etree'
+        self.backend = _xml_backend(backend, huge_tree)
 
     @classmethod
-    def parse(cls, xml_file: str, mappings: Sequence[XMLMapping] = [], namespaces={}):
-        return cls(ET.parse(xml_file).getroot(), mappings, namespaces)
+    def parse(cls, xml_file: str, mappings: Sequence[XMLMapping] = [], namespaces={}, backend=None,
+                   huge_tree=False):
+        backend = _xml_backend(backend, huge_tree)
+        return cls(backend.parse(xml_file), mappings, namespaces, backend)
 
     @classmethod
-    def fromstring(cls, xml_string: str):
-        return cls(ET.fromstring(xml_string))
+    def stream(cls, xml_file, mappings: Sequence[XMLMapping] = [], namespaces={}, backend=None,
+                    huge_tree=False):
+        """Create a loader that streams xml_file, a path or binary file object, when it runs"""
+        loader = cls(None, mappings, namespaces, backend, huge_tree)
+        loader.source = xml_file
+        return loader
+
+    @classmethod
+    def fromstring(cls, xml_string: str, backend=None, huge_tree=False):
+        backend = _xml_backend(backend, huge_tree)
+        return cls(backend.fromstring(xml_string), backend=backend)
 
     def add_mapping(self, mapping: XMLMapping):
-        self.elements.append(mapping)
+        self.mappings.append(mapping)
 
-    def run(self, connection: DynizerConnection, debug=False):
-        try:
-            if connection is not None:
-                connection.connect()
+    def run(self, connection: DynizerConnection, debug=False,
+                  pipeline=False, upload_workers=2, queue_size=8,
+                  registry=None, prescan=False, prescan_workers=4,
+                  progress=None, rejects=None, dedup=None, workers=1,
+                  sink: Sink = None):
+        """
+        Load the xml document into the Dynizer
+
+        With pipeline enabled, batches are uploaded by upload_workers threads,
+        each on their own connection, while the next entities are mapped. At
+        most queue_size batches wait for upload before mapping blocks. A
+        streamed document also gets a reader stage: a separate thread parses
+        and maps the entities and hands them over in chunks, at most
+        queue_size chunks ahead. A parsed document is read before run, so it
+        only gets the upload stage.
+
+        Actions and topologies are resolved through registry, a
+        TopologyRegistry that can be shared between loaders and persisted
+        between runs. Without one a fresh in memory registry is used.
+
+        With prescan enabled the entities are mapped once up front to collect
+        the distinct topologies of every mapping, which are then resolved with
+        prescan_workers concurrent requests before any instance is loaded. A
+        number instead of True only samples that many entities per mapping;
+        topologies missed by the sample are resolved when they are met.
+
+        progress takes a ProgressReporter (such as ConsoleReporter), a function
+        or a list of them, which receive periodic snapshots with the entity and
+        instance throughput, batch counts and the time spent per stage. The
+        final snapshot is returned.
+
+        rejects takes a path or a RejectFile. When given, entities whose
+        mapping raises an error and instances the server rejects are written
+        to it with the serialized entity and the error, and loading continues.
+        Rejected batches are bisected to single out the offending instances.
+
+        dedup drops instances identical to one loaded before in this run (same
+        action, topology and data values): True for an in memory
+        FingerprintSet, a number to bound its size, or a Deduplicator such as
+        a spilling FingerprintSet or a BloomFilter. The number of dropped
+        duplicates is reported in the snapshot.
+
+        With more than one worker, the loop variable combinations of a mapping
+        are mapped in parallel by a pool of workers processes. The instances
+        of all combinations are merged in order into the batches of the
+        mapping, and topologies, deduplication and uploads stay in the calling
+        process. Mappings without loop variables and streamed documents are
+        mapped in the calling process. The mapped instances are sent back to
+        the calling process, so workers pay off when mapping an entity costs
+        more than that, e.g. with expensive transform functions. Worker
+        processes are forked, so on platforms without fork the loader, with
+        its document and mappings (including transform functions), must be
+        picklable, which lxml documents are not.
+
+        sink replaces the Dynizer as the destination of the instances, e.g. a
+        SpoolSink that writes them to a file for a later replay. Without a
+        connection the instances are mapped and counted by a DryRunSink.
+        """
+        if self.root_node is None:
             for mapping in self.mappings:
-                self.__run_mapping(connection, mapping, debug)
-            if connection is not None:
-                connection.close()
-        except Exception as e:
-            if connection is not None:
-                connection.close()
-            raise e
-
-
-    def __expand_variables(self, root, mapping, variable):
-        elements = root.findall(variable.path, self.ns)
-        values = []
-        for elem in elements:
-            v_values = []
-            for v_path in variable.variable_path:
-                var_elem = elem.findall(v_path, self.ns)
-                v_values.append(list(map(lambda x: x.text, var_elem)))
-            values = values + list(itertools.product(*v_values))
-        mapping.expanded_variables.append(values)
-
+                _StreamPath(mapping.root_path, self.ns, mapping.variables)
+        sink = default_sink(connection, sink, registry, upload_workers if pipeline else 0, queue_size)
+        engine = LoaderEngine(XMLLoader, sink, progress=progress, rejects=rejects, dedup=dedup, debug=debug)
+        return engine.run(lambda engine: self.__load(engine, prescan, prescan_workers, workers,
+                                                     pipeline, queue_size))
+
+
+    def __load(self, engine: LoaderEngine, prescan, prescan_workers, workers, pipeline, queue_size):
+        states = [engine.bind(mapping, mapping.compile(self.ns, self.backend)) for mapping in self.mappings]
+        if self.root_node is None:
+            if prescan:
+                print('Prescan requires a parsed document, skipping prescan')
+            self.__run_stream(engine, states, pipeline, queue_size)
+        else:
+            if prescan and engine.sink.resolves_topologies:
+                self.__prescan(engine, states, prescan, prescan_workers)
+            for state in states:
+                self.__run_mapping(engine, state, workers)
+
+
+    def __prescan(self, engine: LoaderEngine, states, prescan, workers):
+        def samples():
+            for state in states:
+                entities = self.__entities(state.mapping)
+                if prescan is not True:
+                    entities = itertools.islice(entities, prescan)
+                for entity, variables in entities:
+                    yield state, (entity, variables)
+        engine.prescan(samples(), workers)
+
+
+    def __combinations(self, mapping: XMLMapping):
+        # Yields (combination, entities) pairs. Without loop variables all
+        # entities come in a single pair with a None combination.
+        if len(mapping.variables) == 0:
+            # No loopvariables are present
+            yield None, self.__find_entities(mapping.root_path)
+        else:
+            # We have loop variables, only the combinations that match entities are produced
+            yield from _LoopExpansion(mapping, self.ns, self.backend).expand(self.root_node)
 
-    def __run_mapping(self, connection: DynizerConnection,
-                            mapping: XMLMapping,
-                            debug):
 
-        print('Creating instances for: {0}'.format( mapping.action.name))
-        action_obj = None
-        if connection is not None:
-            try:
-                action_obj = connection.create(mapping.action)
-            except Exception as e:
-                raise LoaderError(XMLLoader, "Failed to create required action: '{0}'".format(mapping.action))
+    def __entities(self, mapping: XMLMapping):
+        # Yields (entity, combination) pairs of the mapping
+        for combination, entities in self.__combinations(mapping):
+            for entity in entities:
+                yield entity, combination
 
-        topology_map = {}
-        loadlist = []
 
-        if len(mapping.variables) == 0:
-            # No loopvariables are present
-            self.__run_simple_mapping(connection, mapping, mapping.root_path, action_obj, topology_map, loadlist, debug)
-        else:
-            # We have loop variables, resolve them
-            for variable in mapping.variables:
-                self.__expand_variables(self.root_node, mapping, variable)
-
-            # Make the combinations of the various loop variables and iterate over them
-            var_combinations = list(itertools.product(*mapping.expanded_variables))
-            for combination in var_combinations:
-                # Adjust the root path with the requested loop variables
-                current_root = mapping.root_path.format(*combination)
-                for elem in mapping.elements:
-                    # Apply the current variables to the XMLVariableElements
-                    elem.apply_variables(combination)
-                for elem in mapping.fallback:
-                    elem.apply_variables(combination)
-
-                self.__run_simple_mapping(connection, mapping, current_root, action_obj, topology_map, loadlist, debug)
-
-        if len(loadlist) > 0:
-            self.__push_batch(connection, loadlist)
-
-
-    def __run_simple_mapping(self, connection: DynizerConnection,
-                                   mapping: XMLMapping,
-                                   root_path: str,
-                                   action_obj, topology_map, loadlist,
-                                   debug):
+    def __find_entities(self, root_path: str):
         # Fetch the root node
         root = None
 
         try:
-            root = self.root_node.findall(root_path, self.ns)
+            root = self.backend.compile_path(root_path, self.ns)(self.root_node)
         except Exception as e:
             print(root_path)
             raise e
         if len(root) == 0:
             raise LoaderError(XMLLoader, "Invalid xpath specified for root path: '{0}'".format(root_path))
-
-        # Loop over all entities in the root node and parse the entities
-        for entity in root:
-            status = self.__run_mapping_on_entity(entity, topology_map, loadlist, action_obj, connection, mapping, debug = debug)
-            if not status:
-                self.__run_mapping_on_entity(entity, topology_map, loadlist, action_obj, connection, mapping, fallback=True, debug = debug)
-
-
-        if len(loadlist) >= mapping.batch_size:
-            self.__push_batch(connection, loadlist)
-
-
-
-    def __run_mapping_on_entity(self, entity, topology_map, loadlist,
-                                      action_obj: Action,
-                                      connection: DynizerConnection,
-                                      mapping: XMLMapping,
-                                      fallback = False,
-                                      debug = False):
-        components = []
-        data = []
-        labels = []
-        elements = mapping.fallback if fallback else mapping.elements
-        if len(elements) == 0:
-            return False
-
-        # Loop over all elements and fetch them fro mthe entity
-        for element in elements:
-            if element.fetch_from_entity(entity, components, data, labels, self.ns) == False:
-                return False
-
-        if len(components) < 2:
-            return False
-
-        if debug:
-            inst = Instance(action_id=0, topology_id=0, data=data)
-            print(inst.to_json())
-
-
-
-        if connection is None:
-            return True
-
-        # Build the topology
-        top_map_key = ','.join(map(str, components))
-        topology_obj = None
-        if top_map_key in topology_map:
-            topology_obj = topology_map[top_map_key]
+        return root
+
+
+    def __run_mapping(self, engine: LoaderEngine, state, workers = 1):
+        # Loop over all entities of the mapping and parse the entities
+        if workers > 1 and len(state.mapping.variables) > 0:
+            for result in self.__map_combinations(engine, state, workers):
+                self.__load_result(engine, state, result)
+            return
+        for entity, combination in engine.metrics.timed_iter(self.__entities(state.mapping), 'parse'):
+            engine.metrics.row()
+            engine.map(state, lambda: self.backend.tostring(entity), entity, combination)
+
+
+    def __run_stream(self, engine: LoaderEngine, states, pipeline = False, queue_size = 8):
+        # A single incremental pass over the document serves all mappings.
+        # Entities are dropped from the tree as the stream moves on, so with
+        # pipeline the reader thread maps them as well and hands over chunks
+        # of results.
+        if not pipeline:
+            for i, elem in self.__stream_entities(engine.metrics):
+                engine.metrics.row()
+                engine.map(states[i], lambda: self.backend.tostring(elem), elem, None)
+            return
+
+        def results():
+            for i, elem in self.__stream_entities(engine.metrics):
+                state = states[i]
+                yield state, self.__map_entity(state.mapper, elem, None, state.rejects is not None)
+
+        chunks = threaded_iter(chunked(results(), _MAP_CHUNK_ENTITIES), queue_size)
+        try:
+            for chunk in chunks:
+                for state, result in chunk:
+                    self.__load_result(engine, state, result)
+        finally:
+            chunks.close()
+
+
+    def __load_result(self, engine: LoaderEngine, state, result):
+        mapped, source, error = result
+        engine.metrics.row()
+        if error is not None:
+            engine.reject(state, source, error)
         else:
-            # Check if we have it in the system
-            if topology_obj is None:
-                try:
-                    topology = Topology(components=components, labels=labels)
-                    topology_obj = connection.create(topology)
-                    topology_obj.labels = labels
-                except Exception as e:
-                    raise LoaderError(XMLLoader, "Failed to create topology: '{0}'".format(top_map_key))
-
-            # Also make sure it is linked to the action
-            try:
-                connection.link_actiontopology(action_obj, topology_obj)
-            except Exception as e:
-                print("Failed to link action and topology.")
-
-            topology_map[top_map_key] = topology_obj
-
-        # Create the instance and push it onto the load list
-        inst = Instance(action_id=action_obj.id, topology_id=topology_obj.id, data=data)
-        loadlist.append(inst)
+            engine.load(state, mapped, source=source)
+
+
+    def __stream_entities(self, metrics: LoaderMetrics = None):
+        # Yields (mapping index, entity) for every element that matches the
+        # root path of a mapping, in document order. The entity is removed
+        # from the tree once the next one is requested.
+        paths = [_StreamPath(mapping.root_path, self.ns) for mapping in self.mappings]
+        matches = {}
+        with self.__open_stream(metrics) as xml_file:
+            stack = []
+            tags = []
+            open_entities = 0
+            events = self.backend.iterparse(xml_file, ('start', 'end'))
+            if metrics is not None:
+                events = metrics.timed_iter(events, 'parse')
+            for event, elem in events:
+                if event == 'start':
+                    if len(stack) > 0:
+                        tags.append(elem.tag)
+                    key = tuple(tags)
+                    found = matches.get(key)
+                    if found is None:
+                        found = matches[key] = [i for i, path in enumerate(paths) if path.matches(key)]
+                    stack.append((elem, found))
+                    if len(found) > 0:
+                        open_entities += 1
+                    continue
+
+                elem, found = stack.pop()
+                if len(found) > 0:
+                    open_entities -= 1
+                    for i in found:
+                        yield i, elem
+                if len(stack) > 0:
+                    tags.pop()
+                    if open_entities == 0:
+                        # No open entity contains the element, so it can be dropped.
+                        # Earlier siblings are gone already, which keeps remove() cheap.
+                        elem.clear()
+                        stack[-1][0].remove(elem)
+
+
+    def __streamable(self):
+        try:
+            for mapping in self.mappings:
+                _StreamPath(mapping.root_path, self.ns, mapping.variables)
+        except LoaderError:
+            return False
         return True
 
 
-
-    def __push_batch(self, connection: DynizerConnection,
-                           batch: Sequence[Instance]):
-        if connection is not None:
-            print("Writing batch ...")
+    @contextlib.contextmanager
+    def __open_stream(self, metrics: LoaderMetrics):
+        source = self.source
+        if not isinstance(source, (str, os.PathLike)):
+            yield source
+            return
+        with open(source, 'rb') as xml_file:
+            if metrics is None:
+                yield xml_file
+                return
+            metrics.position = xml_file.tell
+            metrics.total_bytes = os.path.getsize(source)
             try:
-                connection.batch_create(batch)
-                batch.clear()
-            except Exception as e:
-                raise LoaderError(XMLLoader, "Failed to push batch of instances")
-
+                yield xml_file
+            finally:
+                offset = xml_file.tell()
+                metrics.position = lambda: offset
+
+
+    def _map_chunks(self, quarantine = False):
+        # Runs for a DirectoryLoader file, yields the results of chunks of
+        # entities in the shape of CSVLoader._map_range: the entity count and
+        # (mapping index, mapped entity, source, error) tuples. Streamable
+        # mappings are mapped while the document streams, others on the parsed
+        # document. Errors are only kept when quarantining.
+        loader = self
+        if self.root_node is None and not self.__streamable():
+            loader = XMLLoader.parse(self.source, self.mappings, self.ns, self.backend)
+        mappers = [mapping.compile(loader.ns, loader.backend) for mapping in loader.mappings]
+        if loader.root_node is None:
+            entities = ((i, entity, None) for i, entity in loader.__stream_entities())
+        else:
+            entities = ((i, entity, combination) for i, mapping in enumerate(loader.mappings)
+                                                 for entity, combination in loader.__entities(mapping))
+        result = []
+        entity_count = 0
+        for mapping_index, entity, combination in entities:
+            entity_count += 1
+            mapped, source, error = loader.__map_entity(mappers[mapping_index], entity, combination, quarantine)
+            if error is not None:
+                result.append((mapping_index, None, source, describe_error(error)))
+            elif mapped is not None:
+                result.append((mapping_index, mapped, source, None))
+            if entity_count == _MAP_CHUNK_ENTITIES:
+                yield (entity_count, result, None)
+                result = []
+                entity_count = 0
+        if entity_count > 0:
+            yield (entity_count, result, None)
+
+
+    def __map_combinations(self, engine: LoaderEngine, state, workers):
+        # Maps the combinations of the mapping in a pool of worker processes
+        # and yields their results in combination order. The combinations are
+        # expanded lazily in the calling process; each task holds consecutive
+        # combinations with about _MAP_CHUNK_ENTITIES entities, which are sent
+        # by their address in the document. At most 2 * workers tasks are
+        # mapped ahead of the results that were consumed.
+        mapping_index = self.mappings.index(state.mapping)
+        quarantine = state.rejects is not None
+        addresses = _ElementAddresses(self.root_node)
+
+        def tasks():
+            task = []
+            entity_count = 0
+            combinations = engine.metrics.timed_iter(self.__combinations(state.mapping), 'parse')
+            for combination, entities in combinations:
+                task.append((combination, [addresses.address(entity) for entity in entities]))
+                entity_count += len(entities)
+                if entity_count >= _MAP_CHUNK_ENTITIES:
+                    yield mapping_index, task, quarantine
+                    task = []
+                    entity_count = 0
+            if len(task) > 0:
+                yield mapping_index, task, quarantine
+
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=_worker_context(),
+                                 initializer=_init_xml_worker,
+                                 initargs=(self,)) as executor:
+            for results in ordered_map(executor, _map_xml_combinations, tasks(), 2 * workers):
+                yield from results
+
+
+    def _map_combinations(self, mapping_index, task, quarantine = False):
+        # Runs inside a worker process, returns the (mapped, source, error)
+        # results of the entities of the (combination, entity addresses) pairs
+        # of task. Errors are only kept, as descriptions, when quarantining.
+        mapper = _worker_mappers.get(mapping_index)
+        if mapper is None:
+            mapper = _worker_mappers[mapping_index] = self.mappings[mapping_index].compile(self.ns, self.backend)
+        results = []
+        for combination, entity_addresses in task:
+            for address in entity_addresses:
+                entity = _ElementAddresses.element(self.root_node, address)
+                mapped, source, error = self.__map_entity(mapper, entity, combination, quarantine)
+                results.append((mapped, source, describe_error(error) if error is not None else None))
+        return results
+
+
+    def __map_entity(self, map_entity, entity, combination, quarantine):
+        # Returns (mapped, source, error); errors are only caught when they
+        # are quarantined, which also requires the serialized entity
+        if not quarantine:
+            return map_entity(entity, combination), None, None
+        source = self.backend.tostring(entity)
+        try:
+            return map_entity(entity, combination), source, None
+        except Exception as e:
+            return None, source, e
+
+
+
+_MAP_CHUNK_ENTITIES = 1000
+
+def _binds_variables(element):
+    # Whether the class of element overrides apply_variables to receive the
+    # loop variable combination, as elements did before combinations were
+    # passed to fetch_from_entity
+    apply_variables = type(element).apply_variables
+    return (apply_variables is not XMLAbstractElement.apply_variables and
+            apply_variables is not XMLVariableElement.apply_variables)
+
+def _bind_variables(element, combination):
+    # A copy of element with the combination applied, the mapping's element is left untouched
+    bound = copy.copy(element)
+    bound.apply_variables(combination)
+    return bound
+
+_worker_xml_loader = None
+_worker_mappers = {}
+
+def _init_xml_worker(loader):
+    global _worker_xml_loader
+    _worker_xml_loader = loader
+    _worker_mappers.clear()
+
+def _map_xml_combinations(mapping_index, task, quarantine):
+    return _worker_xml_loader._map_combinations(mapping_index, task, quarantine)
+
+
+
+class _ElementAddresses:
+    # Addresses the elements of a parsed document by the child indices from
+    # the root to the element, which stay valid in forked worker processes.
+    # lxml elements know their parent; for ElementTree the parents are
+    # indexed once on first use. The child positions are indexed per parent.
+    def __init__(self, root):
+        self.root = root
+        self.parents = None
+        self.positions = {}
+
+    def address(self, elem):
+        path = []
+        while elem is not self.root:
+            parent = self.__parent(elem)
+            positions = self.positions.get(parent)
+            if positions is None:
+                positions = self.positions[parent] = dict((child, i) for i, child in enumerate(parent))
+            path.append(positions[elem])
+            elem = parent
+        path.reverse()
+        return tuple(path)
+
+    def __parent(self, elem):
+        if hasattr(elem, 'getparent'):
+            return elem.getparent()
+        if self.parents is None:
+            self.parents = dict((child, parent) for parent in self.root.iter() for child in parent)
+        return self.parents[elem]
+
+    @staticmethod
+    def element(root, address):
+        elem = root
+        for i in address:
+            elem = elem[i]
+        return elem
+
+_PLANNED_FETCHES = (
+    XMLAbstractElement.fetch_from_entity,
+    XMLExtractionElement.fetch_from_entity,
+    XMLStringCombinationElement.fetch_from_entity
+)
+
+def _split_path(path: str):
+    # Split an ElementPath on '/' outside '{uri}' parts, after dropping a
+    # leading './'. An empty step stands for '//'.
+    if path.startswith('./'):
+        path = path[2:]
+    if path in ('', '.'):
+        return []
+    steps = []
+    step = ''
+    in_uri = False
+    for c in path:
+        if c == '/' and not in_uri:
+            steps.append(step)
+            step = ''
+            continue
+        if c == '{':
+            in_uri = True
+        elif c == '}':
+            in_uri = False
+        step += c
+    steps.append(step)
+    return steps
+
+def _qualify(tag: str, ns):
+    # Resolve 'prefix:tag' and the default namespace to '{uri}tag'
+    if tag.startswith('{') or tag == '*':
+        return tag
+    if ':' in tag:
+        prefix, name = tag.split(':', 1)
+        if prefix not in ns:
+            raise LoaderError(XMLLoader, "Unknown namespace prefix: '{0}'".format(prefix))
+        return '{{{0}}}{1}'.format(ns[prefix], name)
+    if ns.get('', '') != '':
+        return '{{{0}}}{1}'.format(ns[''], tag)
+    return tag
+
+
+
+class _ElementTreeBackend:
+    # xml.etree.ElementTree parsing and ElementPath
+    name = 'etree'
+
+    def parse(self, source):
+        return ET.parse(source).getroot()
+
+    def fromstring(self, text):
+        return ET.fromstring(text)
+
+    def iterparse(self, source, events):
+        return ET.iterparse(source, events=events)
+
+    def tostring(self, elem):
+        return ET.tostring(elem, encoding='unicode')
+
+    def compile_path(self, path, ns):
+        # Returns a function that selects the nodes of path from a node
+        return lambda node: node.findall(path, ns)
+
+class _LxmlBackend:
+    # lxml parsing with paths compiled to XPath. The parser drops comments and
+    # processing instructions like ElementTree does.
+    name = 'lxml'
+
+    def __init__(self, huge_tree=False):
+        self.huge_tree = huge_tree
+        self.parser = _lxml_etree.XMLParser(remove_comments=True, remove_pis=True, huge_tree=huge_tree)
+
+    def parse(self, source):
+        return _lxml_etree.parse(source, self.parser).getroot()
+
+    def fromstring(self, text):
+        if isinstance(text, str):
+            # lxml refuses unicode strings with an encoding declaration, which
+            # ElementTree ignores
+            text = _XML_DECLARATION.sub('', text, count=1)
+        return _lxml_etree.fromstring(text, self.parser)
+
+    def iterparse(self, source, events):
+        return _lxml_etree.iterparse(source, events=events, remove_comments=True,
+                                     remove_pis=True, huge_tree=self.huge_tree)
+
+    def tostring(self, elem):
+        return _lxml_etree.tostring(elem, encoding='unicode')
+
+    def compile_path(self, path, ns):
+        translated = _to_xpath(path, ns)
+        if translated is not None:
+            try:
+                return _lxml_etree.XPath(translated[0], namespaces=translated[1])
+            except _lxml_etree.XPathSyntaxError as e:
+                pass
+        return lambda node: node.findall(path, ns)
+
+def _xml_backend(backend, huge_tree=False):
+    # Resolve the backend argument of the xml loader: None for lxml when it
+    # is installed, 'lxml', 'etree' or a backend object. huge_tree only
+    # applies to lxml, ElementTree has no such limits
+    if backend is None:
+        backend = 'lxml' if _lxml_etree is not None else 'etree'
+    if not isinstance(backend, str):
+        return backend
+    if backend == 'etree':
+        return _ElementTreeBackend()
+    if backend == 'lxml':
+        if _lxml_etree is None:
+            raise LoaderError(XMLLoader, "The lxml backend requires the lxml package")
+        return _LxmlBackend(huge_tree)
+    raise LoaderError(XMLLoader, "Unknown xml backend: '{0}'".format(backend))
+
+_XML_DECLARATION = re.compile(r'^\s*<\?xml[^>]*\?>')
+_PATH_STEP = re.compile(r'^((?:\{[^}]*\})?[^\[]+)((?:\[(?:[^\]\'"]|\'[^\']*\'|"[^"]*")*\])*)$')
+_PATH_PREDICATE = re.compile(r'\[((?:[^\]\'"]|\'[^\']*\'|"[^"]*")*)\]')
+_TAG_PREDICATE = re.compile(r'^\s*((?:\{[^}]*\})?[A-Za-z_][\w.:-]*)\s*((?:!?=).*)?$')
+
+def _to_xpath(path: str, ns):
+    # Translate an ElementPath to an XPath expression and its prefix mapping,
+    # or return None when it has no direct equivalent. XPath has no default
+    # namespace and no '{uri}tag' names, so those tags get generated prefixes.
+    if path.startswith('/') or '{*}' in path:
+        return None
+    prefixes = dict((prefix, uri) for prefix, uri in ns.items() if prefix)
+    generated = {}
+
+    def name(tag):
+        uri = None
+        if tag.startswith('{'):
+            uri, tag = tag[1:].split('}', 1)
+        elif ':' not in tag and tag not in ('*', '.', '..'):
+            uri = ns.get('')
+        if not uri:
+            return tag
+        if uri not in generated:
+            generated[uri] = '_ns{0}'.format(len(generated))
+            prefixes[generated[uri]] = uri
+        return '{0}:{1}'.format(generated[uri], tag)
+
+    steps = []
+    for step in _split_path(path):
+        if step == '':
+            steps.append(step)
+            continue
+        match = _PATH_STEP.match(step)
+        if match is None:
+            return None
+        xpath_step = name(match.group(1))
+        for predicate in _PATH_PREDICATE.findall(match.group(2)):
+            tag = _TAG_PREDICATE.match(predicate)
+            if tag is not None:
+                predicate = name(tag.group(1)) + (tag.group(2) or '')
+            xpath_step += '[{0}]'.format(predicate)
+        steps.append(xpath_step)
+    if len(steps) == 0:
+        return '.', prefixes
+    if steps[-1] == '':
+        return None
+    return './' + '/'.join(steps), prefixes
+
+
+class _EntityPlan:
+    # Collects the nodes of many entity relative paths in one walk over an
+    # entity. The simple paths (child steps by tag or '*') form a trie that is
+    # matched against the children while walking; other paths use findall.
+    # collect() returns the node lists indexed by index(path).
+    def __init__(self, paths, ns, backend):
+        self.ns = ns
+        self.slots = {}
+        self.trie = {}
+        self.findall_paths = []
+        for path in paths:
+            if path in self.slots:
+                continue
+            slot = len(self.slots)
+            self.slots[path] = slot
+            steps = _EntityPlan.__simple_steps(path, ns)
+            if steps is None:
+                self.findall_paths.append((slot, backend.compile_path(path, ns)))
+                continue
+            node = self.trie
+            for i, step in enumerate(steps):
+                child = node.setdefault(step, ({}, []))
+                if i == len(steps) - 1:
+                    child[1].append(slot)
+                node = child[0]
+
+    def index(self, path):
+        return self.slots[path]
+
+    def collect(self, entity):
+        nodes = [[] for i in range(len(self.slots))]
+        if len(self.trie) > 0:
+            _EntityPlan.__walk(entity, self.trie, nodes)
+        for slot, find in self.findall_paths:
+            nodes[slot] = find(entity)
+        return nodes
+
+    @staticmethod
+    def __walk(elem, trie, nodes):
+        wildcard = trie.get('*')
+        for child in elem:
+            for match in (trie.get(child.tag), wildcard):
+                if match is None:
+                    continue
+                children, slots = match
+                for slot in slots:
+                    nodes[slot].append(child)
+                if len(children) > 0:
+                    _EntityPlan.__walk(child, children, nodes)
+
+    @staticmethod
+    def __simple_steps(path, ns):
+        steps = _split_path(path)
+        if len(steps) == 0:
+            return None
+        for step in steps:
+            if step in ('', '.', '..') or '[' in step or step.startswith('@'):
+                return None
+        return [_qualify(step, ns) for step in steps]
+
+
+
+_PLACEHOLDER = re.compile(r'\{(\d+)\[(\d+)\]\}')
+_TEMPLATED_STEP = re.compile(r'^([^\[]+)((?:\[(?:[^\]{]|\{\d+\[\d+\]\})*\])+)$')
+_VARIABLE_PREDICATE = re.compile(r'\[\s*([^=\]]+?)\s*=\s*([\'"])\{(\d+)\[(\d+)\]\}\2\s*\]')
+
+class _LoopExpansion:
+    # Expands the loop variables of a mapping into (combination, entities)
+    # pairs, generated lazily and only for combinations that match entities.
+    #
+    # When every placeholder of the root path sits in a predicate that selects
+    # a loop variable's nodes by its own values, e.g. with a variable on
+    # './country' with variable path './name':
+    #     ./country[name='{0[0]}']/city
+    # the nodes of each variable are indexed once by their values, nested
+    # variables only within the nodes of the enclosing combination, and the
+    # entities are found relative to the indexed nodes. Other root paths fall
+    # back to formatting the path for each combination and searching from the
+    # root, skipping the combinations without entities.
+    def __init__(self, mapping: XMLMapping, ns, backend = None):
+        self.mapping = mapping
+        self.ns = ns
+        self.backend = _ElementTreeBackend() if backend is None else backend
+        self.finders = {}
+        self.chain, self.rest = _LoopExpansion.__plan(mapping.root_path, mapping.variables)
+
+    def expand(self, root):
+        variables = self.mapping.variables
+        if self.chain is None:
+            yield from self.__expand_formatted(root)
+            return
+        chained = set(level[0] for level in self.chain)
+        free = [i for i in range(len(variables)) if i not in chained]
+        free_values = [self.__values(root, variables[i]) for i in free]
+        find_rest = self.__finder(self.rest) if self.rest is not None else None
+        for combination, nodes in self.__expand_chain(0, [root], [None] * len(variables)):
+            entities = nodes if find_rest is None else [e for node in nodes for e in find_rest(node)]
+            if len(entities) == 0:
+                continue
+            for values in itertools.product(*free_values):
+                for i, value in zip(free, values):
+                    combination[i] = value
+                yield tuple(combination), entities
+
+    def __expand_chain(self, level, contexts, combination):
+        if level == len(self.chain):
+            yield combination, contexts
+            return
+        index, path = self.chain[level]
+        variable = self.mapping.variables[index]
+        nodes_by_value = {}
+        find = self.__finder(path)
+        for context in contexts:
+            for node in find(context):
+                for value in self.__node_values(node, variable):
+                    nodes_by_value.setdefault(value, []).append(node)
+        for value, nodes in nodes_by_value.items():
+            combination[index] = value
+            yield from self.__expand_chain(level + 1, nodes, combination)
+
+    def __expand_formatted(self, root):
+        variables = self.mapping.variables
+        values = [self.__values(root, variable) for variable in variables]
+        for combination in itertools.product(*values):
+            entities = root.findall(self.mapping.root_path.format(*combination), self.ns)
+            if len(entities) > 0:
+                yield combination, entities
+
+    def __values(self, root, variable):
+        # The distinct value tuples of a variable in document order
+        values = {}
+        for node in self.__finder(variable.path)(root):
+            for value in self.__node_values(node, variable):
+                values[value] = True
+        return list(values)
+
+    def __node_values(self, node, variable):
+        texts = [[elem.text for elem in self.__finder(v_path)(node)] for v_path in variable.variable_path]
+        return itertools.product(*texts)
+
+    def __finder(self, path):
+        # The root path formatted per combination keeps using findall, the
+        # fixed paths are compiled once by the backend
+        find = self.finders.get(path)
+        if find is None:
+            find = self.finders[path] = self.backend.compile_path(path, self.ns)
+        return find
+
+    @staticmethod
+    def __plan(root_path, variables):
+        # Returns ([(variable index, path relative to the previous level)], rest),
+        # or (None, None) when the root path can not be resolved through an index
+        steps = _split_path(root_path)
+        chain = []
+        plain = []
+        start = 0
+        for position, step in enumerate(steps):
+            if '{' not in step:
+                plain.append(step)
+                continue
+            match = _TEMPLATED_STEP.match(step)
+            if match is None:
+                return None, None
+            tag, predicates = match.groups()
+            found = _VARIABLE_PREDICATE.findall(predicates)
+            if ''.join(m.group(0) for m in _VARIABLE_PREDICATE.finditer(predicates)) != predicates:
+                return None, None
+            indices = set(int(f[2]) for f in found)
+            if len(indices) != 1:
+                return None, None
+            index = indices.pop()
+            if index >= len(variables) or index in (level[0] for level in chain):
+                return None, None
+            variable = variables[index]
+            plain.append(tag)
+            if '/'.join(plain) != '/'.join(_split_path(variable.path)):
+                return None, None
+            referenced = dict((int(f[3]), f[0]) for f in found)
+            if (len(found) != len(variable.variable_path) or len(referenced) != len(found) or
+                    any(j not in referenced or _split_path(referenced[j]) != _split_path(v_path)
+                        for j, v_path in enumerate(variable.variable_path))):
+                return None, None
+            chain.append((index, './' + '/'.join(steps[start:position] + [tag])))
+            start = position + 1
+
+        if len(chain) == 0 or _PLACEHOLDER.search(root_path) is None:
+            return None, None
+        rest = steps[start:]
+        return chain, ('./' + '/'.join(rest)) if len(rest) > 0 else None
+
+
+
+class _StreamPath:
+    # Matches the tags from the document root to an element against a root
+    # path while streaming. Only the subset of ElementPath without predicates
+    # is supported: tags (with namespace prefixes), '*' and '//'.
+    def __init__(self, root_path: str, ns, variables = ()):
+        if len(variables) > 0:
+            raise LoaderError(XMLLoader, "Streaming does not support loop variables: '{0}'".format(root_path))
+        if '[' in root_path or root_path.startswith('/'):
+            raise LoaderError(XMLLoader, "Streaming does not support root path: '{0}'".format(root_path))
+
+        pattern = ''
+        descendant = False
+        for step in _split_path(root_path):
+            if step == '':
+                descendant = True
+                continue
+            if step == '.':
+                continue
+            if descendant:
+                pattern += '(?:[^\\x00]+\\x00)*'
+                descendant = False
+            pattern += '[^\\x00]+\\x00' if step == '*' else re.escape(_qualify(step, ns) + '\x00')
+        self.regex = re.compile(pattern)
+
+    def matches(self, tags):
+        return self.regex.fullmatch(''.join(tag + '\x00' for tag in tags)) is not None
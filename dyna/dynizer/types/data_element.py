@@ -2,6 +2,7 @@ from ...common.decorators import *
 from ...common.errors import *
 from .data_type import DataType
 from decimal import *
+import datetime
 import json
 import dateutil.parser
 
@@ -15,6 +16,9 @@ class DataElement:
 
     @staticmethod
     def _format_input_value(datatype, value):
+        # Values that already have the python type of the datatype are kept
+        if value.__class__ is _PYTHON_TYPES.get(datatype):
+            return value
         if datatype == DataType.INTEGER:
             return int(value)
         if datatype == DataType.STRING:
@@ -22,6 +26,9 @@ class DataElement:
         if datatype == DataType.BOOLEAN:
             return bool(value)
         if datatype == DataType.DECIMAL:
+            if isinstance(value, float):
+                # Decimal(float) keeps the binary expansion, the repr is the value as written
+                return Decimal(repr(value))
             return Decimal(value)
         if datatype == DataType.TIMESTAMP:
             if type(value).__name__ == 'str':
@@ -29,11 +36,11 @@ class DataElement:
             if type(value).__name__ == 'date' :
                 return datetime.datetime(value.year, value.month, value.day)
             if type(value).__name__ == 'time':
-                td = datetime.today()
+                td = datetime.datetime.today()
                 return datetime.datetime(td.year, td.month, td.day, value.hour, value.minute, value.second, value.microsecond)
             if type(value).__name__ == 'datetime':
                 return value
-            return datetime.min
+            return datetime.datetime.min
         if datatype == DataType.URI:
             return str(value)
         return None
@@ -121,3 +128,12 @@ class DataElement:
         return json_string
 
 
+
+_PYTHON_TYPES = {
+    DataType.INTEGER: int,
+    DataType.STRING: str,
+    DataType.BOOLEAN: bool,
+    DataType.DECIMAL: Decimal,
+    DataType.TIMESTAMP: datetime.datetime,
+    DataType.URI: str
+}
@@ -1,6 +1,28 @@
 from dyna.dynizer.connector import *
+from dyna.dynizer.filters import *
 from dyna.dynizer.types import *
 
+
+class FakeConnection(DynizerConnection):
+    """Connection that serves list() calls from memory"""
+    calls = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.objects = FakeConnection.objects
+
+    def connect(self, reconnect=False):
+        self.connection = True
+
+    def close(self):
+        self.connection = None
+
+    def list(self, type, field_filters=None, pagination_filter=None):
+        FakeConnection.calls.append((field_filters, pagination_filter))
+        ids = field_filters[0].value
+        return [obj for obj in self.objects if obj.id in ids]
+
+
 def test_Certificates():
     conn = DynizerConnector("api.unittest.dynizer.com",
                             https=True,
@@ -14,3 +36,59 @@ def test_Certificates():
 
     conn.close()
 
+def test_read_many():
+    FakeConnection.objects = [Topology(id=i) for i in range(1000)]
+    FakeConnection.calls = []
+    conn = FakeConnection('localhost')
+    ids = [999, 5, 12345, 0] + list(range(100, 900))
+    res = conn.read_many(Topology, ids, max_url_length=512)
+    assert(len(res) == len(ids))
+    assert(res[0].id == 999)
+    assert(res[1].id == 5)
+    assert(res[2] is None)
+    assert([r.id for r in res[4:]] == list(range(100, 900)))
+    assert(1 < len(FakeConnection.calls) < len(ids) // 10)
+
+def test_iterate():
+    class PagedConnection(FakeConnection):
+        def list(self, type, field_filters=None, pagination_filter=None):
+            FakeConnection.calls.append(pagination_filter)
+            last = pagination_filter.last_key
+            objs = [o for o in self.objects if last is None or o.id > last]
+            return objs[:pagination_filter.limit]
+
+    FakeConnection.objects = [Instance(id=i) for i in range(1, 251)]
+    FakeConnection.calls = []
+    conn = PagedConnection('localhost')
+    res = list(conn.iterate(Instance))
+    assert([o.id for o in res] == list(range(1, 251)))
+    assert(len(FakeConnection.calls) == 3)
+
+def test_parallel_scan():
+    urls = []
+
+    class RangeConnection(FakeConnection):
+        def list(self, type, field_filters=None, pagination_filter=None):
+            urls.append(DynizerConnection._DynizerConnection__build_url_with_arguments(
+                type, '/data/v1_1/instances', field_filters, pagination_filter))
+            objs = self.objects
+            for f in field_filters or []:
+                if f.op == FilterOperator.GT:
+                    objs = [o for o in objs if o.id > f.value]
+                elif f.op == FilterOperator.LTEQ:
+                    objs = [o for o in objs if o.id <= f.value]
+            last = pagination_filter.last_key
+            objs = [o for o in objs if last is None or o.id > last]
+            return objs[:pagination_filter.limit]
+
+    FakeConnection.objects = [Instance(id=i) for i in range(17, 5000, 3)]
+    conn = RangeConnection('localhost')
+    res = list(conn.parallel_scan(Instance, partitions=7, page_size=64))
+    assert(sorted(o.id for o in res) == list(range(17, 5000, 3)))
+    # Without user filters the probes and the first partition carry only the pagination
+    assert(urls[0] == '/data/v1_1/instances?limit=1')
+    assert('/data/v1_1/instances?id=<=727&id=>16&limit=64' in urls)
+    assert(not any('?&' in url for url in urls))
+
+    FakeConnection.objects = []
+    assert(list(conn.parallel_scan(Instance)) == [])
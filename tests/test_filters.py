@@ -0,0 +1,19 @@
+from dyna.dynizer.filters import *
+from dyna.dynizer.types import *
+from dyna.common.errors import *
+import pytest
+
+def test_FieldFilter():
+    assert(FieldFilter('id', FilterOperator.GT, 5).compose_filter(Instance) == 'id=>5')
+    assert(FieldFilter('name', FilterOperator.EQ, 'a b').compose_filter(Action) == 'name=a%20b')
+    assert(FieldFilter('id', FilterOperator.IN, [1, 2, 3]).compose_filter(Instance) == 'id=[1,2,3]')
+    with pytest.raises(FilterError):
+        FieldFilter('name', FilterOperator.EQ, 'x').compose_filter(Instance)
+
+def test_KeysetPaginationFilter():
+    f = KeysetPaginationFilter(50)
+    assert(f.compose_filter(Instance) == 'limit=50')
+    f = f.next_page([Instance(id=7), Instance(id=42)])
+    assert(f.compose_filter(Instance) == 'id=>42&limit=50')
+    with pytest.raises(FilterError):
+        KeysetPaginationFilter(10, 1, key='value').compose_filter(Instance)
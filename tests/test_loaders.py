@@ -0,0 +1,1018 @@
+from dyna.dynizer.connector import DynizerConnection
+from dyna.dynizer.loaders import *
+from dyna.dynizer.loaders.csv_loader import _csv_record_ranges
+from dyna.dynizer.loaders.xml_loader import _LoopExpansion
+from dyna.dynizer.types import *
+from dyna.common.errors import *
+import csv
+import decimal
+import xml.etree.ElementTree as ET
+import json
+import os
+import io
+import pytest
+
+
+class RecordingConnection(DynizerConnection):
+    """Connection that records what a loader creates instead of sending it"""
+    def __init__(self):
+        super().__init__('localhost')
+        self.batches = []
+        self.topologies = []
+        self.links = []
+
+    def connect(self, reconnect=False):
+        pass
+
+    def close(self):
+        pass
+
+    def clone(self):
+        return self
+
+    def create(self, obj):
+        if isinstance(obj, Action):
+            return Action(id=1, name=obj.name)
+        self.topologies.append(obj)
+        return Topology(id=len(self.topologies), components=obj.components)
+
+    def read(self, obj):
+        if isinstance(obj, Action):
+            return Action(id=obj.id, name='lives in')
+        return self.topologies[obj.id - 1]
+
+    def link_actiontopology(self, action, topology, labels=None):
+        self.links.append((action.id, topology.id))
+
+    def batch_create(self, obj_arr, payload=None):
+        self.batches.append(list(obj_arr))
+
+    def instances(self):
+        return [i for b in self.batches for i in b]
+
+
+def write_csv(tmp_path, rows, name='data.csv'):
+    path = str(tmp_path / name)
+    with open(path, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+    return path
+
+def sample_rows(count):
+    rows = [['name', 'city', 'year']]
+    for i in range(count):
+        city = 'Gent\n"Oost"' if i % 7 == 0 else 'Brussel'
+        rows.append(['person {0}'.format(i), city, str(1900 + i % 100)])
+    return rows
+
+def sample_mapping(batch_size=100):
+    return CSVMapping(Action(name='lives in'), [
+        CSVRowElement(0, DataType.STRING, ComponentType.WHO),
+        CSVRowElement(1, DataType.STRING, ComponentType.WHERE),
+        CSVRowElement(2, DataType.INTEGER, ComponentType.WHEN)
+    ], batch_size=batch_size)
+
+def instance_values(conn):
+    return [tuple(e.dataelement.value for e in inst.data) for inst in conn.instances()]
+
+
+def test_csv_record_ranges(tmp_path):
+    # Quoted fields that open after a split offset keep their line breaks
+    expected = [[name, city.replace('\n', ' '), year] for name, city, year in sample_rows(500)]
+    path = write_csv(tmp_path, expected)
+    ranges = _csv_record_ranges(path, 1000, '"', skip_records=1)
+    assert(len(ranges) > 5)
+    rows = []
+    with open(path, 'rb') as f:
+        for start, end in ranges:
+            f.seek(start)
+            chunk = f.read(end - start).decode()
+            rows.extend(csv.reader(io.StringIO(chunk, newline='')))
+    assert(rows == expected[1:])
+
+    # An offset inside a quoted field that spans lines gives a bad range,
+    # which the loader detects before loading the rest in order
+    path = write_csv(tmp_path, [['name', 'city', 'year'], ['a', 'x\n' * 400 + 'y', '1900'], ['b', 'z', '1901']])
+    start, end = _csv_record_ranges(path, 100, '"', skip_records=1)[0]
+    assert(end < os.path.getsize(path) - len('b,z,1901\r\n'))
+    serial = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1).run(serial)
+    parallel = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1).run(parallel, processes=2, chunk_size=100)
+    assert(len(serial.instances()) == 2 and instance_values(parallel) == instance_values(serial))
+
+def test_CSVLoader(tmp_path):
+    path = write_csv(tmp_path, sample_rows(250))
+    conn = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1).run(conn)
+    assert(len(conn.batches) == 3)
+    assert(len(conn.topologies) == 1)
+    values = instance_values(conn)
+    assert(values[0] == ('person 0', 'Gent\n"Oost"', 1900))
+    assert(len(values) == 250)
+
+def test_CSVLoader_parallel(tmp_path):
+    path = write_csv(tmp_path, sample_rows(2000))
+    serial = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1).run(serial)
+    parallel = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1).run(parallel, processes=3, chunk_size=4096)
+    assert(instance_values(parallel) == instance_values(serial))
+
+def test_CSVLoader_multiple_mappings(tmp_path):
+    path = write_csv(tmp_path, sample_rows(120))
+    born = CSVMapping(Action(name='born in'), [
+        CSVRowElement(0, DataType.STRING, ComponentType.WHO),
+        CSVRowElement(2, DataType.INTEGER, ComponentType.WHEN)
+    ], batch_size=50)
+    conn = RecordingConnection()
+    CSVLoader(path, [sample_mapping(batch_size=100), born], header_count=1).run(conn)
+    assert([len(b) for b in conn.batches] == [50, 100, 50, 20, 20])
+    assert(len(conn.topologies) == 2)
+
+def test_CSVLoader_sources(tmp_path):
+    import gzip
+    rows = sample_rows(30)
+    expected = RecordingConnection()
+    CSVLoader(write_csv(tmp_path, rows), [sample_mapping()], header_count=1).run(expected)
+
+    text = io.StringIO(newline='')
+    csv.writer(text).writerows(rows)
+    data = text.getvalue().encode()
+    gz_path = str(tmp_path / 'data.csv.gz')
+    with gzip.open(gz_path, 'wb') as f:
+        f.write(data)
+
+    sources = [gz_path,
+               io.BufferedReader(io.BytesIO(gzip.compress(data))),
+               io.BytesIO(data),
+               io.StringIO(text.getvalue(), newline=''),
+               text.getvalue().splitlines(keepends=True)]
+    for source in sources:
+        conn = RecordingConnection()
+        CSVLoader(source, [sample_mapping()], header_count=1).run(conn, processes=2)
+        assert(instance_values(conn) == instance_values(expected))
+
+def test_CSVMapping_compile():
+    mapping = CSVMapping(Action(name='test'), [
+        CSVFixedElement('fixed', DataType.STRING, ComponentType.WHAT),
+        CSVRowElement(0, DataType.INTEGER, ComponentType.WHO, transform_funcs=[lambda v: v.strip()]),
+        CSVRowElement(1, DataType.STRING, ComponentType.WHERE, required=False),
+        CSVStringCombinationElement([2, 3], ComponentType.WHEN)
+    ], fallback=[
+        CSVRowElement(0, DataType.INTEGER, ComponentType.WHO),
+        CSVFixedElement('fallback', DataType.STRING, ComponentType.WHAT)
+    ])
+    mapper = mapping.compile()
+    rows = [[' 1', 'Gent', 'a', 'b'], ['2', 'n/a', '', 'c'], ['3', 'Gent'], ['4', 'x', '', ''], ['5'], []]
+    for row in rows:
+        expected = mapping.map_row(row)
+        result = mapper(row)
+        if expected is None:
+            assert(result is None)
+            continue
+        assert(result[0] == expected[0])
+        assert(result[2] == expected[2])
+        assert(result[3] == expected[3])
+        assert([e.to_dict() for e in result[1]] == [e.to_dict() for e in expected[1]])
+    assert(mapper(rows[0])[1][3].dataelement.value == 'a b')
+    assert(mapper(rows[3])[3] == 'What,Who,Where,When')
+
+    single = CSVMapping(Action(name='single'), [CSVRowElement(0, DataType.STRING, ComponentType.WHO)])
+    assert(single.map_row(['x']) is None and single.compile()(['x']) is None)
+
+def test_CSVLoader_pipeline(tmp_path):
+    path = write_csv(tmp_path, sample_rows(2500))
+    serial = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1).run(serial)
+    pipelined = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1).run(pipelined, pipeline=True, upload_workers=3)
+    assert(sorted(instance_values(pipelined)) == sorted(instance_values(serial)))
+    assert(len(pipelined.batches) == 25)
+
+def test_CSVLoader_pipeline_error(tmp_path):
+    class FailingConnection(RecordingConnection):
+        def batch_create(self, obj_arr, payload=None):
+            raise ConnectionError()
+
+    path = write_csv(tmp_path, sample_rows(2500))
+    with pytest.raises(LoaderError):
+        CSVLoader(path, [sample_mapping()], header_count=1).run(FailingConnection(), pipeline=True)
+
+
+def sample_xml(count):
+    people = ''.join('<person><name>person {0}</name><city>{1}</city><year>{2}</year></person>'.format(
+        i, 'Gent' if i % 3 == 0 else 'Brussel', 1900 + i % 100) for i in range(count))
+    return '<root><people>{0}</people></root>'.format(people)
+
+def sample_xml_mapping(batch_size=100):
+    return XMLMapping(Action(name='lives in'), './people/person', [], [
+        XMLExtractionElement('./name', DataType.STRING, ComponentType.WHO),
+        XMLExtractionElement('./city', DataType.STRING, ComponentType.WHERE),
+        XMLExtractionElement('./year', DataType.INTEGER, ComponentType.WHEN)
+    ], batch_size=batch_size)
+
+def test_XMLLoader():
+    conn = RecordingConnection()
+    loader = XMLLoader.fromstring(sample_xml(250))
+    loader.mappings = [sample_xml_mapping()]
+    loader.run(conn)
+    assert([len(b) for b in conn.batches] == [100, 100, 50])
+    assert(instance_values(conn)[3] == ('person 3', 'Gent', 1903))
+
+    pipelined = RecordingConnection()
+    loader.run(pipelined, pipeline=True, upload_workers=2)
+    assert(sorted(instance_values(pipelined)) == sorted(instance_values(conn)))
+
+def test_TopologyRegistry(tmp_path):
+    path = write_csv(tmp_path, sample_rows(50))
+    registry = TopologyRegistry(str(tmp_path / 'registry.db'))
+    conn = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1).run(conn, registry=registry)
+    CSVLoader(path, [sample_mapping()], header_count=1).run(conn, registry=registry)
+    assert(len(conn.topologies) == 1)
+    assert(len(conn.links) == 1)
+    registry.close()
+
+    # A new registry is warmed from disk and validates lazily
+    registry = TopologyRegistry(str(tmp_path / 'registry.db'))
+    CSVLoader(path, [sample_mapping()], header_count=1).run(conn, registry=registry)
+    assert(len(conn.topologies) == 1)
+    assert(len(conn.links) == 1)
+    assert(len(conn.instances()) == 150)
+
+def test_prescan(tmp_path):
+    class PrescanConnection(RecordingConnection):
+        def create(self, obj):
+            # No topology may be created once instances are being written
+            assert(len(self.batches) == 0)
+            return super().create(obj)
+
+    rows = sample_rows(300)
+    for row in rows[150:]:
+        row[1] = ''
+    mapping = sample_mapping()
+    mapping.elements[1].required = False
+    path = write_csv(tmp_path, rows)
+
+    conn = PrescanConnection()
+    CSVLoader(path, [mapping], header_count=1).run(conn, prescan=True)
+    assert(len(conn.topologies) == 2)
+    assert(len(conn.instances()) == 300)
+
+    with pytest.raises(LoaderError):
+        CSVLoader(path, [mapping], header_count=1).run(PrescanConnection())
+
+    xml_conn = RecordingConnection()
+    loader = XMLLoader.fromstring(sample_xml(50))
+    loader.mappings = [sample_xml_mapping()]
+    loader.run(xml_conn, prescan=10)
+    assert(len(xml_conn.topologies) == 1)
+    assert(len(xml_conn.instances()) == 50)
+
+def test_progress(tmp_path):
+    class Reporter(ProgressReporter):
+        def __init__(self):
+            super().__init__(interval=0)
+            self.snapshots = []
+            self.final = None
+
+        def on_progress(self, snapshot):
+            self.snapshots.append(snapshot)
+
+        def on_finish(self, snapshot):
+            self.final = snapshot
+
+    path = write_csv(tmp_path, sample_rows(2100))
+    reporter = Reporter()
+    result = CSVLoader(path, [sample_mapping()], header_count=1).run(RecordingConnection(), progress=reporter)
+    assert(result is reporter.final)
+    assert(len(reporter.snapshots) == 2)
+    assert(result['rows'] == 2100)
+    assert(result['instances'] == 2100)
+    assert(result['batches'] == 21)
+    assert(result['batches_in_flight'] == 0)
+    assert(result['progress'] == 1.0)
+    assert(set(result['stage_times']) == set(LoaderMetrics.STAGES))
+    assert(result['stage_times']['http'] > 0)
+    assert(len(ConsoleReporter.format(result)) > 0)
+
+    snapshots = []
+    result = CSVLoader(path, [sample_mapping()], header_count=1).run(
+            RecordingConnection(), processes=2, chunk_size=4096, progress=snapshots.append)
+    assert(result['rows'] == 2100)
+    assert(result['progress'] == 1.0)
+
+def test_rejects(tmp_path):
+    class RejectingConnection(RecordingConnection):
+        def __init__(self):
+            super().__init__()
+            self.requests = 0
+
+        def batch_create(self, obj_arr, payload=None):
+            self.requests += 1
+            if any(inst.data[2].dataelement.value == 1913 for inst in obj_arr):
+                raise RequestError(400, 'Bad Request')
+            super().batch_create(obj_arr, payload)
+
+    def year(value):
+        if value == '1907':
+            raise ValueError('unlucky year')
+        return value
+
+    rows = sample_rows(300)
+    mapping = sample_mapping()
+    mapping.elements[2].transform_funcs = [year]
+    path = write_csv(tmp_path, rows)
+
+    with pytest.raises(ValueError):
+        CSVLoader(path, [mapping], header_count=1).run(RejectingConnection())
+
+    for kwargs in [{}, {'pipeline': True}, {'processes': 2, 'chunk_size': 1024}]:
+        reject_path = str(tmp_path / 'rejects.jsonl')
+        conn = RejectingConnection()
+        result = CSVLoader(path, [mapping], header_count=1).run(conn, rejects=reject_path, **kwargs)
+        with open(reject_path) as f:
+            records = [json.loads(line) for line in f]
+        os.remove(reject_path)
+
+        assert(len(conn.instances()) == 294)
+        assert(result['rejected'] == 6)
+        assert(sorted(r['stage'] for r in records) == ['mapping'] * 3 + ['upload'] * 3)
+        for record in records:
+            assert(record['loader'] == 'CSVLoader')
+            if record['stage'] == 'upload':
+                assert(record['source'][2] == '1913')
+                assert(record['instance'] is not None)
+                assert(record['error'].startswith('RequestError'))
+            else:
+                assert(record['source'][2] == '1907')
+                assert(record['error'] == 'ValueError: unlucky year')
+
+    with pytest.raises(LoaderError):
+        CSVLoader(path, [sample_mapping()], header_count=1).run(RejectingConnection())
+
+    xml_mapping = sample_xml_mapping()
+    xml_mapping.elements[2].transform_funcs = [year]
+    xml_path = str(tmp_path / 'people.xml')
+    with open(xml_path, 'w') as f:
+        f.write(sample_xml(30))
+    for loader in [XMLLoader.parse(xml_path, [xml_mapping]), XMLLoader.stream(xml_path, [xml_mapping])]:
+        reject_path = str(tmp_path / 'rejects.jsonl')
+        conn = RecordingConnection()
+        result = loader.run(conn, rejects=reject_path)
+        with open(reject_path) as f:
+            records = [json.loads(line) for line in f]
+        os.remove(reject_path)
+        assert(len(conn.instances()) == 29 and result['rejected'] == 1)
+        assert('<name>person 7</name>' in records[0]['source'])
+
+def test_dedup(tmp_path):
+    rows = sample_rows(200)
+    rows = rows + rows[1:101]
+    path = write_csv(tmp_path, rows)
+
+    for dedup in [True, FingerprintSet(max_entries=50, spill=True, spill_dir=str(tmp_path)),
+                  BloomFilter(capacity=1000, error_rate=0.0001)]:
+        conn = RecordingConnection()
+        result = CSVLoader(path, [sample_mapping()], header_count=1).run(conn, dedup=dedup)
+        assert(result['duplicates'] == 100)
+        assert(len(instance_values(conn)) == 200)
+        assert(len(set(instance_values(conn))) == 200)
+
+    # Without spill only recent duplicates are found
+    conn = RecordingConnection()
+    result = CSVLoader(path, [sample_mapping()], header_count=1).run(conn, dedup=10)
+    assert(result['duplicates'] == 0)
+    assert(len(conn.instances()) == 300)
+
+    xml_conn = RecordingConnection()
+    loader = XMLLoader.fromstring(sample_xml(20))
+    loader.mappings = [sample_xml_mapping(), sample_xml_mapping()]
+    result = loader.run(xml_conn, dedup=True)
+    assert(result['duplicates'] == 20)
+    assert(len(xml_conn.instances()) == 20)
+
+def test_delta(tmp_path):
+    state_path = str(tmp_path / 'delta.sqlite')
+    rows = sample_rows(100)
+    path = write_csv(tmp_path, rows)
+
+    def load(**kwargs):
+        conn = RecordingConnection()
+        CSVLoader(path, [sample_mapping()], header_count=1).run(conn, delta=state_path, **kwargs)
+        return instance_values(conn)
+
+    assert(len(load()) == 100)
+    assert(len(load()) == 0)
+
+    # Appended rows are read from the old end of the file
+    rows = rows + sample_rows(120)[101:]
+    write_csv(tmp_path, rows)
+    assert(load() == [('person {0}'.format(i), 'Brussel' if i % 7 else 'Gent\n"Oost"', 1900 + i % 100) for i in range(100, 120)])
+    rows = rows + sample_rows(150)[121:]
+    write_csv(tmp_path, rows)
+    assert(len(load(processes=2, chunk_size=256)) == 30)
+
+    # Changed rows are found by their content hash
+    rows[5] = ['person 5', 'Antwerpen', '1905']
+    rows.insert(1, ['person x', 'Leuven', '2000'])
+    write_csv(tmp_path, rows)
+    assert(sorted(load(processes=2)) == [('person 5', 'Antwerpen', 1905), ('person x', 'Leuven', 2000)])
+    assert(len(load()) == 0)
+
+    # A failed load leaves the state untouched
+    class FailingConnection(RecordingConnection):
+        def batch_create(self, obj_arr, payload=None):
+            raise ConnectionError()
+
+    write_csv(tmp_path, rows + [['person y', 'Gent', '2001']])
+    with pytest.raises(LoaderError):
+        CSVLoader(path, [sample_mapping()], header_count=1).run(FailingConnection(), delta=state_path)
+    assert(load() == [('person y', 'Gent', 2001)])
+
+def test_CSVLoader_mmap(tmp_path):
+    rows = sample_rows(500)
+    rows = [row + ['extra {0}'.format(i), '"x"' if i % 2 else 'y', ''] for i, row in enumerate(rows)]
+    rows.insert(200, [])
+    path = write_csv(tmp_path, rows)
+
+    serial = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1).run(serial)
+    for kwargs in [{}, {'processes': 2, 'chunk_size': 1024}]:
+        mapped = RecordingConnection()
+        CSVLoader(path, [sample_mapping()], header_count=1, backend='mmap').run(mapped, **kwargs)
+        assert(instance_values(mapped) == instance_values(serial))
+
+    # Only the referenced columns are decoded
+    seen = []
+    class Recording(CSVRowElement):
+        def fetch_from_row(self, row, components, data, labels):
+            seen.append(list(row))
+            return super().fetch_from_row(row, components, data, labels)
+
+    loader = CSVLoader(path, [sample_mapping()], header_count=1, backend='mmap')
+    with loader._CSVLoader__rows() as csv_rdr:
+        csv_rdr = list(csv_rdr)
+    assert(csv_rdr[1] == ['person 0', 'Gent\n"Oost"', '1900', None, None, None])
+    assert(csv_rdr[2] == ['person 1', 'Brussel', '1901', None, None, None])
+    assert(csv_rdr[200] == [])
+
+    mapping = sample_mapping()
+    mapping.elements.append(Recording(4, DataType.STRING, ComponentType.WHAT))
+    CSVLoader(path, [mapping], header_count=1, backend='mmap').run(None)
+    assert(seen[1] == ['person 1', 'Brussel', '1901', 'extra 2', 'y', ''])
+
+    with pytest.raises(LoaderError):
+        CSVLoader(path, [sample_mapping()], backend='fast')
+
+def test_CSVLoader_stray_quote(tmp_path):
+    # A quote inside an unquoted field is literal and does not swallow the following rows
+    path = str(tmp_path / 'stray.csv')
+    with open(path, 'w', newline='') as f:
+        f.write('name,city,year\r\nperson 0,Gent 5" west,1900\r\nperson 1,"Brussel",1901\r\n'
+                'person 2,Antwerpen,1902\r\nperson 3,"Gent\r\nOost",1903\r\n')
+    serial = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1).run(serial)
+    assert(len(serial.instances()) == 4)
+    assert(instance_values(serial)[0] == ('person 0', 'Gent 5" west', 1900))
+    mapped = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1, backend='mmap').run(mapped)
+    assert(instance_values(mapped) == instance_values(serial))
+
+    # Stray quotes mislead the range splitter, the workers detect it and the
+    # rest of the file is loaded in order
+    text = io.StringIO()
+    csv.writer(text).writerows(sample_rows(400))
+    path = str(tmp_path / 'stray_ranges.csv')
+    with open(path, 'w', newline='') as f:
+        f.write(text.getvalue().replace('person 3,Brussel', 'person 3,Brussel 5" west'))
+    serial = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1).run(serial)
+    assert(len(serial.instances()) == 400)
+    for backend in ['csv', 'mmap']:
+        parallel = RecordingConnection()
+        CSVLoader(path, [sample_mapping()], header_count=1, backend=backend).run(parallel, processes=2, chunk_size=512)
+        assert(instance_values(parallel) == instance_values(serial))
+
+def test_CSVLoader_parallel_encoding(tmp_path):
+    path = str(tmp_path / 'utf16.csv')
+    with open(path, 'w', newline='', encoding='utf-16') as f:
+        csv.writer(f).writerows(sample_rows(300))
+    serial = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1, encoding='utf-16').run(serial)
+    parallel = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1, encoding='utf-16').run(parallel, processes=2, chunk_size=1024)
+    assert(len(serial.instances()) == 300 and instance_values(parallel) == instance_values(serial))
+
+def test_XMLLoader_stream(tmp_path):
+    path = str(tmp_path / 'data.xml')
+    with open(path, 'w') as f:
+        f.write(sample_xml(250))
+
+    parsed = RecordingConnection()
+    loader = XMLLoader.parse(path)
+    loader.mappings = [sample_xml_mapping()]
+    loader.run(parsed)
+
+    for root_path in ['./people/person', 'people/*', './/person']:
+        mapping = sample_xml_mapping()
+        mapping.root_path = root_path
+        streamed = RecordingConnection()
+        result = XMLLoader.stream(path, [mapping]).run(streamed)
+        assert(instance_values(streamed) == instance_values(parsed))
+        assert(result['progress'] == 1.0)
+
+    # Entities nested in other entities stay intact until the outer one is mapped
+    outer = XMLMapping(Action(name='lists'), './people', [], [
+        XMLFixedElement('people', DataType.STRING, ComponentType.WHAT),
+        XMLExtractionElement('./person/name', DataType.STRING, ComponentType.WHO)
+    ])
+    streamed = RecordingConnection()
+    XMLLoader.stream(path, [sample_xml_mapping(), outer]).run(streamed)
+    assert(len(streamed.instances()) == 251)
+    assert(len(streamed.instances()[-1].data) == 251)
+
+    # The reader stage maps every entity before the stream drops it and passes errors on
+    pipelined = RecordingConnection()
+    XMLLoader.stream(path, [sample_xml_mapping(), outer]).run(pipelined, pipeline=True, queue_size=2)
+    assert(sorted(instance_values(pipelined)) == sorted(instance_values(streamed)))
+    failing = sample_xml_mapping()
+    failing.elements[2].transform_funcs = [lambda year: 1 // 0]
+    with pytest.raises(ZeroDivisionError):
+        XMLLoader.stream(path, [failing]).run(RecordingConnection(), pipeline=True)
+
+    ns_xml = '<root xmlns:p="urn:p"><p:person><p:name>a</p:name><p:city>b</p:city><p:year>1</p:year></p:person></root>'
+    mapping = XMLMapping(Action(name='lives in'), './p:person', [], [
+        XMLExtractionElement('./p:name', DataType.STRING, ComponentType.WHO),
+        XMLExtractionElement('./p:city', DataType.STRING, ComponentType.WHERE)
+    ])
+    streamed = RecordingConnection()
+    XMLLoader.stream(io.BytesIO(ns_xml.encode()), [mapping], {'p': 'urn:p'}).run(streamed)
+    assert(instance_values(streamed) == [('a', 'b')])
+
+    mapping = sample_xml_mapping()
+    mapping.root_path = './people/person[1]'
+    with pytest.raises(LoaderError):
+        XMLLoader.stream(path, [mapping]).run(RecordingConnection())
+
+def test_XMLMapping_compile():
+    entity = ET.fromstring(
+        '<person xmlns:p="urn:p"><name>Jan</name><name>Jansen</name><p:city>Gent</p:city>'
+        '<address><street>Kouter</street><nr>1</nr></address><address><street>Veld</street></address>'
+        '<tag kind="a">x</tag><tag kind="b">y</tag></person>')
+    ns = {'p': 'urn:p'}
+
+    class Custom(XMLAbstractElement):
+        def fetch_from_entity(self, entity, components, data, labels, ns):
+            components.append(self.component)
+            data.append(InstanceElement(value=len(entity), datatype=DataType.INTEGER))
+            labels.append(self.label)
+            return True
+
+    mapping = XMLMapping(Action(name='lives in'), '.', [], [
+        XMLExtractionElement('./name', DataType.STRING, ComponentType.WHO),
+        XMLExtractionElement('p:city', DataType.STRING, ComponentType.WHERE),
+        XMLExtractionElement('./address/street', DataType.STRING, ComponentType.WHERE),
+        XMLExtractionElement('./missing', DataType.STRING, ComponentType.WHAT, default='none'),
+        XMLExtractionElement("./tag[@kind='b']", DataType.STRING, ComponentType.WHAT),
+        XMLStringCombinationElement(['./address/nr', './*/street', './name'], ComponentType.WHAT),
+        XMLFixedElement('fixed', DataType.STRING, ComponentType.WHEN),
+        Custom(None, DataType.INTEGER, ComponentType.WHEN)
+    ], fallback=[
+        XMLExtractionElement('./name', DataType.STRING, ComponentType.WHO)
+    ])
+
+    def values(mapped):
+        components, data, labels, key = mapped
+        return (list(components), [(e.dataelement.value, e.dataelement.datatype) for e in data], list(labels), key)
+
+    expected = values(mapping.map_entity(entity, ns))
+    assert(values(mapping.compile(ns)(entity)) == expected)
+    assert(expected[1][:5] == [('Jan', DataType.STRING), ('Jansen', DataType.STRING), ('Gent', DataType.STRING),
+                               ('Kouter', DataType.STRING), ('Veld', DataType.STRING)])
+    assert(expected[1][5:8] == [('none', DataType.STRING), ('y', DataType.STRING),
+                                ('1 Kouter,Veld Jan,Jansen', DataType.STRING)])
+
+    mapping.elements[1].allow_void = False
+    mapping.elements[1].path = './city'
+    fallback = values(mapping.map_entity(entity, ns))
+    assert(fallback[3] == 'Who,Who')
+    assert(values(mapping.compile(ns)(entity)) == fallback)
+
+def test_XMLLoader_loop_variables(monkeypatch):
+    xml = ('<root>'
+           '<country><name>BE</name><city><name>Gent</name><street>Kouter</street><street>Veld</street></city>'
+           '<city><name>Brussel</name><street>Louiza</street></city></country>'
+           '<country><name>NL</name><city><name>Gent</name><street>Dorp</street></city></country>'
+           '<country><name>FR</name></country>'
+           '<year>2000</year><year>2001</year>'
+           '</root>')
+
+    def load(root_path, workers=1, backend=None):
+        mapping = XMLMapping(Action(name='lies in'), root_path, [
+            XMLLoopVariable('./country', ['./name']),
+            XMLLoopVariable('./country/city', ['./name']),
+            XMLLoopVariable('./year', ['.'])
+        ], [
+            XMLExtractionElement('.', DataType.STRING, ComponentType.WHAT),
+            XMLVariableElement(1, 0, DataType.STRING, ComponentType.WHERE),
+            XMLVariableElement(0, 0, DataType.STRING, ComponentType.WHERE, transform_funcs=[str.lower]),
+            XMLVariableElement(2, 0, DataType.INTEGER, ComponentType.WHEN)
+        ])
+        conn = RecordingConnection()
+        loader = XMLLoader.fromstring(xml, backend=backend)
+        loader.mappings = [mapping]
+        loader.run(conn, workers=workers)
+        # The combinations are passed to the elements instead of stored on them
+        assert(all(element.value is None for element in mapping.elements))
+        return instance_values(conn)
+
+    expected = sorted((street, city, country.lower(), year)
+                      for country, city, street in [('BE', 'Gent', 'Kouter'), ('BE', 'Gent', 'Veld'),
+                                                    ('BE', 'Brussel', 'Louiza'), ('NL', 'Gent', 'Dorp')]
+                      for year in [2000, 2001])
+    # Indexed and formatted expansion give the same entities
+    assert(sorted(load("./country[name='{0[0]}']/city[name='{1[0]}']/street")) == expected)
+    assert(sorted(load("./country[name='{0[0]}']/city[name='{1[0]}']//street")) == expected)
+    assert(sorted(load("./*[name=\"{0[0]}\"]/city[name='{1[0]}']/street")) == expected)
+    # A worker pool maps the combinations in parallel and keeps their order
+    from dyna.dynizer.loaders import xml_loader
+    monkeypatch.setattr(xml_loader, '_MAP_CHUNK_ENTITIES', 3)
+    assert(load("./country[name='{0[0]}']/city[name='{1[0]}']/street", workers=4) ==
+           load("./country[name='{0[0]}']/city[name='{1[0]}']/street"))
+    assert(sorted(load("./*[name=\"{0[0]}\"]/city[name='{1[0]}']/street", workers=3)) == expected)
+    # Workers find the entities by their position in the document with either backend
+    assert(load("./country[name='{0[0]}']/city[name='{1[0]}']//street", workers=2, backend='etree') ==
+           load("./country[name='{0[0]}']/city[name='{1[0]}']//street", backend='etree'))
+
+    variables = [XMLLoopVariable('./country', ['./name']), XMLLoopVariable('./country/city', ['./name'])]
+    def is_indexed(root_path):
+        return _LoopExpansion(XMLMapping(Action(name='x'), root_path, variables, []), {}).chain is not None
+    assert(is_indexed("./country[name='{0[0]}']/city[name='{1[0]}']//street"))
+    assert(is_indexed("./country[name='{0[0]}']/city"))
+    assert(not is_indexed("./country[name='{0[0]}'][1]/city"))
+    assert(not is_indexed("./country/city[name='{0[0]}']"))
+    assert(not is_indexed("./country[name='{1[0]}']"))
+
+def test_XMLLoader_apply_variables():
+    # Custom elements that take the combination through apply_variables keep working
+    class CountryElement(XMLAbstractElement):
+        def __init__(self):
+            super().__init__(None, DataType.STRING, ComponentType.WHERE)
+
+        def apply_variables(self, combination):
+            self.value = combination[0][0]
+
+    xml = ('<root><country><name>BE</name><city>Gent</city></country>'
+           '<country><name>NL</name><city>Delft</city></country></root>')
+    country = CountryElement()
+    mapping = XMLMapping(Action(name='lies in'), "./country[name='{0[0]}']/city", [
+        XMLLoopVariable('./country', ['./name'])
+    ], [
+        XMLExtractionElement('.', DataType.STRING, ComponentType.WHO),
+        country
+    ])
+    for workers in [1, 2]:
+        conn = RecordingConnection()
+        loader = XMLLoader.fromstring(xml)
+        loader.mappings = [mapping]
+        loader.run(conn, workers=workers)
+        assert(instance_values(conn) == [('Gent', 'BE'), ('Delft', 'NL')])
+    city = ET.fromstring(xml).find('./country/city')
+    assert(mapping.map_entity(city, variables=(('BE',),))[1][1].dataelement.value == 'BE')
+    assert(country.value is None)
+
+def test_DirectoryLoader(tmp_path):
+    os.mkdir(str(tmp_path / 'sub'))
+    write_csv(tmp_path, sample_rows(400), name='a.csv')
+    write_csv(tmp_path, sample_rows(30), name=os.path.join('sub', 'b.csv'))
+    (tmp_path / 'c.xml').write_text(sample_xml(20))
+    (tmp_path / 'd.xml').write_text('<root><people>')
+    (tmp_path / 'e.txt').write_text('not loaded')
+
+    expected = sorted(sample_rows(400)[1:] + sample_rows(30)[1:] + [
+        ['person {0}'.format(i), 'Gent' if i % 3 == 0 else 'Brussel', str(1900 + i % 100)] for i in range(20)])
+    expected = [(name, city, int(year)) for name, city, year in expected]
+    patterns = [str(tmp_path / '**' / '*.csv'), str(tmp_path / '*.xml')]
+
+    for processes in [1, 3]:
+        conn = RecordingConnection()
+        loader = DirectoryLoader(patterns, [sample_mapping(), sample_xml_mapping()], csv_options={'header_count': 1})
+        snapshot = loader.run(conn, processes=processes, chunk_size=2048)
+        assert(sorted(instance_values(conn)) == expected)
+        assert(snapshot['instances'] == len(expected))
+        status = dict((os.path.basename(s.path), s) for s in loader.status)
+        assert(sorted(status) == ['a.csv', 'b.csv', 'c.xml', 'd.xml'])
+        assert(status['a.csv'].status == FileStatus.LOADED and status['a.csv'].instances == 400)
+        assert(status['b.csv'].rows == 30 and status['c.xml'].instances == 20)
+        assert(status['d.xml'].status == FileStatus.FAILED and status['d.xml'].error is not None)
+
+def test_DirectoryLoader_splitting(tmp_path):
+    # Stray quotes mislead the range splitter and utf-16 files cannot be split on raw bytes
+    text = io.StringIO()
+    csv.writer(text).writerows(sample_rows(400))
+    with open(str(tmp_path / 'stray.csv'), 'w', newline='') as f:
+        f.write(text.getvalue().replace('person 3,Brussel', 'person 3,Brussel 5" west'))
+    with open(str(tmp_path / 'wide.txt'), 'w', newline='', encoding='utf-16') as f:
+        csv.writer(f).writerows(sample_rows(300))
+
+    expected = [('person 3', 'Brussel 5" west', 1903)] + [
+        (r[0], r[1], int(r[2])) for i, r in enumerate(sample_rows(400)[1:]) if i != 3]
+    conn = RecordingConnection()
+    loader = DirectoryLoader(str(tmp_path / '*.csv'), [sample_mapping()], csv_options={'header_count': 1})
+    loader.run(conn, processes=3, chunk_size=512)
+    assert(sorted(instance_values(conn)) == sorted(expected) and loader.status[0].rows == 400)
+
+    conn = RecordingConnection()
+    loader = DirectoryLoader(str(tmp_path / '*.txt'), [sample_mapping()],
+                             csv_options={'header_count': 1, 'encoding': 'utf-16'})
+    loader.run(conn, processes=3, chunk_size=512)
+    assert(len(conn.instances()) == 300 and loader.status[0].status == FileStatus.LOADED)
+
+def test_DirectoryLoader_streamed(tmp_path):
+    # Compressed csv files and xml documents above chunk_size are streamed in chunks by the workers
+    import gzip
+    text = io.StringIO()
+    csv.writer(text).writerows(sample_rows(3000))
+    with gzip.open(str(tmp_path / 'big.csv.gz'), 'wt', newline='') as f:
+        f.write(text.getvalue())
+    write_csv(tmp_path, sample_rows(10), name='small.csv')
+    (tmp_path / 'big.xml').write_text(sample_xml(2500))
+    patterns = [str(tmp_path / '*.gz'), str(tmp_path / '*.csv'), str(tmp_path / '*.xml')]
+
+    gent = XMLMapping(Action(name='in Gent'), "./people/person[city='Gent']", [], [
+        XMLExtractionElement('./name', DataType.STRING, ComponentType.WHO),
+        XMLFixedElement('Gent', DataType.STRING, ComponentType.WHERE)
+    ])
+    for mappings, xml_instances in [([sample_xml_mapping()], 2500), ([sample_xml_mapping(), gent], 2500 + 834)]:
+        conn = RecordingConnection()
+        loader = DirectoryLoader(patterns, [sample_mapping()] + mappings, csv_options={'header_count': 1})
+        snapshot = loader.run(conn, processes=2, chunk_size=1024)
+        status = dict((os.path.basename(s.path), s) for s in loader.status)
+        assert(all(s.status == FileStatus.LOADED for s in loader.status))
+        assert(status['big.csv.gz'].rows == 3000 and status['small.csv'].instances == 10)
+        assert(status['big.xml'].instances == xml_instances)
+        assert(snapshot['instances'] == 3010 + xml_instances)
+
+    # A streamed file that breaks halfway fails alone, a failing sink stops the streams
+    (tmp_path / 'broken.xml').write_text(sample_xml(2500)[:-30])
+    for processes in [1, 2]:
+        loader = DirectoryLoader(patterns, [sample_mapping(), sample_xml_mapping()], csv_options={'header_count': 1})
+        snapshot = loader.run(RecordingConnection(), processes=processes, chunk_size=1024)
+        status = dict((os.path.basename(s.path), s) for s in loader.status)
+        assert(status['broken.xml'].status == FileStatus.FAILED and status['broken.xml'].error is not None)
+        assert(status['big.xml'].status == FileStatus.LOADED and snapshot['instances'] >= 5510)
+
+    class FailingSink(DryRunSink):
+        def write(self, name, mapped, source=None):
+            if sum(self.counts.values()) == 1500:
+                raise ValueError('sink failed')
+            super().write(name, mapped, source)
+
+    loader = DirectoryLoader(patterns, [sample_mapping(), sample_xml_mapping()], csv_options={'header_count': 1})
+    with pytest.raises(ValueError):
+        loader.run(None, processes=2, chunk_size=1024, sink=FailingSink())
+
+def test_XMLLoader_backends(tmp_path):
+    pytest.importorskip('lxml')
+    from dyna.dynizer.loaders.xml_loader import _to_xpath
+    ns = {'': 'urn:d', 'p': 'urn:p'}
+    assert(_to_xpath(".//city[name='Gent']/../p:x[@a='1'][2]", ns) ==
+           (".//_ns0:city[_ns0:name='Gent']/../p:x[@a='1'][2]", {'p': 'urn:p', '_ns0': 'urn:d'}))
+    assert(_to_xpath('{urn:q}a/*[last()]', {}) == ('./_ns0:a/*[last()]', {'_ns0': 'urn:q'}))
+    assert(_to_xpath('.', {}) == ('.', {}))
+
+    xml = ('<?xml version="1.0" encoding="UTF-8"?>'
+           '<root xmlns="urn:d" xmlns:p="urn:p"><!-- people -->'
+           '<country><name>BE</name><city><name>Gent</name>'
+           '<person p:id="1"><name>Jan</name><p:year>1990</p:year></person>'
+           '<person p:id="2"><name>Piet</name><p:year>1991</p:year></person></city></country>'
+           '<country><name>NL</name><city><name>Delft</name>'
+           '<person p:id="3"><name>Kees</name></person></city></country>'
+           '</root>')
+    path = str(tmp_path / 'data.xml')
+    with open(path, 'w') as f:
+        f.write(xml)
+
+    def mappings(parent=False):
+        elements = [
+            XMLExtractionElement('./name', DataType.STRING, ComponentType.WHO),
+            XMLVariableElement(0, 0, DataType.STRING, ComponentType.WHERE),
+            XMLExtractionElement('.//p:year', DataType.INTEGER, ComponentType.WHEN, required=False),
+            XMLExtractionElement("./name[.='Jan']", DataType.STRING, ComponentType.WHAT, required=False)
+        ]
+        if parent:
+            # Only lxml elements know their parent
+            elements.insert(1, XMLExtractionElement('../name', DataType.STRING, ComponentType.WHERE))
+        return [XMLMapping(Action(name='lives in'), "./country[name='{0[0]}']/city/person", [
+            XMLLoopVariable('./country', ['./name'])
+        ], elements), XMLMapping(Action(name='named'), './/{urn:d}person', [], [
+            XMLExtractionElement('./name', DataType.STRING, ComponentType.WHO),
+            XMLFixedElement('person', DataType.STRING, ComponentType.WHAT)
+        ])]
+
+    results = {}
+    for backend in ['etree', 'lxml']:
+        conn = RecordingConnection()
+        loader = XMLLoader.parse(path, mappings(), ns, backend=backend)
+        assert(loader.backend.name == backend)
+        loader.run(conn)
+        results[backend] = instance_values(conn)
+    assert(results['lxml'] == results['etree'])
+    assert(results['lxml'][:3] == [('Jan', 'BE', 1990, 'Jan'), ('Piet', 'BE', 1991), ('Kees', 'NL')])
+    assert(len(results['lxml']) == 6)
+
+    conn = RecordingConnection()
+    XMLLoader.parse(path, mappings(parent=True), ns, backend='lxml').run(conn)
+    assert(instance_values(conn)[:3] == [('Jan', 'Gent', 'BE', 1990, 'Jan'), ('Piet', 'Gent', 'BE', 1991),
+                                         ('Kees', 'Delft', 'NL')])
+
+    streamed = RecordingConnection()
+    XMLLoader.stream(path, mappings()[1:], ns, backend='lxml').run(streamed)
+    assert(instance_values(streamed) == results['lxml'][3:])
+    assert(XMLLoader.fromstring(xml).backend.name == 'lxml')
+    assert(XMLLoader(ET.fromstring(xml)).backend.name == 'etree')
+    with pytest.raises(LoaderError):
+        XMLLoader.fromstring(xml, backend='sax')
+
+    # libxml2's depth limit stays on unless huge_tree is asked for
+    deep = '<a>' * 300 + '</a>' * 300
+    with pytest.raises(SyntaxError):
+        XMLLoader.fromstring(deep, backend='lxml')
+    assert(XMLLoader.fromstring(deep, backend='lxml', huge_tree=True).root_node.tag == 'a')
+    deep_path = tmp_path / 'deep.xml'
+    deep_path.write_text(deep)
+    assert(XMLLoader.stream(str(deep_path), backend='lxml', huge_tree=True).backend.huge_tree)
+
+def test_JSONLoader(tmp_path, monkeypatch):
+    people = [{'name': 'person {0}'.format(i), 'address': {'city': 'Gent' if i % 3 == 0 else 'Brussel'},
+               'year': 1900 + i % 100, 'tags': ['a', 'b'] if i % 2 == 0 else []} for i in range(250)]
+    mapping = lambda: JSONMapping(Action(name='lives in'), '', [], [
+        JSONExtractionElement('name', DataType.STRING, ComponentType.WHO),
+        JSONExtractionElement('address.city', DataType.STRING, ComponentType.WHERE),
+        JSONExtractionElement('year', DataType.INTEGER, ComponentType.WHEN),
+        JSONStringCombinationElement(['tags[*]', 'missing'], ComponentType.WHAT, required=False)
+    ], fallback=[
+        JSONExtractionElement('name', DataType.STRING, ComponentType.WHO),
+        JSONFixedElement('untagged', DataType.STRING, ComponentType.WHAT)
+    ])
+    expected = [('person {0}'.format(i), 'Gent' if i % 3 == 0 else 'Brussel', 1900 + i % 100, 'a,b')
+                if i % 2 == 0 else ('person {0}'.format(i), 'untagged') for i in range(250)]
+
+    array_path = str(tmp_path / 'people.json')
+    with open(array_path, 'w') as f:
+        json.dump(people, f, indent=1)
+    ndjson_path = str(tmp_path / 'people.ndjson')
+    with open(ndjson_path, 'w') as f:
+        f.write('\n'.join(json.dumps(person) for person in people) + '\n\n')
+
+    for source in [array_path, ndjson_path, io.BytesIO(json.dumps({'people': people}).encode())]:
+        m = mapping()
+        if not isinstance(source, str):
+            m.root_path = 'people[*]'
+        conn = RecordingConnection()
+        result = JSONLoader(source, [m]).run(conn)
+        assert(instance_values(conn) == expected)
+        assert([len(b) for b in conn.batches] == [100, 100, 50])
+        assert(result['rows'] == 250)
+
+    # Loop variables flatten nested arrays
+    document = {'countries': [
+        {'name': 'BE', 'cities': [{'name': 'Gent', 'streets': ['Kouter', 'Veld']}, {'name': 'Brussel', 'streets': []}]},
+        {'name': 'NL', 'cities': [{'name': 'Delft', 'streets': ['Markt']}]}]}
+    nested = JSONMapping(Action(name='lies in'), 'streets[*]', [
+        JSONLoopVariable('countries[*]', ['name']),
+        JSONLoopVariable('cities[*]', ['name'])
+    ], [
+        JSONExtractionElement('$', DataType.STRING, ComponentType.WHAT),
+        JSONVariableElement(1, 0, DataType.STRING, ComponentType.WHERE),
+        JSONVariableElement(0, 0, DataType.STRING, ComponentType.WHERE, transform_funcs=[str.lower])
+    ])
+    conn = RecordingConnection()
+    JSONLoader(io.StringIO(json.dumps(document)), [nested]).run(conn)
+    assert(instance_values(conn) == [('Kouter', 'Gent', 'be'), ('Veld', 'Gent', 'be'), ('Markt', 'Delft', 'nl')])
+
+    with pytest.raises(LoaderError):
+        JSONLoader(io.StringIO('[{"name": "a"}, {"name"'), [mapping()]).run(RecordingConnection())
+    # An invalid element fails at once rather than after buffering the rest of the file
+    text = '[{"name": "a"}, {"name": b}, ' + '{"name": "c"}, ' * 50000 + '{"name": "d"}]'
+    source = io.StringIO(text)
+    with pytest.raises(LoaderError):
+        JSONLoader(source, [mapping()]).run(RecordingConnection())
+    assert(source.tell() < len(text) // 4)
+
+    # Numbers and escapes cut off by a read are completed by the next one
+    import dyna.dynizer.loaders.json_loader
+    monkeypatch.setattr(dyna.dynizer.loaders.json_loader, '_READ_SIZE', 7)
+    values = [-1.5e+10, '\u00e9\u1234', True, 123456789, None, [2.25], {'name': 'a'}] * 5
+    assert(list(dyna.dynizer.loaders.json_loader._iter_json_documents(io.StringIO(json.dumps(values)))) == values)
+
+def test_SQLLoader(tmp_path):
+    import sqlite3
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE people (name TEXT, city TEXT, year INTEGER)')
+    rows = sample_rows(250)[1:]
+    db.executemany('INSERT INTO people VALUES (?, ?, ?)', [(name, city, int(year)) for name, city, year in rows])
+    db.execute("INSERT INTO people VALUES ('nobody', NULL, 2000)")
+
+    from_csv = RecordingConnection()
+    CSVLoader(write_csv(tmp_path, sample_rows(250)), [sample_mapping()], header_count=1).run(from_csv)
+    from_sql = RecordingConnection()
+    result = SQLLoader(db, 'SELECT name, city, year FROM people WHERE year >= ?', [sample_mapping()],
+                       parameters=(1900,), fetch_size=64).run(from_sql)
+    assert(instance_values(from_sql)[:250] == instance_values(from_csv))
+    assert(instance_values(from_sql)[250] == ('nobody', None, 2000))
+    assert(result['rows'] == 251 and [len(b) for b in from_sql.batches] == [100, 100, 51])
+
+    combined = CSVMapping(Action(name='born'), [
+        CSVRowElement(0, DataType.STRING, ComponentType.WHO),
+        CSVStringCombinationElement([1, 2], ComponentType.WHAT)
+    ])
+    conn = RecordingConnection()
+    SQLLoader(db, "SELECT name, city, year FROM people WHERE name IN ('person 1', 'nobody')", [combined]).run(conn)
+    assert(instance_values(conn) == [('person 1', 'Brussel 1901'), ('nobody', '2000')])
+
+    # REAL columns arrive as floats, array columns of other databases as lists
+    priced = CSVMapping(Action(name='priced'), [
+        CSVRowElement(0, DataType.STRING, ComponentType.WHO),
+        CSVRowElement(1, DataType.DECIMAL, ComponentType.WHAT),
+        CSVRowElement(2, DataType.STRING, ComponentType.WHERE, transform_funcs=[' '.join])
+    ])
+    conn = RecordingConnection()
+    SQLLoader(db, "SELECT name, 0.1, 'x' FROM people WHERE name = 'person 1'", [priced]).run(conn)
+    assert(instance_values(conn)[0][1] == decimal.Decimal('0.1'))
+    components, data, labels, key = priced.compile()(['person 1', 2.5, ['a', 'b']])
+    assert(data[2].dataelement.value == 'a b')
+
+    with pytest.raises(LoaderError):
+        SQLLoader(db, 'SELECT * FROM missing', [sample_mapping()]).run(RecordingConnection())
+
+def test_sinks(tmp_path):
+    path = write_csv(tmp_path, sample_rows(250))
+    direct = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1).run(direct)
+
+    dry_run = DryRunSink()
+    result = CSVLoader(path, [sample_mapping()], header_count=1).run(None, sink=dry_run)
+    assert(dry_run.counts == {'lives in': 250} and result['instances'] == 250)
+
+    spool = str(tmp_path / 'spool.jsonl')
+    CSVLoader(path, [sample_mapping()], header_count=1).run(None, sink=SpoolSink(spool))
+    with open(spool) as f:
+        assert(len(f.readlines()) == 250)
+
+    replayed = RecordingConnection()
+    result = SpoolSink.replay(spool, ConnectorSink(replayed), batch_size=100)
+    assert(instance_values(replayed) == instance_values(direct))
+    assert(result['rows'] == 250 and [len(b) for b in replayed.batches] == [100, 100, 50])
+    assert(replayed.topologies[0].components == direct.topologies[0].components)
+
+    # XML loaders run on the same engine and sinks
+    loader = XMLLoader.fromstring(sample_xml(30))
+    loader.mappings = [sample_xml_mapping()]
+    dry_run = DryRunSink()
+    loader.run(RecordingConnection(), sink=dry_run)
+    assert(dry_run.counts == {'lives in': 30})
+
+def test_CSVLoader_follow(tmp_path):
+    import threading
+    import time
+    path = write_csv(tmp_path, sample_rows(150))
+    offsets = str(tmp_path / 'offsets.db')
+    options = dict(offsets=offsets, poll_interval=0.01, max_latency=0.05)
+
+    conn = RecordingConnection()
+    result = CSVLoader(path, [sample_mapping()], header_count=1).follow(conn, idle_timeout=0.2, **options)
+    assert(instance_values(conn) == [(r[0], r[1], int(r[2])) for r in sample_rows(150)[1:]])
+    assert(result['rows'] == 150 and [len(b) for b in conn.batches] == [100, 50])
+
+    # A restart resumes at the stored offset and leaves an incomplete record for later
+    with open(path, 'a', newline='') as f:
+        csv.writer(f).writerows(sample_rows(160)[151:])
+        f.write('late,"Gent\n')
+    conn = RecordingConnection()
+    CSVLoader(path, [sample_mapping()], header_count=1).follow(conn, idle_timeout=0.2, **options)
+    assert([v[0] for v in instance_values(conn)] == ['person {0}'.format(i) for i in range(150, 160)])
+
+    # A rotated file is drained and the new file is followed from its headers on
+    conn = RecordingConnection()
+    stop = threading.Event()
+    follower = threading.Thread(target=CSVLoader(path, [sample_mapping()], header_count=1).follow,
+                                args=(conn,), kwargs=dict(stop=stop, **options))
+    follower.start()
+
+    def wait_for(count):
+        deadline = time.monotonic() + 10
+        while len(conn.instances()) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    with open(path, 'a', newline='') as f:
+        f.write('Oost",2000\r\n')
+    wait_for(1)
+    os.rename(path, path + '.1')
+    write_csv(tmp_path, sample_rows(20))
+    wait_for(21)
+    stop.set()
+    follower.join()
+    assert(instance_values(conn)[0] == ('late', 'Gent\nOost', 2000))
+    assert(len(conn.instances()) == 21 and instance_values(conn)[1][0] == 'person 0')